@@ -0,0 +1,110 @@
+"""
+Benchmark HLS media playlist parsing on long playlists: one dict per segment
+from decoded lines versus the compact MediaPlaylistParser, plus a live reload
+that resumes after the previous playlist
+
+Usage: python benchmarks/bench_m3u8_parser.py [--segments N] [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from urllib.parse import urljoin
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.core.m3u8_parser import MediaPlaylistParser
+
+BASE_URL = "https://cdn.example.com/live/stream/"
+
+
+def make_playlist(segments, start=0):
+    """An EVENT playlist with program date times, as long DVR recordings have"""
+    lines = ["#EXTM3U", "#EXT-X-VERSION:6", "#EXT-X-TARGETDURATION:6", "#EXT-X-PLAYLIST-TYPE:EVENT",
+             "#EXT-X-MEDIA-SEQUENCE:0"]
+    for sequence in range(start, start + segments):
+        lines.append(f"#EXT-X-PROGRAM-DATE-TIME:2024-01-01T00:{sequence // 10 % 60:02d}:00.000Z")
+        lines.append("#EXTINF:6.006,")
+        lines.append(f"segment_{sequence}.ts?token=abcdef0123456789")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def dict_parser(data, base_url, after_sequence=None):
+    """The previous approach: decode, split into lines and build a dict per segment"""
+    fragments = []
+    sequence = 0
+    duration = None
+    for line in data.decode('utf-8').splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':')[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line and not line.startswith('#'):
+            if after_sequence is None or sequence > after_sequence:
+                url = line if line.startswith(('http://', 'https://')) else urljoin(base_url, line)
+                fragments.append({'url': url, 'sequence': sequence, 'duration': duration})
+            sequence += 1
+            duration = None
+    return fragments
+
+
+def compact_parser(data, base_url, after_sequence=None):
+    return MediaPlaylistParser(base_url).parse(data, after_sequence)['fragments']
+
+
+def measure(function, repeat):
+    """Return the best time of several runs and the peak memory of one"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="M3U8 parser benchmark")
+    parser.add_argument("--segments", type=int, default=50000, help="Segments in the playlist")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement (best time is shown)")
+    args = parser.parse_args()
+
+    data = make_playlist(args.segments)
+    # The next reload of the same EVENT playlist, three segments longer
+    reloaded = data + make_playlist(3, args.segments).split(b"#EXT-X-MEDIA-SEQUENCE:0\n", 1)[1]
+    last_sequence = args.segments - 1
+
+    live = MediaPlaylistParser(BASE_URL)
+    live.parse(data)
+    primed = dict(vars(live))
+
+    def resumed_reload():
+        # Every run starts from the parser state left by the previous playlist
+        vars(live).update(primed)
+        return live.parse(reloaded, last_sequence)['fragments']
+
+    cases = (
+        ("dict full", lambda: dict_parser(data, BASE_URL)),
+        ("compact full", lambda: compact_parser(data, BASE_URL)),
+        ("dict reload", lambda: dict_parser(reloaded, BASE_URL, last_sequence)),
+        ("compact reload", lambda: compact_parser(reloaded, BASE_URL, last_sequence)),
+        ("resumed reload", resumed_reload),
+    )
+
+    print(f"{args.segments} segments, {len(data) / 1024:.0f} KiB playlist")
+    print(f"{'parser':>15}  {'ms':>8}  {'peak KiB':>9}")
+    for name, function in cases:
+        elapsed, peak = measure(function, args.repeat)
+        print(f"{name:>15}  {elapsed * 1000:>8.2f}  {peak / 1024:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark per-fragment progress bookkeeping: rewriting progress.json on every
+commit versus appending to the progress journal
+
+Usage: python benchmarks/bench_progress_journal.py [--fragments N]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.core.progress_journal import ProgressJournal
+
+
+def rewrite_json(output_dir, count):
+    """The previous approach: dump the whole state after every fragment"""
+    path = os.path.join(output_dir, "progress.json")
+    records = []
+    for index in range(count):
+        records.append([index, 188 * 1000])
+        with open(path, 'w') as f:
+            json.dump({
+                'fragments_total': len(records),
+                'fragments_downloaded': len(records),
+                'last_fragment': index,
+                'last_url': f"https://cdn.example.com/frag{index}.ts",
+                'fragments': records
+            }, f)
+
+
+def append_journal(output_dir, count):
+    journal = ProgressJournal(output_dir)
+    records = []
+    for index in range(count):
+        records.append([index, 188 * 1000])
+        if journal.append(index, index, 188 * 1000):
+            journal.checkpoint({'fragments_total': len(records), 'fragments': records})
+    journal.checkpoint({'fragments_total': len(records), 'fragments': records})
+
+
+def run(function, count):
+    output_dir = tempfile.mkdtemp(prefix="bench_progress_")
+    try:
+        start = time.perf_counter()
+        function(output_dir, count)
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Progress bookkeeping benchmark")
+    parser.add_argument("--fragments", type=int, default=5000, help="Number of committed fragments")
+    args = parser.parse_args()
+
+    print(f"{args.fragments} fragments")
+    print(f"{'method':>14}  {'seconds':>8}  {'us/fragment':>11}")
+    for name, function in (("rewrite json", rewrite_json), ("journal", append_journal)):
+        elapsed = run(function, args.fragments)
+        print(f"{name:>14}  {elapsed:>8.3f}  {elapsed / args.fragments * 1e6:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
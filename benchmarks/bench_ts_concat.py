@@ -0,0 +1,94 @@
+"""
+Benchmark merging MPEG-TS fragments: the native concatenation in
+stream_merger (copy_file_range/sendfile, with a buffered fallback) versus
+FFmpeg's concat demuxer
+
+The fragments are cut on packet boundaries from one MPEG-TS file that FFmpeg
+encodes from a test source, then repeated to reach the requested total size.
+
+Usage: python benchmarks/bench_ts_concat.py [--fragments N] [--fragment-kib N] [--ffmpeg PATH]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.core import stream_merger
+from src.core.fragment_validation import TS_PACKET_SIZE
+
+
+def make_source(ffmpeg_path, path):
+    """Encode a few seconds of test video and audio as MPEG-TS"""
+    subprocess.run([ffmpeg_path, "-loglevel", "error", "-f", "lavfi", "-i", "testsrc=size=640x360:rate=30",
+                    "-f", "lavfi", "-i", "sine=frequency=440", "-t", "10", "-c:v", "mpeg2video", "-b:v", "4M",
+                    "-c:a", "mp2", "-f", "mpegts", "-y", path], check=True)
+
+
+def make_fragments(source, directory, count, fragment_size):
+    """Write count fragments of about fragment_size bytes, each a whole number of TS packets"""
+    with open(source, 'rb') as f:
+        data = f.read()
+    fragment_size = max(TS_PACKET_SIZE, fragment_size - fragment_size % TS_PACKET_SIZE)
+    offset = 0
+    for index in range(count):
+        if offset + fragment_size > len(data):
+            offset = 0
+        with open(os.path.join(directory, f"fragment_{index:06d}.ts"), 'wb') as f:
+            f.write(data[offset:offset + fragment_size])
+        offset += fragment_size
+
+
+def timed_merge(directory, output_file, ffmpeg_path, native):
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    start = time.perf_counter()
+    ok = stream_merger.merge_ts_files(directory, output_file, ffmpeg_path, native=native)
+    return time.perf_counter() - start, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MPEG-TS concatenation benchmark")
+    parser.add_argument("--fragments", type=int, default=2000, help="Number of fragments")
+    parser.add_argument("--fragment-kib", type=int, default=512, help="Size of each fragment in KiB")
+    parser.add_argument("--ffmpeg", default="ffmpeg", help="FFmpeg executable")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work:
+        source = os.path.join(work, "source.ts")
+        fragments_dir = os.path.join(work, "fragments")
+        os.mkdir(fragments_dir)
+        output_file = os.path.join(work, "merged.ts")
+        make_source(args.ffmpeg, source)
+        make_fragments(source, fragments_dir, args.fragments, args.fragment_kib * 1024)
+        total = sum(entry.stat().st_size for entry in os.scandir(fragments_dir))
+
+        def buffered_only():
+            # Force the buffered fallback, as on filesystems without in-kernel copies
+            with mock.patch.object(stream_merger, "_copy_file_range", lambda in_fd, out_fd, offset, size: offset), \
+                    mock.patch.object(stream_merger, "_sendfile", lambda in_fd, out_fd, offset, size: offset):
+                return timed_merge(fragments_dir, output_file, args.ffmpeg, True)
+
+        cases = (
+            ("native", lambda: timed_merge(fragments_dir, output_file, args.ffmpeg, True)),
+            ("buffered", buffered_only),
+            ("ffmpeg concat", lambda: timed_merge(fragments_dir, output_file, args.ffmpeg, False)),
+        )
+
+        print(f"{args.fragments} fragments, {total / 1024 ** 2:.0f} MiB")
+        print(f"{'merge':>14}  {'seconds':>8}  {'MiB/s':>8}")
+        for name, function in cases:
+            elapsed, ok = function()
+            if not ok:
+                print(f"{name:>14}  {'failed':>8}")
+                continue
+            print(f"{name:>14}  {elapsed:>8.2f}  {total / 1024 ** 2 / elapsed:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+A local HTTP server that imitates a high-latency HLS CDN for benchmarks
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TS_PACKET_SIZE = 188
+
+
+def make_ts_payload(size):
+    """Build a payload of MPEG-TS sized packets that all start with the 0x47 sync byte"""
+    packet = b'\x47' + b'\x00' * (TS_PACKET_SIZE - 1)
+    packets = size // TS_PACKET_SIZE or 1
+    return packet * packets
+
+
+class _CDNHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        cdn = self.server.cdn
+        time.sleep(cdn.latency)
+
+        if self.path.startswith("/stream.m3u8"):
+            body = cdn.playlist()
+            content_type = "application/vnd.apple.mpegurl"
+        elif self.path.startswith("/frag/"):
+            body = cdn.payload
+            content_type = "video/mp2t"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SimulatedCDN:
+    """Serve an HLS playlist and fragments with a fixed per-request latency"""
+
+    def __init__(self, fragment_count=50, fragment_size=256 * 1024, latency=0.05):
+        self.fragment_count = fragment_count
+        self.latency = latency
+        self.payload = make_ts_payload(fragment_size)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _CDNHandler)
+        self.server.daemon_threads = True
+        self.server.cdn = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def playlist_url(self):
+        return f"{self.base_url}/stream.m3u8"
+
+    def playlist(self):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:2", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for i in range(self.fragment_count):
+            lines.append("#EXTINF:2.000,")
+            lines.append(f"frag/{i}.ts")
+        lines.append("#EXT-X-ENDLIST")
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.server.shutdown()
+        self.server.server_close()
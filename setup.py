@@ -18,6 +18,7 @@ setup(
         "requests>=2.25.0",
         "inquirer>=3.1.3",
         "colorama>=0.4.6",
+        "pycryptodomex>=3.15.0",
     ],
     entry_points={
         "console_scripts": [
@@ -16,8 +16,8 @@ from colorama import init, Fore, Style, Back # type: ignore
 init(autoreset=True)
 
 # Import required modules from the existing application
-from src.core.stream_downloader import StreamDownloader
 from src.core.stream_merger import process_stream_download
+from src.core.rate_limiter import parse_rate
 from src.utils.history_manager import HistoryManager
 from src.utils.updater import get_current_version, check_for_updates
 from src.utils.spinner import Spinner
@@ -227,6 +227,8 @@ def download_with_yt_dlp(args):
         command.extend(["--retries", str(args.retries)])
     if hasattr(args, 'timeout') and args.timeout is not None:
         command.extend(["--socket-timeout", str(args.timeout)])
+    if getattr(args, 'limit_rate', None):
+        command.extend(["--limit-rate", str(args.limit_rate)])
     if hasattr(args, 'quiet') and args.quiet:
         command.append("--quiet")
     if hasattr(args, 'abort_on_error') and args.abort_on_error:
@@ -1020,6 +1022,7 @@ def show_help():
     print(f"{Fore.WHITE}    --proxy URL           Use proxy for downloading")
     print(f"{Fore.WHITE}    --retries NUMBER      Number of retry attempts (default: 3)")
     print(f"{Fore.WHITE}    --timeout SECONDS     Connection timeout in seconds (default: 30)")
+    print(f"{Fore.WHITE}    --limit-rate RATE     Maximum download rate of this download, e.g. 500K or 2M")
     print(f"{Fore.WHITE}    --quiet               Suppress all output except errors")
     print(f"{Fore.WHITE}    --abort-on-error      Abort on first error")
     print(f"{Fore.WHITE}    --list-formats        List all available formats before downloading")
@@ -1123,6 +1126,7 @@ def main():
     download_parser.add_argument("--proxy", help="Use proxy for downloading. Format: http://[user:pass@]host:port/")
     download_parser.add_argument("--retries", type=int, default=3, help="Number of retry attempts (default: 3)")
     download_parser.add_argument("--timeout", type=int, default=30, help="Connection timeout in seconds (default: 30)")
+    download_parser.add_argument("--limit-rate", type=parse_rate, metavar="RATE", help="Maximum download rate of this download in bytes per second, e.g. 500K or 2M")
     download_parser.add_argument("--quiet", action="store_true", help="Suppress all output except errors")
     download_parser.add_argument("--abort-on-error", action="store_true", help="Abort on first error")
     download_parser.add_argument("--list-formats", action="store_true", help="List all available formats before downloading")
@@ -0,0 +1,104 @@
+import os
+import shutil
+import logging
+
+STREAM_NAME = "stream"
+INDEX_FILE = "stream.index"
+
+
+def single_file_path(output_dir, extension='ts'):
+    """Return the path of the file that single-file mode appends fragments to"""
+    return os.path.join(output_dir, f"{STREAM_NAME}.{extension}")
+
+
+def fragment_file_path(output_dir, index, extension='ts'):
+    """Return the path of the fragment committed at index when every fragment gets its own file
+
+    Indices are zero-padded to five digits and just get longer past 99,999, so
+    these files must be put in order with fragment_file_index(), never by name.
+    """
+    return os.path.join(output_dir, f"fragment_{index:05d}.{extension}")
+
+
+def fragment_file_index(path):
+    """Return the index of a fragment_<index>.<extension> file"""
+    return int(os.path.basename(path).split("_")[1].split(".")[0])
+
+
+class AppendWriter:
+    """Append committed fragments to one growing file, with a sidecar offset index
+
+    Fragments are appended in commit order to stream.<extension>. After each
+    one is flushed, a "sequence offset size" line is added to stream.index,
+    so a crash leaves at most an unindexed tail. load() cuts that tail off.
+    """
+
+    def __init__(self, output_dir, extension='ts'):
+        self.path = single_file_path(output_dir, extension)
+        self.index_path = os.path.join(output_dir, INDEX_FILE)
+        self.logger = logging.getLogger("stream_downloader")
+        self.offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self._data = None
+        self._index = None
+
+    def append(self, part_path, sequence):
+        """Append a downloaded fragment file to the stream and remove it; returns its size"""
+        if self._data is None:
+            self._data = open(self.path, 'ab')
+            self._index = open(self.index_path, 'a')
+        with open(part_path, 'rb') as f:
+            shutil.copyfileobj(f, self._data, 1024 * 1024)
+        self._data.flush()
+        size = self._data.tell() - self.offset
+
+        self._index.write(f"{sequence} {self.offset} {size}\n")
+        self._index.flush()
+        self.offset += size
+        os.remove(part_path)
+        return size
+
+    def load(self):
+        """Return the (sequence, offset, size) of every indexed fragment
+
+        Torn index lines and data past the last indexed fragment, left by a
+        crash, are truncated so appending can carry on from there.
+        """
+        self.close()
+        entries = []
+        index_length = 0
+        data_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) != 3 or not line.endswith(b"\n"):
+                        break
+                    sequence, offset, size = (int(part) for part in parts)
+                    expected = entries[-1][1] + entries[-1][2] if entries else 0
+                    if offset != expected or offset + size > data_size:
+                        break
+                    entries.append((sequence, offset, size))
+                    index_length += len(line)
+            os.truncate(self.index_path, index_length)
+
+        self.offset = entries[-1][1] + entries[-1][2] if entries else 0
+        if data_size > self.offset:
+            self.logger.info(f"Dropping {data_size - self.offset} unindexed bytes from {self.path}")
+            os.truncate(self.path, self.offset)
+        return entries
+
+    def reset(self):
+        """Start an empty stream, discarding what an earlier download left behind"""
+        self.close()
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.offset = 0
+
+    def close(self):
+        """Close the stream and index files; the next append reopens them"""
+        for f in (self._data, self._index):
+            if f is not None:
+                f.close()
+        self._data = None
+        self._index = None
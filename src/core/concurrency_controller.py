@@ -0,0 +1,82 @@
+import time
+
+
+class AIMDController:
+    """Additive-increase/multiplicative-decrease limit on in-flight fragment requests
+
+    Results are observed in rounds of ``limit`` fragments. After a round whose
+    throughput did not fall (within ``noise``) and whose mean latency stayed
+    within ``latency_tolerance`` of the best round seen, the limit grows by
+    ``increase``. Throttling responses (HTTP 429/5xx) and timeouts multiply it
+    by ``decrease``, at most once per round so one burst of errors from
+    requests that were already in flight only counts once.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=16, increase=1, decrease=0.5,
+                 latency_tolerance=1.5, noise=0.05):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.maximum, max(self.minimum, initial))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.noise = noise
+        self._congestion_seen = 0
+        self._last_throughput = None
+        self._base_latency = None
+        self._start_round()
+
+    def _start_round(self):
+        self._round_bytes = 0
+        self._round_latency = 0
+        self._round_count = 0
+        self._round_congested = False
+        self._round_start = time.monotonic()
+
+    def _change(self, limit, reason):
+        previous = self.limit
+        self.limit = limit
+        self._start_round()
+        return {'concurrency': limit, 'previous': previous, 'reason': reason}
+
+    def observe(self, result, congestion_errors=0):
+        """Account for one finished fragment and the job's running count of throttling errors
+
+        Returns {'concurrency', 'previous', 'reason'} when the limit changed, otherwise None.
+        """
+        new_errors = congestion_errors - self._congestion_seen
+        self._congestion_seen = congestion_errors
+        if new_errors > 0 and not self._round_congested:
+            limit = max(self.minimum, int(self.limit * self.decrease))
+            if limit < self.limit:
+                self._last_throughput = None
+                change = self._change(limit, f"backing off after {new_errors} throttled or timed out requests")
+                self._round_congested = True
+                return change
+            self._round_congested = True
+
+        if result.get('error') or result.get('elapsed') is None:
+            return None
+
+        self._round_bytes += result['bytes']
+        self._round_latency += result['elapsed']
+        self._round_count += 1
+        if self._round_count < self.limit:
+            return None
+
+        throughput = self._round_bytes / max(time.monotonic() - self._round_start, 1e-6)
+        latency = self._round_latency / self._round_count
+        self._base_latency = latency if self._base_latency is None else min(self._base_latency, latency)
+        previous_throughput = self._last_throughput
+        self._last_throughput = throughput
+        latency_stable = latency <= self._base_latency * self.latency_tolerance
+        throughput_rising = previous_throughput is None or throughput >= previous_throughput * (1 - self.noise)
+
+        if self._round_congested or not latency_stable or not throughput_rising or self.limit >= self.maximum:
+            self._start_round()
+            return None
+
+        return self._change(
+            min(self.maximum, self.limit + self.increase),
+            f"throughput {throughput / 1024:.0f} KiB/s with stable latency ({latency * 1000:.0f} ms)"
+        )
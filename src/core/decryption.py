@@ -0,0 +1,62 @@
+AES_BLOCK_SIZE = 16
+
+
+def _cbc_decrypt_function():
+    """Return an AES-128-CBC decrypt(data, key, iv) function"""
+    # yt-dlp's AES helpers use pycryptodomex when it is installed and fall
+    # back to a pure Python implementation otherwise
+    try:
+        from yt_dlp.aes import aes_cbc_decrypt_bytes
+    except ImportError:
+        raise RuntimeError("Decrypting AES-128 streams requires yt-dlp (pip install yt-dlp pycryptodomex)")
+    return aes_cbc_decrypt_bytes
+
+
+def parse_iv(value):
+    """Convert an EXT-X-KEY IV attribute such as 0x1A2B... to 16 bytes"""
+    digits = value[2:] if value.lower().startswith('0x') else value
+    return bytes.fromhex(digits.zfill(AES_BLOCK_SIZE * 2))
+
+
+def sequence_iv(media_sequence):
+    """Derive the default IV of a fragment from its media sequence number (RFC 8216 section 5.2)"""
+    return media_sequence.to_bytes(AES_BLOCK_SIZE, 'big')
+
+
+class AES128Decryptor:
+    """Incrementally decrypt an AES-128-CBC stream and strip its PKCS#7 padding"""
+
+    def __init__(self, key, iv):
+        if len(key) != AES_BLOCK_SIZE:
+            raise ValueError(f"AES-128 key must be {AES_BLOCK_SIZE} bytes, got {len(key)}")
+        self.key = key
+        self.iv = iv
+        self._decrypt = _cbc_decrypt_function()
+        self._pending = b''
+
+    def update(self, data):
+        """Decrypt as much of the data as possible, returning the plaintext produced so far"""
+        data = self._pending + bytes(data)
+        # Always keep the last whole block back: it carries the padding
+        usable = (len(data) - 1) // AES_BLOCK_SIZE * AES_BLOCK_SIZE
+        if usable <= 0:
+            self._pending = data
+            return b''
+
+        ciphertext, self._pending = data[:usable], data[usable:]
+        plaintext = self._decrypt(ciphertext, self.key, self.iv)
+        # CBC chains on the previous ciphertext block
+        self.iv = ciphertext[-AES_BLOCK_SIZE:]
+        return plaintext
+
+    def finalize(self):
+        """Decrypt the last block and remove the PKCS#7 padding"""
+        if len(self._pending) != AES_BLOCK_SIZE:
+            raise ValueError("Encrypted fragment is not a whole number of AES blocks")
+
+        plaintext = self._decrypt(self._pending, self.key, self.iv)
+        self._pending = b''
+        padding = plaintext[-1]
+        if not 1 <= padding <= AES_BLOCK_SIZE or plaintext[-padding:] != bytes([padding]) * padding:
+            raise ValueError("Invalid PKCS#7 padding, wrong key or IV?")
+        return plaintext[:-padding]
@@ -0,0 +1,120 @@
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+# Top-level ISO BMFF boxes that start an init segment or a media segment
+_FMP4_BOXES = {b'ftyp', b'styp', b'sidx', b'moof', b'moov', b'mdat', b'emsg', b'prft', b'free', b'skip'}
+# Enough bytes to recognize either format: MPEG-TS needs the sync bytes of two packets
+_SNIFF_SIZE = TS_PACKET_SIZE + 1
+# How error pages start; a body that merely begins with '<' may still be media
+_MARKUP_PREFIXES = (b'<!doctype', b'<html', b'<?xml', b'<head', b'<body', b'<!--', b'<error')
+
+
+class FragmentIntegrityError(ValueError):
+    """A fragment body that is truncated, empty or not the media it should be"""
+
+
+class FragmentValidator:
+    """Incrementally check a fragment body as it is written
+
+    The format is recognized from the first bytes: a body with 0x47 sync bytes
+    at offsets 0 and 188 is MPEG-TS, which must carry one every 188 bytes and
+    end on a packet boundary, fragmented MP4 must
+    be a chain of well-formed boxes that ends exactly at the end of the body.
+    Empty bodies and HTML error pages are rejected; other formats (packed audio,
+    subtitles) are passed through unchecked.
+    """
+
+    def __init__(self, url=None):
+        self.url = url
+        self.format = None
+        self.length = 0
+        self._head = bytearray()
+        self._box_header = bytearray()
+        # Bytes left in the current box; None once a box runs to the end of the body
+        self._box_remaining = 0
+
+    def _fail(self, message):
+        raise FragmentIntegrityError(f"{message}{f' in {self.url}' if self.url else ''}")
+
+    def update(self, data):
+        """Check the next chunk of the body"""
+        if self.format is None:
+            self._head += data
+            if len(self._head) < _SNIFF_SIZE:
+                return
+            data, self._head = bytes(self._head), None
+            self._sniff(data)
+
+        if self.format == 'ts':
+            self._check_ts(data)
+        elif self.format == 'fmp4':
+            self._check_boxes(data)
+        self.length += len(data)
+
+    def finalize(self):
+        """Check the end of the body, raising FragmentIntegrityError if it is incomplete or invalid"""
+        if self.format is None:
+            data, self._head = bytes(self._head), None
+            if not data:
+                self._fail("Empty fragment")
+            self._sniff(data)
+            self.update(data)
+
+        if self.format == 'ts' and self.length % TS_PACKET_SIZE:
+            self._fail(f"MPEG-TS fragment ends in a partial packet ({self.length} bytes)")
+        if self.format == 'fmp4' and (self._box_header or self._box_remaining):
+            self._fail(f"MP4 fragment ends inside a box ({self.length} bytes)")
+
+    def _sniff(self, head):
+        # A single 0x47 is one byte in 256 of any payload, so it takes two packets' worth
+        if len(head) > TS_PACKET_SIZE and head[0] == head[TS_PACKET_SIZE] == TS_SYNC_BYTE:
+            self.format = 'ts'
+        elif head[4:8] in _FMP4_BOXES:
+            self.format = 'fmp4'
+        elif head.lstrip()[:16].lower().startswith(_MARKUP_PREFIXES):
+            self._fail("Got an HTML or XML document instead of media")
+        else:
+            self.format = 'unknown'
+
+    def _check_ts(self, data):
+        # Sync bytes fall on every absolute offset that is a multiple of 188
+        first = -self.length % TS_PACKET_SIZE
+        sync_bytes = bytes(data[first::TS_PACKET_SIZE])
+        if sync_bytes.count(TS_SYNC_BYTE) != len(sync_bytes):
+            self._fail("MPEG-TS sync byte missing")
+
+    def _check_boxes(self, data):
+        pos = 0
+        while pos < len(data):
+            if self._box_remaining is None:
+                return
+            if self._box_remaining:
+                step = min(self._box_remaining, len(data) - pos)
+                self._box_remaining -= step
+                pos += step
+                continue
+
+            # Collect the 8 byte header, plus 8 more for a 64-bit size
+            needed = 16 if len(self._box_header) >= 8 and self._box_header[:4] == b'\x00\x00\x00\x01' else 8
+            take = min(needed - len(self._box_header), len(data) - pos)
+            self._box_header += data[pos:pos + take]
+            pos += take
+            if len(self._box_header) < needed:
+                continue
+            if needed == 8 and self._box_header[:4] == b'\x00\x00\x00\x01':
+                continue
+
+            size = int.from_bytes(self._box_header[:4], 'big')
+            box_type = bytes(self._box_header[4:8])
+            if not all(32 <= byte < 127 or byte == 0xa9 for byte in box_type):
+                self._fail(f"Invalid MP4 box type {box_type!r}")
+            if size == 1:
+                size = int.from_bytes(self._box_header[8:16], 'big')
+            if size == 0:
+                # The last box may extend to the end of the body
+                self._box_remaining = None
+            elif size < len(self._box_header):
+                self._fail(f"Invalid MP4 box size {size} for {box_type!r}")
+            else:
+                self._box_remaining = size - len(self._box_header)
+            self._box_header = bytearray()
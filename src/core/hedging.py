@@ -0,0 +1,56 @@
+import math
+from collections import deque
+
+
+class DownloadCancelled(Exception):
+    """A fragment download that was stopped because a competing request won"""
+
+
+class HedgeTracker:
+    """Latency percentile and request budget deciding when a job hedges a slow fragment
+
+    Once min_samples latencies are known, a fragment still running after the
+    given percentile of recent latencies gets a duplicate request, as long as
+    hedges stay below ``budget`` of all requests.
+    """
+
+    def __init__(self, percentile=95, budget=0.05, min_samples=20, window=256):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def observe(self, latency):
+        """Record the latency of a finished request"""
+        self.latencies.append(latency)
+
+    def count_request(self):
+        """Count a primary request towards the hedging budget"""
+        self.requests += 1
+
+    def threshold(self):
+        """Return the latency after which a request is hedged, or None while there are too few samples"""
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        rank = max(1, math.ceil(self.percentile / 100 * len(ordered)))
+        return ordered[rank - 1]
+
+    def try_acquire(self):
+        """Take a hedge from the budget if one is left"""
+        if self.hedges + 1 > self.budget * self.requests:
+            return False
+        self.hedges += 1
+        return True
+
+    def record_win(self, hedge_won):
+        """Record which of the two racing requests finished first"""
+        if hedge_won:
+            self.hedge_wins += 1
+
+    def snapshot(self):
+        """Return the hedging counters"""
+        return {'requests': self.requests, 'hedges': self.hedges, 'hedge_wins': self.hedge_wins}
@@ -0,0 +1,267 @@
+import hashlib
+import logging
+import re
+from array import array
+from urllib.parse import urljoin
+
+from src.core.decryption import parse_iv, sequence_iv
+
+logger = logging.getLogger("stream_downloader")
+
+_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+_HASH = ord('#')
+# Bytes of playlist text split into lines at once
+_BLOCK_SIZE = 64 * 1024
+
+
+def _digest(data, length):
+    """Digest of the first length bytes of data, hashed in place"""
+    return hashlib.blake2b(memoryview(data)[:length], digest_size=16).digest()
+
+
+def _parse_attribute_list(value):
+    """Parse an HLS attribute list such as BANDWIDTH=1280000,RESOLUTION=1280x720,CODECS="..." into a dict"""
+    return {
+        key: raw[1:-1] if raw.startswith('"') else raw
+        for key, raw in _ATTRIBUTE.findall(value)
+    }
+
+
+def _resolve_uri(base_url, uri):
+    """Make a playlist URI absolute"""
+    if not base_url or uri.startswith(('http://', 'https://')):
+        return uri
+    return urljoin(base_url if base_url.endswith('/') else base_url + '/', uri)
+
+
+class FragmentTable:
+    """Read-only sequence of the segments of a media playlist, stored in parallel arrays
+
+    Each segment takes a duration, the start and end offset of its URI in the
+    playlist body, a key index and a byte range; sequence numbers count up
+    from first_sequence. Indexing and iterating build the usual fragment dicts,
+    and only then is the URI decoded and resolved against base_url.
+    """
+
+    def __init__(self, data, base_url=None):
+        self.data = data
+        self.base_url = base_url
+        self.first_sequence = 0
+        # -1 when the segment has no EXTINF duration
+        self.durations = array('d')
+        # start, end pairs
+        self.uri_offsets = array('q')
+        # Index into keys, -1 for unencrypted segments
+        self.key_indices = array('i')
+        self.keys = []
+        # offset, length pairs; -1, -1 without a byte range
+        self.ranges = array('q')
+
+    def __len__(self):
+        return len(self.durations)
+
+    def __iter__(self):
+        for index in range(len(self.durations)):
+            yield self._fragment(index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._fragment(i) for i in range(*index.indices(len(self.durations)))]
+        if index < 0:
+            index += len(self.durations)
+        if not 0 <= index < len(self.durations):
+            raise IndexError("fragment index out of range")
+        return self._fragment(index)
+
+    @property
+    def last_sequence(self):
+        """Sequence number of the last segment, or None when the table is empty"""
+        return self.first_sequence + len(self.durations) - 1 if self.durations else None
+
+    def _fragment(self, index):
+        sequence = self.first_sequence + index
+        uri = self.data[self.uri_offsets[2 * index]:self.uri_offsets[2 * index + 1]].decode('utf-8')
+        duration = self.durations[index]
+        fragment = {
+            'url': _resolve_uri(self.base_url, uri),
+            'sequence': sequence,
+            'duration': duration if duration >= 0 else None
+        }
+        key_index = self.key_indices[index]
+        if key_index >= 0:
+            key = self.keys[key_index]
+            # Without an explicit IV, the media sequence number is the IV
+            fragment['key'] = dict(key, iv=key['iv'] or sequence_iv(sequence))
+        if self.ranges[2 * index + 1] >= 0:
+            fragment['byterange'] = (self.ranges[2 * index], self.ranges[2 * index + 1])
+        return fragment
+
+
+class MediaPlaylistParser:
+    """Incremental HLS media playlist parser with a compact result
+
+    The raw body is split into lines one bounded block at a time and segments
+    are appended to a FragmentTable, so nothing per segment outlives the
+    parse. The parser remembers where the last complete
+    segment of the previous playlist ended: when a reload still starts with
+    those bytes, as EVENT playlists and growing DVR windows do, and only
+    segments after that one are wanted, scanning resumes there instead of at
+    the top. Only the length and a digest of that prefix are kept, not the
+    bytes themselves.
+
+    Sliding-window live playlists don't benefit: once the oldest segment
+    drops off and EXT-X-MEDIA-SEQUENCE moves, the body no longer starts with
+    the previous prefix and every reload is parsed from the top.
+    """
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url
+        # Length and digest of the previous playlist up to the end of its last complete segment
+        self._prefix_length = 0
+        self._prefix_digest = None
+        self._state = None
+
+    def _can_resume(self, data, after_sequence):
+        if not self._prefix_length or after_sequence is None or after_sequence < self._state['sequence'] - 1:
+            return False
+        if len(data) < self._prefix_length:
+            return False
+        return _digest(data, self._prefix_length) == self._prefix_digest
+
+    def parse(self, data, after_sequence=None):
+        """Parse a playlist body into its fragments and playlist-level tags
+
+        Returns target_duration, media_sequence, endlist, can_skip_until,
+        skipped_segments and the fragments as a FragmentTable. Segments up to
+        after_sequence are counted but not stored, so a live reload only
+        yields the segments that are new since the last one.
+        """
+        data = bytes(data)
+        if self._can_resume(data, after_sequence):
+            state = dict(self._state, range_ends=dict(self._state['range_ends']))
+            pos = self._prefix_length
+        else:
+            state = {'target_duration': None, 'media_sequence': 0, 'can_skip_until': None, 'skipped_segments': 0,
+                     'sequence': None, 'key': None, 'range_ends': {}}
+            pos = 0
+
+        table = FragmentTable(data, self.base_url)
+        durations, uri_offsets, key_indices, ranges = table.durations, table.uri_offsets, table.key_indices, table.ranges
+        sequence = state['sequence']
+        key = state['key']
+        key_index = -1
+        if key:
+            table.keys.append(key)
+            key_index = 0
+        range_ends = state['range_ends']
+        endlist = False
+        duration = -1.0
+        byterange = None
+        checkpoint, checkpoint_sequence, checkpoint_key = pos, sequence, key
+        size = len(data)
+
+        while pos < size:
+            # Split a bounded block at a time so the transient line objects stay small
+            block_end = data.find(b'\n', min(pos + _BLOCK_SIZE, size))
+            if block_end < 0:
+                block_end = size
+            for line in data[pos:block_end].split(b'\n'):
+                start = pos
+                pos += len(line) + 1
+                if not line:
+                    continue
+                if line[0] <= 32 or line[-1] <= 32:
+                    stripped = line.strip()
+                    if not stripped:
+                        continue
+                    start += len(line) - len(line.lstrip())
+                    line = stripped
+
+                if line[0] != _HASH:
+                    # A segment URI
+                    if sequence is None:
+                        sequence = 0
+                    offset = length = -1
+                    if byterange is not None:
+                        if pos > size:
+                            # Keep the saved range ends as of the last complete segment
+                            range_ends = dict(range_ends)
+                        length, _, offset = byterange.partition(b'@')
+                        length = int(length)
+                        offset = int(offset) if offset else range_ends.get(line, 0)
+                        range_ends[line] = offset + length
+                        byterange = None
+
+                    if after_sequence is None or sequence > after_sequence:
+                        if not durations:
+                            table.first_sequence = sequence
+                        durations.append(duration)
+                        uri_offsets.append(start)
+                        uri_offsets.append(start + len(line))
+                        key_indices.append(key_index)
+                        ranges.append(offset)
+                        ranges.append(length)
+
+                    sequence += 1
+                    duration = -1.0
+                    # Only a newline-terminated URI is known to be complete
+                    if pos <= size:
+                        checkpoint, checkpoint_sequence, checkpoint_key = pos, sequence, key
+
+                elif line.startswith(b'#EXTINF:'):
+                    comma = line.find(b',')
+                    duration = float(line[8:comma if comma >= 0 else len(line)])
+
+                elif line.startswith(b'#EXT-X-BYTERANGE:'):
+                    byterange = line[17:]
+
+                elif line.startswith(b'#EXT-X-KEY:'):
+                    attributes = _parse_attribute_list(line[11:].decode('utf-8'))
+                    method = attributes.get('METHOD', 'NONE')
+                    if method == 'NONE':
+                        key = None
+                        key_index = -1
+                    else:
+                        if method != 'AES-128':
+                            logger.warning(f"Unsupported HLS encryption method: {method}")
+                        key = {
+                            'method': method,
+                            'uri': _resolve_uri(self.base_url, attributes.get('URI', '')),
+                            'iv': parse_iv(attributes['IV']) if 'IV' in attributes else None
+                        }
+                        table.keys.append(key)
+                        key_index = len(table.keys) - 1
+
+                elif line.startswith(b'#EXT-X-MEDIA-SEQUENCE:'):
+                    sequence = state['media_sequence'] = int(line[22:])
+
+                elif line.startswith(b'#EXT-X-TARGETDURATION:'):
+                    state['target_duration'] = float(line[22:])
+
+                elif line.startswith(b'#EXT-X-ENDLIST'):
+                    endlist = True
+
+                elif line.startswith(b'#EXT-X-SERVER-CONTROL:'):
+                    attributes = _parse_attribute_list(line[22:].decode('utf-8'))
+                    if 'CAN-SKIP-UNTIL' in attributes:
+                        state['can_skip_until'] = float(attributes['CAN-SKIP-UNTIL'])
+
+                elif line.startswith(b'#EXT-X-SKIP:'):
+                    # A delta update leaves out the oldest segments, which still use up sequence numbers
+                    skipped = int(_parse_attribute_list(line[12:].decode('utf-8')).get('SKIPPED-SEGMENTS', 0))
+                    state['skipped_segments'] = skipped
+                    sequence = (sequence or 0) + skipped
+            pos = block_end + 1
+
+        self._prefix_length = checkpoint
+        self._prefix_digest = _digest(data, checkpoint)
+        self._state = dict(state, sequence=checkpoint_sequence, key=checkpoint_key)
+
+        return {
+            'target_duration': state['target_duration'],
+            'media_sequence': state['media_sequence'],
+            'endlist': endlist,
+            'can_skip_until': state['can_skip_until'],
+            'skipped_segments': state['skipped_segments'],
+            'fragments': table
+        }
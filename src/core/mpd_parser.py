@@ -0,0 +1,229 @@
+import io
+import re
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from urllib.parse import urljoin
+
+_NS = '{urn:mpeg:dash:schema:mpd:2011}'
+_MPD = _NS + 'MPD'
+_PERIOD = _NS + 'Period'
+_ADAPTATION_SET = _NS + 'AdaptationSet'
+_REPRESENTATION = _NS + 'Representation'
+_BASE_URL = _NS + 'BaseURL'
+_SEGMENT_TEMPLATE = _NS + 'SegmentTemplate'
+_SEGMENT_TIMELINE = _NS + 'SegmentTimeline'
+_S = _NS + 'S'
+
+_ISO_DURATION = re.compile(
+    r'^P(?:([\d.]+)Y)?(?:([\d.]+)M)?(?:([\d.]+)D)?(?:T(?:([\d.]+)H)?(?:([\d.]+)M)?(?:([\d.]+)S)?)?$'
+)
+
+
+def _parse_iso_duration(value):
+    """Convert an ISO 8601 duration such as PT1H2M3.5S to seconds"""
+    match = _ISO_DURATION.match(value.strip()) if value else None
+    if not match:
+        return None
+    years, months, days, hours, minutes, seconds = (float(g) if g else 0 for g in match.groups())
+    return (((years * 365 + months * 30 + days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def _parse_iso_datetime(value):
+    """Convert an ISO 8601 timestamp to a POSIX timestamp"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.strip().replace('Z', '+00:00')).timestamp()
+
+
+def _parse_frame_rate(value):
+    """Convert a DASH frameRate such as 30 or 30000/1001 to a float"""
+    if not value:
+        return None
+    numerator, _, denominator = value.partition('/')
+    return float(numerator) / float(denominator or 1)
+
+
+class DashManifestParser:
+    """Streaming DASH manifest parser that keeps an index of representations between refreshes
+
+    The MPD is read with iterparse and every element is freed once its end
+    tag has been handled, so a long SegmentTimeline never exists as a tree.
+    Periods that are closed (they have a duration or a later period follows)
+    are cached by id, start, duration and base URL; when a refresh contains one again,
+    its elements are skipped and the cached representations reused, so only
+    the open live period is rebuilt. A period without a duration attribute
+    lasts until the next period starts.
+    """
+
+    def __init__(self, manifest_url=None):
+        self.manifest_url = manifest_url
+        # Representation id -> its representation in every period of the last parsed manifest, in order
+        self.index = {}
+        self._closed_periods = {}
+        # (id, start, base URL) -> duration up to the next period's start, from the last parse
+        self._period_ends = {}
+
+    def parse(self, manifest_data):
+        """Parse a manifest into its MPD-level attributes and representations"""
+        if isinstance(manifest_data, str):
+            manifest_data = manifest_data.encode('utf-8')
+        mpd = None
+        closed_periods = {}
+        period_ends = {}
+        # Open MPD, Period, AdaptationSet and Representation levels, innermost last
+        levels = []
+        # Elements whose end tag is still ahead, so each can be dropped from its parent once handled
+        elements = []
+        period = None
+        timeline = None
+        period_start = 0
+
+        for event, element in ET.iterparse(io.BytesIO(manifest_data), events=('start', 'end')):
+            tag = element.tag
+            if event == 'start':
+                elements.append(element)
+                if tag == _PERIOD:
+                    if period is not None:
+                        # A later period closes the previous one, which lasts until its start
+                        start = _parse_iso_duration(element.get('start'))
+                        if start is not None and period['duration_attribute'] is None:
+                            if not self._end_period(period, start - period['start']):
+                                # A reused period no longer ends where it did, so nothing cached can be trusted
+                                self._closed_periods = {}
+                                self._period_ends = {}
+                                return self.parse(manifest_data)
+                            period_ends[period['key'][:2] + period['key'][3:]] = period['duration']
+                        closed_periods[period['key']] = period['representations']
+                    period, period_start = self._start_period(element, mpd, levels[0], period_start)
+                    levels.append(period)
+                elif period is not None and period['cached']:
+                    pass
+                elif tag == _ADAPTATION_SET or tag == _REPRESENTATION:
+                    levels.append({'attrib': dict(element.attrib), 'base_url': levels[-1]['base_url'],
+                                   'has_base_url': False, 'template': levels[-1]['template']})
+                elif tag == _SEGMENT_TIMELINE:
+                    timeline = []
+                elif tag == _MPD:
+                    mpd = {
+                        'type': element.get('type', 'static'),
+                        'minimum_update_period': _parse_iso_duration(element.get('minimumUpdatePeriod')),
+                        'availability_start_time': _parse_iso_datetime(element.get('availabilityStartTime')),
+                        'time_shift_buffer_depth': _parse_iso_duration(element.get('timeShiftBufferDepth')),
+                        'media_presentation_duration': _parse_iso_duration(element.get('mediaPresentationDuration')),
+                        'representations': []
+                    }
+                    levels.append({'base_url': self.manifest_url, 'has_base_url': False, 'template': {}})
+                continue
+
+            elements.pop()
+            if tag == _PERIOD:
+                levels.pop()
+                mpd['representations'].extend(period['representations'])
+                if period['duration_attribute'] is not None:
+                    closed_periods[period['key']] = period['representations']
+                    period_start += period['duration_attribute']
+            elif period is not None and period['cached']:
+                pass
+            elif tag == _S:
+                timeline.append({
+                    't': int(element.get('t')) if element.get('t') is not None else None,
+                    'd': int(element.get('d')),
+                    'r': int(element.get('r', 0))
+                })
+            elif tag == _SEGMENT_TEMPLATE:
+                level = levels[-1]
+                template = dict(level['template'])
+                template.update(element.attrib)
+                if timeline is not None:
+                    template['timeline'] = timeline
+                    timeline = None
+                level['template'] = template
+            elif tag == _BASE_URL:
+                level = levels[-1]
+                # Only the first BaseURL of a level counts, the others are alternatives
+                if element.text and not level['has_base_url']:
+                    level['base_url'] = urljoin(level['base_url'] or '', element.text.strip())
+                    level['has_base_url'] = True
+            elif tag == _REPRESENTATION:
+                rep = levels.pop()
+                period['representations'].append(self._representation(rep, levels[-1], period))
+            elif tag == _ADAPTATION_SET:
+                levels.pop()
+
+            # Free the element and drop it from its parent, which it is the last child of
+            element.clear()
+            if elements:
+                del elements[-1][-1]
+
+        self._closed_periods = closed_periods
+        self._period_ends = period_ends
+        self.index = {}
+        for rep in mpd['representations']:
+            self.index.setdefault(rep['id'], []).append(rep)
+        # Also handed out with the manifest, so callers don't search its representations
+        mpd['index'] = self.index
+        return mpd
+
+    def _start_period(self, element, mpd, mpd_level, period_start):
+        start = _parse_iso_duration(element.get('start'))
+        if start is not None:
+            period_start = start
+        duration_attribute = _parse_iso_duration(element.get('duration'))
+        duration = duration_attribute
+        if duration is None:
+            # Where the next period started last time; _end_period() corrects it if that changed
+            duration = self._period_ends.get((element.get('id'), period_start, mpd_level['base_url']))
+        if duration is None and mpd['media_presentation_duration']:
+            duration = mpd['media_presentation_duration'] - period_start
+
+        key = (element.get('id'), period_start, duration, mpd_level['base_url'])
+        cached = self._closed_periods.get(key)
+        period = {
+            'id': element.get('id'),
+            'key': key,
+            'start': period_start,
+            'duration': duration,
+            'duration_attribute': duration_attribute,
+            'base_url': mpd_level['base_url'],
+            'has_base_url': False,
+            'template': {},
+            'cached': cached is not None,
+            'representations': cached if cached is not None else []
+        }
+        return period, period_start
+
+    def _end_period(self, period, duration):
+        """Cut a period short where the next one starts; returns False if a reused period ended elsewhere"""
+        if period['cached']:
+            return period['duration'] == duration
+        period['duration'] = duration
+        period['key'] = period['key'][:2] + (duration,) + period['key'][3:]
+        for rep in period['representations']:
+            rep['period_duration'] = duration
+        return True
+
+    def _representation(self, rep, adapt_set, period):
+        attrib, adapt_attrib = rep['attrib'], adapt_set['attrib']
+        template = rep['template']
+        mime_type = attrib.get('mimeType') or adapt_attrib.get('mimeType')
+        return {
+            'id': attrib.get('id'),
+            'mime_type': mime_type,
+            'content_type': adapt_attrib.get('contentType') or (mime_type or '').split('/')[0] or None,
+            'codecs': attrib.get('codecs') or adapt_attrib.get('codecs'),
+            'bandwidth': int(attrib.get('bandwidth', 0)),
+            'width': int(attrib.get('width') or adapt_attrib.get('width') or 0) or None,
+            'height': int(attrib.get('height') or adapt_attrib.get('height') or 0) or None,
+            'frame_rate': _parse_frame_rate(attrib.get('frameRate') or adapt_attrib.get('frameRate')),
+            'initialization': template.get('initialization'),
+            'media': template.get('media'),
+            'base_url': rep['base_url'],
+            'start_number': int(template.get('startNumber', 1)),
+            'timescale': int(template.get('timescale', 1)),
+            'duration': int(template['duration']) if 'duration' in template else None,
+            'presentation_time_offset': int(template.get('presentationTimeOffset', 0)),
+            'timeline': template.get('timeline'),
+            'period_id': period['id'],
+            'period_start': period['start'],
+            'period_duration': period['duration']
+        }
@@ -0,0 +1,92 @@
+import os
+import json
+import logging
+
+CHECKPOINT_FILE = "progress.json"
+JOURNAL_FILE = "progress.journal"
+
+
+class ProgressJournal:
+    """Append-only log of committed fragments with periodic atomic checkpoints
+
+    Every commit appends one "index sequence size" line to progress.journal.
+    Every checkpoint_interval commits the full state is written to progress.json
+    through a temporary file and an atomic rename, after which the journal is
+    removed. Readers replay the journal on top of the last checkpoint.
+    """
+
+    def __init__(self, output_dir, checkpoint_interval=256):
+        self.checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+        self.journal_path = os.path.join(output_dir, JOURNAL_FILE)
+        self.checkpoint_interval = checkpoint_interval
+        self.logger = logging.getLogger("stream_downloader")
+        self._journal = None
+        self._pending = 0
+
+    def append(self, index, sequence, size):
+        """Record one committed fragment"""
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a')
+        self._journal.write(f"{index} {sequence} {size}\n")
+        # Flushed to the OS so a crashed process loses nothing
+        self._journal.flush()
+        self._pending += 1
+        return self._pending >= self.checkpoint_interval
+
+    def checkpoint(self, state):
+        """Atomically replace progress.json with the full state and compact the journal"""
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.checkpoint_path)
+
+        # Journal entries are idempotent, so a crash before this removal only
+        # means they are replayed on top of a checkpoint that already has them
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._pending = 0
+
+    def load(self):
+        """Rebuild the checkpoint state and the [sequence, size] record of every fragment index
+
+        Returns (state, records); state is None when there is no checkpoint yet.
+        """
+        state = None
+        records = []
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+            records = [list(record) for record in state.get('fragments') or []]
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    parts = line.split()
+                    # A crash can leave a torn last line behind
+                    if len(parts) != 3 or not line.endswith("\n"):
+                        continue
+                    index, sequence, size = (int(part) for part in parts)
+                    while len(records) <= index:
+                        records.append([None, 0])
+                    records[index] = [sequence, size]
+                    if state is None:
+                        state = {}
+
+        return state, records
+
+    def close(self):
+        """Close the journal file"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+def load_downloaded_sequences(output_dir):
+    """Return the set of sequence numbers a download directory has committed successfully"""
+    _, records = ProgressJournal(output_dir).load()
+    return {sequence for sequence, size in records if sequence is not None and size}
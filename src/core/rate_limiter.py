@@ -0,0 +1,70 @@
+import re
+import threading
+import time
+
+_RATE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*(?:/s)?\s*$', re.IGNORECASE)
+_RATE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting throughput to ``rate`` bytes per second
+
+    A rate of None or 0 means unlimited. Callers take tokens after reading a
+    chunk and sleep off any debt, so a chunk larger than the bucket still
+    passes and concurrent readers share the rate. The rate can be changed at
+    any time and applies from the next chunk on.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self._updated = time.monotonic()
+        self.rate = None
+        self.burst = 0
+        # An explicitly configured burst, kept when only the rate changes
+        self._burst = None
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Change the limit; burst defaults to the one configured before, else one second worth of tokens"""
+        with self._lock:
+            if burst:
+                self._burst = burst
+            self.rate = rate if rate and rate > 0 else None
+            self.burst = self._burst or self.rate or 0
+            self._tokens = min(self._tokens, self.burst)
+            self._updated = time.monotonic()
+
+    def consume(self, amount):
+        """Take amount tokens, sleeping until the bucket is out of debt; returns the seconds slept"""
+        with self._lock:
+            if not self.rate:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+# Every StreamDownloader in the process is charged to this bucket on top of its own
+global_rate_limiter = TokenBucket()
+
+
+def set_global_rate_limit(rate):
+    """Cap the combined rate of all StreamDownloader instances in this process (bytes per second, None for unlimited)"""
+    global_rate_limiter.set_rate(rate)
+
+
+def parse_rate(value):
+    """Convert a rate such as 500K, 2M or 1.5MiB/s to bytes per second; empty or 0 means unlimited"""
+    if value is None or str(value).strip() in ('', '0'):
+        return None
+    match = _RATE.match(str(value))
+    if not match:
+        raise ValueError(f"Invalid rate limit: {value}")
+    return int(float(match.group(1)) * _RATE_UNITS[match.group(2).lower()]) or None
@@ -0,0 +1,123 @@
+import time
+import queue
+import logging
+import tempfile
+import threading
+import subprocess
+
+# Containers that are only playable while growing when written as fragmented MP4
+_MP4_EXTENSIONS = ('.mp4', '.m4v', '.m4a', '.mov')
+
+
+class RemuxPipe:
+    """Feed committed fragments, in order, into one long-running FFmpeg remux (-c copy)
+
+    FFmpeg is started with the first fragment and writes output_file while the
+    recording runs. A writer thread copies queued fragments into FFmpeg's stdin.
+    When FFmpeg falls behind, the pipe and then the queue of max_pending
+    fragments fill up, and feed() blocks the commit loop until there is room
+    again. If FFmpeg dies, later fragments are dropped and close() reports the
+    failure; the fragments on disk can still be merged afterwards.
+    """
+
+    def __init__(self, output_file, ffmpeg_path="ffmpeg", max_pending=8, chunk_size=1024 * 1024):
+        self.output_file = output_file
+        self.ffmpeg_path = ffmpeg_path
+        self.chunk_size = chunk_size
+        self.logger = logging.getLogger("stream_downloader")
+        self.fragments = 0
+        # Seconds the commit loop spent waiting for FFmpeg
+        self.blocked_seconds = 0.0
+        self.failed = False
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._process = None
+        self._stderr = None
+        self._writer = None
+
+    def _command(self):
+        # Only audio and video, since timed metadata and subtitle streams don't fit every container
+        cmd = [self.ffmpeg_path, "-loglevel", "error", "-i", "pipe:0", "-map", "0:v?", "-map", "0:a?", "-c", "copy"]
+        if self.output_file.lower().endswith(_MP4_EXTENSIONS):
+            cmd.extend(["-movflags", "+frag_keyframe+empty_moov+default_base_moof"])
+        cmd.extend(["-y", self.output_file])
+        return cmd
+
+    def _start(self):
+        cmd = self._command()
+        self.logger.info(f"Starting live remux: {' '.join(cmd)}")
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._stderr)
+        self._writer = threading.Thread(target=self._write_loop, name="remux", daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self.failed:
+                continue
+            path, offset, size = item
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    remaining = size
+                    while remaining is None or remaining > 0:
+                        chunk = f.read(self.chunk_size if remaining is None else min(self.chunk_size, remaining))
+                        if not chunk:
+                            break
+                        self._process.stdin.write(chunk)
+                        if remaining is not None:
+                            remaining -= len(chunk)
+                self._process.stdin.flush()
+            except (OSError, ValueError) as e:
+                # Keep draining the queue so feed() never blocks on a dead FFmpeg
+                self.failed = True
+                self.logger.error(f"Live remux stopped: {str(e)}")
+
+    def feed(self, path, offset=0, size=None):
+        """Queue a committed fragment (or a byte range of a file) for FFmpeg; returns False once it failed"""
+        if self.failed:
+            return False
+        if self._process is None:
+            try:
+                self._start()
+            except OSError as e:
+                self.failed = True
+                self.logger.error(f"Could not start FFmpeg for the live remux: {str(e)}")
+                return False
+
+        try:
+            self._queue.put_nowait((path, offset, size))
+        except queue.Full:
+            started = time.monotonic()
+            self._queue.put((path, offset, size))
+            self.blocked_seconds += time.monotonic() - started
+        self.fragments += 1
+        return True
+
+    def close(self):
+        """Flush the queue, close FFmpeg's input and wait for it; returns whether the output is complete"""
+        if self._process is None:
+            return not self.failed
+
+        self._queue.put(None)
+        self._writer.join()
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        returncode = self._process.wait()
+
+        self._stderr.seek(0)
+        errors = self._stderr.read().decode('utf-8', 'replace').strip()
+        self._stderr.close()
+        self._process = None
+
+        if returncode != 0 or self.failed:
+            self.failed = True
+            self.logger.error(f"Live remux to {self.output_file} failed with exit code {returncode}: {errors}")
+            return False
+        self.logger.info(f"Remuxed {self.fragments} fragments into {self.output_file} "
+                         f"({self.blocked_seconds:.1f}s waiting for FFmpeg)")
+        return True
@@ -0,0 +1,157 @@
+import random
+import socket
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from urllib3.exceptions import ProtocolError
+from urllib3.exceptions import TimeoutError as Urllib3Timeout
+
+from src.core.fragment_validation import FragmentIntegrityError
+
+
+class RetryPolicy:
+    """Decide whether and when a failed request is retried
+
+    Delays grow exponentially from base_delay up to max_delay, with up to
+    ``jitter`` of each delay randomly taken off so concurrent workers don't
+    retry in lockstep. A Retry-After header (capped at max_retry_after)
+    replaces the computed delay, and HTTP statuses in permanent_statuses
+    fail immediately.
+    """
+
+    def __init__(self, name='fragment', max_attempts=10, base_delay=2, max_delay=30, multiplier=2, jitter=0.5,
+                 max_retry_after=120, permanent_statuses=(400, 401, 403, 404, 405, 410)):
+        self.name = name
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+        self.permanent_statuses = set(permanent_statuses)
+
+    def is_permanent(self, error):
+        """Check whether an error is an HTTP status that retrying cannot fix"""
+        return _status_code(error) in self.permanent_statuses
+
+    def should_retry(self, error, attempt):
+        """Check whether another attempt is allowed after the given (1-based) failed attempt"""
+        return attempt < self.max_attempts and not self.is_permanent(error)
+
+    def retry_after(self, error):
+        """Return the server's Retry-After delay in seconds, or None"""
+        response = getattr(error, 'response', None)
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+
+        value = value.strip()
+        if value.isdigit():
+            delay = int(value)
+        else:
+            try:
+                delay = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(0, delay), self.max_retry_after)
+
+    def backoff(self, error, attempt):
+        """Return the number of seconds to wait before the next attempt"""
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            return retry_after
+
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+
+class RetryStats:
+    """Thread-safe retry counters of one download job"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {
+            'manifest_retries': 0,
+            'fragment_retries': 0,
+            'retry_after_waits': 0,
+            'backoff_seconds': 0.0,
+            'failures': 0,
+            'permanent_failures': 0,
+            'timeouts': 0,
+            'congestion_errors': 0,
+            'integrity_errors': 0,
+            'repaired_fragments': 0
+        }
+        self._statuses = {}
+
+    def record_retry(self, policy, error, delay, honored_retry_after):
+        """Count a retry scheduled by the given policy"""
+        key = f"{policy.name}_retries"
+        status = _status_code(error)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            self._counters['backoff_seconds'] += delay
+            if honored_retry_after:
+                self._counters['retry_after_waits'] += 1
+            self._count_error(error, status)
+
+    def record_failure(self, error, permanent):
+        """Count a request that was given up on"""
+        status = _status_code(error)
+        with self._lock:
+            self._counters['permanent_failures' if permanent else 'failures'] += 1
+            self._count_error(error, status)
+
+    def _count_error(self, error, status):
+        # Called with the lock held
+        if status is not None:
+            self._statuses[status] = self._statuses.get(status, 0) + 1
+        timeout = _is_timeout(error)
+        if timeout:
+            self._counters['timeouts'] += 1
+        if isinstance(error, FragmentIntegrityError):
+            self._counters['integrity_errors'] += 1
+        # Errors that mean the server or the network is overloaded
+        if timeout or status == 429 or (status is not None and status >= 500):
+            self._counters['congestion_errors'] += 1
+
+    def record_repair(self):
+        """Count a fragment that passed validation after an invalid download"""
+        with self._lock:
+            self._counters['repaired_fragments'] += 1
+
+    def repaired_fragments(self):
+        """Return how many fragments were re-fetched after failing validation"""
+        with self._lock:
+            return self._counters['repaired_fragments']
+
+    def congestion_errors(self):
+        """Return how many requests were throttled (HTTP 429/5xx) or timed out so far"""
+        with self._lock:
+            return self._counters['congestion_errors']
+
+    def snapshot(self):
+        """Return the counters and the number of errors per HTTP status"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['statuses'] = dict(self._statuses)
+        return stats
+
+
+def _is_timeout(error):
+    """Return whether error is a timeout, including one raised by urllib3 while reading a streamed body"""
+    if isinstance(error, (requests.Timeout, Urllib3Timeout, socket.timeout)):
+        return True
+    # A stalled body can also surface as a broken connection that wraps the timeout
+    if isinstance(error, (ProtocolError, requests.ConnectionError)):
+        return any(isinstance(arg, BaseException) and _is_timeout(arg) for arg in error.args)
+    return False
+
+
+def _status_code(error):
+    """Return the HTTP status of a requests error, or None for network errors"""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code
+    return None
@@ -0,0 +1,152 @@
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+def _counting_pool_class(base, pool):
+    """Create a urllib3 connection pool class that reports connection reuse to ``pool``"""
+    class CountingConnectionPool(base):
+        def _get_conn(self, timeout=None):
+            conn = super()._get_conn(timeout)
+            # A connection without a socket will open a fresh TCP (and TLS) connection
+            pool._record_connection(reused=getattr(conn, 'sock', None) is not None)
+            return conn
+
+    return CountingConnectionPool
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools count new vs. reused connections"""
+
+    def __init__(self, pool, **kwargs):
+        self._session_pool = pool
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool_class(HTTPConnectionPool, self._session_pool),
+            'https': _counting_pool_class(HTTPSConnectionPool, self._session_pool),
+        }
+
+
+class SessionPool:
+    """Long-lived keep-alive HTTP sessions, one per host, with idle eviction
+
+    A host's session is shared by every job that talks to it, so sessions keep
+    no cookies of their own: each request carries its job's cookies, and
+    Set-Cookie responses only last for that request's redirects.
+    """
+
+    def __init__(self, pool_size=10, keep_alive=True, idle_timeout=60, headers=None):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.headers = dict(headers or {})
+        self.logger = logging.getLogger("stream_downloader")
+
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._counters = {
+            'requests': 0,
+            'new_connections': 0,
+            'reused_connections': 0,
+            'evicted_sessions': 0
+        }
+
+    def _create_session(self):
+        session = requests.Session()
+        # A jar that never stores or sends anything, so one job's cookies can't leak into another's requests
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        session.headers.update(self.headers)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+
+        adapter = _CountingAdapter(self, pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _record_connection(self, reused):
+        with self._lock:
+            self._counters['requests'] += 1
+            self._counters['reused_connections' if reused else 'new_connections'] += 1
+
+    def _acquire(self, url):
+        parsed = urlparse(url)
+        host = (parsed.scheme, parsed.netloc)
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._hosts.get(host)
+            if entry is None:
+                entry = self._hosts[host] = {'session': self._create_session(), 'active': 0, 'last_used': now}
+            entry['active'] += 1
+            entry['last_used'] = now
+            return host, entry
+
+    def _release(self, entry):
+        now = time.monotonic()
+        with self._lock:
+            entry['active'] -= 1
+            entry['last_used'] = now
+            # Also evict here, so sessions for hosts that are no longer fetched from close while others stay busy
+            self._evict_idle(now)
+
+    def _evict_idle(self, now):
+        # Called with the lock held
+        if not self.idle_timeout:
+            return
+
+        for host, entry in list(self._hosts.items()):
+            if entry['active'] == 0 and now - entry['last_used'] > self.idle_timeout:
+                entry['session'].close()
+                del self._hosts[host]
+                self._counters['evicted_sessions'] += 1
+                self.logger.debug(f"Evicted idle HTTP session for {host[1]}")
+
+    def evict_idle(self):
+        """Close sessions that have not been used for longer than idle_timeout"""
+        with self._lock:
+            self._evict_idle(time.monotonic())
+
+    @contextmanager
+    def request(self, url, **kwargs):
+        """Open a GET request on the pooled session for the URL's host"""
+        host, entry = self._acquire(url)
+        try:
+            response = entry['session'].get(url, **kwargs)
+            try:
+                yield response
+            finally:
+                response.close()
+        finally:
+            self._release(entry)
+
+    def get(self, url, **kwargs):
+        """Fetch a URL and return the response with its body already read"""
+        with self.request(url, **kwargs) as response:
+            response.content
+            return response
+
+    def stats(self):
+        """Return connection reuse counters"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['open_sessions'] = len(self._hosts)
+        return stats
+
+    def close(self):
+        """Close every pooled session"""
+        with self._lock:
+            for entry in self._hosts.values():
+                entry['session'].close()
+            self._hosts.clear()
@@ -1,124 +1,1096 @@
 import os
-import json
 import time
 import requests
 import logging
 import re
-import xml.etree.ElementTree as ET
-from urllib.parse import parse_qs, urlparse
+import math
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from urllib.parse import parse_qs, urljoin, urlparse
+from urllib3.exceptions import HTTPError as Urllib3Error
+
+from src.core.append_writer import AppendWriter, fragment_file_path
+from src.core.decryption import AES128Decryptor
+from src.core.concurrency_controller import AIMDController
+from src.core.fragment_validation import FragmentIntegrityError, FragmentValidator
+from src.core.hedging import DownloadCancelled, HedgeTracker
+from src.core.mpd_parser import DashManifestParser
+from src.core.m3u8_parser import MediaPlaylistParser, _parse_attribute_list, _resolve_uri
+from src.core.progress_journal import ProgressJournal
+from src.core.rate_limiter import TokenBucket, global_rate_limiter
+from src.core.remux_pipe import RemuxPipe
+from src.core.retry_policy import RetryPolicy, RetryStats
+from src.core.session_pool import SessionPool
+from src.core.stream_merger import IncrementalMerger
+
+
+_TEMPLATE_IDENTIFIER = re.compile(r'\$(RepresentationID|Number|Time|Bandwidth)(?:%0(\d+)d)?\$|\$\$')
+_AUDIO_CODECS = ('mp4a', 'ac-3', 'ec-3', 'opus', 'flac')
+# DASH sequence numbers carry the period start (in ms) above this bit, since $Number$ and $Time$ restart per period
+_PERIOD_SEQUENCE_SHIFT = 48
+
+
+def expand_segment_template(template, representation_id=None, number=None, time=None, bandwidth=None):
+    """Substitute $RepresentationID$, $Number$, $Time$ and $Bandwidth$ in a DASH SegmentTemplate"""
+    values = {
+        'RepresentationID': representation_id,
+        'Number': number,
+        'Time': time,
+        'Bandwidth': bandwidth
+    }
+    
+    def replace(match):
+        if match.group(0) == '$$':
+            return '$'
+        value = values[match.group(1)]
+        if value is None:
+            return match.group(0)
+        if match.group(2):
+            return str(value).zfill(int(match.group(2)))
+        return str(value)
+    
+    return _TEMPLATE_IDENTIFIER.sub(replace, template)
+
+
+def _playlist_base_url(playlist_url):
+    """Return the directory URL that a playlist's relative URIs are resolved against"""
+    return urljoin(playlist_url, '.')
+
+
+def _add_query_parameter(url, name, value):
+    """Append a query parameter to a URL, keeping the existing query (such as access tokens)"""
+    parsed = urlparse(url)
+    parameter = f"{name}={value}"
+    return parsed._replace(query=f"{parsed.query}&{parameter}" if parsed.query else parameter).geturl()
+
+
+class FragmentJob:
+    """Settings and running state of one download job in the fragment engine"""
+    
+    def __init__(self, output_dir, cookies=None, concurrency=None, extension='ts', label='Fragment',
+                 progress_callback=None, resume=False, rate_limiter=None, single_file=False):
+        self.output_dir = output_dir
+        self.cookies = cookies
+        self.concurrency = concurrency
+        self.extension = extension
+        self.label = label
+        self.progress_callback = progress_callback
+        self.resume = resume
+        # Optional TokenBucket capping this job on top of the downloader-wide limit
+        self.rate_limiter = rate_limiter
+        self.logger = logging.getLogger("stream_downloader")
+        self.journal = ProgressJournal(output_dir)
+        # Index of the next fragment file; keeps growing across live manifest reloads
+        self.next_index = 0
+        # [sequence, size] of every fragment file, by index; size 0 marks a failed fragment
+        self.records = []
+        # File index of every sequence number seen so far, and the ones complete on disk
+        self.indices = {}
+        self.completed = set()
+        self.last_fragment = None
+        self.retry_stats = RetryStats()
+        # Adaptive in-flight limit, kept across live manifest reloads; None when concurrency is fixed
+        self.controller = None
+        # Latency samples and budget for hedged fragment requests; None when hedging is off
+        self.hedger = None
+        # Append committed fragments to one stream file instead of one file per fragment
+        self.single_file = single_file
+        self.writer = None
+        # Optional RemuxPipe that committed fragments are streamed into
+        self.remux = None
+        # When progress.json was last written; live recordings only rewrite it every so often
+        self.last_checkpoint = time.monotonic()
+        # Optional IncrementalMerger that concatenates committed fragments in the background
+        self.merger = None
+        self._progress_loaded = False
+    
+    def fragment_path(self, index):
+        """Return the file path of the fragment committed at the given index"""
+        return fragment_file_path(self.output_dir, index, self.extension)
+    
+    def append_writer(self):
+        """Return the single-file mode writer, creating it on first use"""
+        if self.writer is None:
+            self.writer = AppendWriter(self.output_dir, self.extension)
+            if not self.resume:
+                self.writer.reset()
+        return self.writer
+    
+    def report(self, event):
+        """Pass a progress event to the job's callback, if any"""
+        if self.progress_callback:
+            event['label'] = self.label
+            self.progress_callback(event)
+    
+    def load_progress(self):
+        """Pick up an interrupted job from its progress journal, keeping fragments that are complete on disk"""
+        self._progress_loaded = True
+        state, records = self.journal.load()
+        if state is None:
+            # A crash can land between the first append to the stream and its journal entry
+            return self._load_single_file_progress([]) if self.single_file else 0
+        
+        if not records and 'fragments' not in state:
+            # Older progress files only know how many fragments were committed and the last sequence
+            count = state.get('fragments_downloaded', 0)
+            last = state.get('last_fragment')
+            records = [[last - (count - 1 - i) if last is not None else None, None] for i in range(count)]
+        
+        if self.single_file:
+            return self._load_single_file_progress(records)
+        
+        self.records = []
+        for index, (sequence, size) in enumerate(records):
+            path = self.fragment_path(index)
+            actual_size = os.path.getsize(path) if os.path.exists(path) else 0
+            # A fragment is only complete if its file has exactly the size that was committed
+            if sequence is not None and actual_size and (size is None or actual_size == size):
+                self.completed.add(sequence)
+            else:
+                actual_size = 0
+            if sequence is not None:
+                self.indices[sequence] = index
+            self.records.append([sequence, actual_size])
+        
+        self.next_index = len(self.records)
+        return len(self.completed)
+    
+    def _load_single_file_progress(self, records):
+        """Resume single-file mode from the stream's offset index
+        
+        Fragments that failed before the last one appended stay missing, since
+        an append-only file has no slot to put them back into.
+        """
+        appended = {sequence: size for sequence, _, size in self.append_writer().load()}
+        last_appended = max((index for index, (sequence, _) in enumerate(records) if sequence in appended),
+                            default=-1)
+        
+        self.records = []
+        gaps = 0
+        for index, (sequence, _) in enumerate(records):
+            size = appended.get(sequence, 0)
+            if sequence is not None:
+                self.indices[sequence] = index
+                if size or index < last_appended:
+                    self.completed.add(sequence)
+                    gaps += not size
+            self.records.append([sequence, size])
+        # A fragment appended just before a crash may not have reached the journal
+        for sequence, size in appended.items():
+            if sequence not in self.indices:
+                self.indices[sequence] = len(self.records)
+                self.records.append([sequence, size])
+                self.completed.add(sequence)
+        
+        if gaps:
+            self.logger.warning(f"{gaps} fragments that failed earlier are left out of {self.writer.path}")
+        self.next_index = len(self.records)
+        return len(appended)
+    
+    def assign_indices(self, fragments):
+        """Pair fragments that still need downloading with their file index
+        
+        When resuming, fragments already complete on disk are skipped and missing
+        ones go back into the slot they had before.
+        """
+        if self.resume and not self._progress_loaded:
+            completed = self.load_progress()
+            if completed:
+                self.logger.info(f"Resuming download: {completed} fragments already complete")
+        
+        indexed = []
+        for fragment in fragments:
+            sequence = fragment['sequence']
+            if sequence in self.completed:
+                continue
+            index = self.indices.get(sequence)
+            if index is None:
+                index = self.indices[sequence] = self.next_index
+                self.next_index += 1
+            indexed.append((index, fragment))
+        return indexed
+    
+    def record(self, index, fragment, size):
+        """Record a committed fragment in the progress journal"""
+        while len(self.records) <= index:
+            self.records.append([None, 0])
+        self.records[index] = [fragment['sequence'], size]
+        if size:
+            self.completed.add(fragment['sequence'])
+        self.last_fragment = fragment
+        
+        if self.journal.append(index, fragment['sequence'], size):
+            self.checkpoint()
+    
+    def checkpoint(self):
+        """Write the full progress state to progress.json and compact the journal"""
+        state = {
+            'fragments_total': len(self.records),
+            'fragments_downloaded': sum(1 for _, size in self.records if size),
+            'last_fragment': self.last_fragment['sequence'] if self.last_fragment else None,
+            'last_url': self.last_fragment['url'] if self.last_fragment else None,
+            'fragments': self.records,
+            'retries': self.retry_stats.snapshot(),
+            'hedging': self.hedger.snapshot() if self.hedger else None
+        }
+        self.journal.checkpoint(state)
+        self.last_checkpoint = time.monotonic()
+
 
 class StreamDownloader:
     """Handles the downloading of stream fragments"""
     
-    def __init__(self, user_agent=None, max_retries=10, retry_delay=2):
+    def __init__(self, user_agent=None, max_retries=10, retry_delay=2, concurrency=4,
+                 pool_size=10, keep_alive=True, idle_timeout=60, chunk_size=64 * 1024,
+                 live_idle_timeout=60, max_coalesce_bytes=8 * 1024 * 1024,
+                 manifest_retry_policy=None, fragment_retry_policy=None, rate_limiter=None,
+                 adaptive_concurrency=True, max_concurrency=16, validate_fragments=True,
+                 hedge_percentile=95, hedge_budget=0.05, hedge_min_samples=20, request_timeout=15):
         self.user_agent = user_agent or "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        # Manifest and fragment fetches have separate retry budgets
+        self.manifest_retry_policy = manifest_retry_policy or RetryPolicy(
+            'manifest', max_attempts=max_retries, base_delay=retry_delay)
+        self.fragment_retry_policy = fragment_retry_policy or RetryPolicy(
+            'fragment', max_attempts=max_retries, base_delay=retry_delay)
+        self.concurrency = concurrency
+        # Seconds to wait for a connection, and for each read of a response once it started
+        self.request_timeout = request_timeout
+        # Jobs without an explicit concurrency start at concurrency and adapt between 1 and max_concurrency
+        self.adaptive_concurrency = adaptive_concurrency
+        self.max_concurrency = max(concurrency, max_concurrency)
+        # Bandwidth cap shared by every fragment worker of this downloader; reads are also charged
+        # to the process-wide global_rate_limiter
+        self.rate_limiter = rate_limiter or TokenBucket()
+        # Peak memory per in-flight fragment is one chunk_size buffer per worker thread
+        self.chunk_size = chunk_size
+        self._local = threading.local()
+        # A fragment at the head of the commit queue that runs longer than this percentile of
+        # recent latencies gets a duplicate request, for at most hedge_budget of all requests
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedge_min_samples = hedge_min_samples
+        # Check Content-Length and TS/fMP4 structure while writing, re-fetching invalid fragments
+        self.validate_fragments = validate_fragments
+        # Adjacent EXT-X-BYTERANGE fragments are fetched together in Range requests up to this size
+        self.max_coalesce_bytes = max_coalesce_bytes
+        # Decryption keys by URI, shared by all fragments and jobs; the least recently used go
+        # first, since long live streams rotate keys
+        self.key_cache_size = 16
+        self._key_cache = OrderedDict()
+        # Guards the cache; each URI being fetched has its own lock so one slow key server blocks nobody else
+        self._key_lock = threading.Lock()
+        self._key_fetch_locks = {}
+        # Live HLS recordings stop after this many seconds without a new fragment
+        self.live_idle_timeout = live_idle_timeout
+        self.live_default_target_duration = 6
+        # Live recordings rewrite progress.json at most this often and rely on the journal in between
+        self.live_checkpoint_interval = 30
         self.headers = {"User-Agent": self.user_agent}
         self.logger = logging.getLogger("stream_downloader")
+        # Shared by manifest and fragment fetches so connections are reused across requests
+        self.sessions = SessionPool(
+            pool_size=max(pool_size, self.max_concurrency if adaptive_concurrency else concurrency),
+            keep_alive=keep_alive,
+            idle_timeout=idle_timeout,
+            headers=self.headers
+        )
+    
+    def connection_stats(self):
+        """Return counters for new vs. reused HTTP connections"""
+        return self.sessions.stats()
+    
+    def close(self):
+        """Close all pooled HTTP connections"""
+        self.sessions.close()
     
-    def download_data(self, url, cookies=None):
-        """Download data from a URL with retries"""
-        for attempt in range(self.max_retries):
+    def set_rate_limit(self, rate):
+        """Change the bandwidth cap of this downloader in bytes per second (None for unlimited)"""
+        self.rate_limiter.set_rate(rate)
+    
+    def _rate_limiters(self, job):
+        """Return the token buckets a job's fragment reads are charged to"""
+        limiters = []
+        for limiter in (job.rate_limiter, self.rate_limiter, global_rate_limiter):
+            if limiter and limiter not in limiters:
+                limiters.append(limiter)
+        return tuple(limiters)
+    
+    def _with_retries(self, url, fetch, policy=None, retry_stats=None, cancel=None):
+        """Call fetch() until it succeeds, the retry policy gives up or cancel is set"""
+        policy = policy or self.fragment_retry_policy
+        attempt = 0
+        invalid = False
+        while True:
             try:
-                session = requests.Session()
-                response = session.get(url, headers=self.headers, cookies=cookies, timeout=15)
-                response.raise_for_status()
-                return response.content
-            except (requests.RequestException, ConnectionError) as e:
-                self.logger.warning(f"Download attempt {attempt+1}/{self.max_retries} failed: {str(e)}")
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                else:
-                    self.logger.error(f"Failed to download {url} after {self.max_retries} attempts")
+                result = fetch()
+                if invalid and retry_stats:
+                    retry_stats.record_repair()
+                return result
+            except (requests.RequestException, Urllib3Error, ConnectionError, FragmentIntegrityError) as e:
+                attempt += 1
+                # A later valid download counts as a repaired fragment
+                if isinstance(e, FragmentIntegrityError):
+                    invalid = True
+                if not policy.should_retry(e, attempt):
+                    permanent = policy.is_permanent(e)
+                    if retry_stats:
+                        retry_stats.record_failure(e, permanent)
+                    if permanent:
+                        self.logger.error(f"Failed to download {url}: {str(e)} (not retrying)")
+                    else:
+                        self.logger.error(f"Failed to download {url} after {attempt} attempts")
                     raise
+                
+                retry_after = policy.retry_after(e)
+                delay = policy.backoff(e, attempt)
+                if retry_stats:
+                    retry_stats.record_retry(policy, e, delay, retry_after is not None)
+                self.logger.warning(f"Download attempt {attempt}/{policy.max_attempts} failed: {str(e)}, "
+                                    f"retrying in {delay:.1f}s")
+                if cancel is None:
+                    time.sleep(delay)
+                elif cancel.wait(delay):
+                    raise DownloadCancelled(f"Download of {url} was cancelled")
     
-    def download_fragment(self, url, output_path, cookies=None):
-        """Download a single stream fragment to a file"""
-        try:
-            data = self.download_data(url, cookies)
+    def download_data(self, url, cookies=None, retry_stats=None):
+        """Download a manifest or key with retries"""
+        def fetch():
+            response = self.sessions.get(url, cookies=cookies, timeout=self.request_timeout)
+            response.raise_for_status()
+            return response.content
+        
+        return self._with_retries(url, fetch, self.manifest_retry_policy, retry_stats)
+    
+    def download_manifest(self, url, cookies=None, validators=None, retry_stats=None):
+        """Download a manifest that is polled repeatedly, revalidating it with the server
+        
+        validators is a dict holding the 'etag' and 'last_modified' of the previous
+        response, updated in place. Returns None if the server answers 304 Not Modified.
+        """
+        def fetch():
+            headers = {}
+            if validators and validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators and validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
             
-            # Create directory if it doesn't exist
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            response = self.sessions.get(url, cookies=cookies, timeout=self.request_timeout, headers=headers)
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+            if validators is not None:
+                validators['etag'] = response.headers.get('ETag')
+                validators['last_modified'] = response.headers.get('Last-Modified')
+            return response.content
+        
+        return self._with_retries(url, fetch, self.manifest_retry_policy, retry_stats)
+    
+    def _chunk_buffer(self):
+        """Return this thread's reusable read buffer"""
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or len(buffer) != self.chunk_size:
+            buffer = self._local.buffer = bytearray(self.chunk_size)
+        return buffer
+    
+    def get_decryption_key(self, key_url, cookies=None):
+        """Fetch an encryption key, downloading each key URI only once while it stays cached"""
+        with self._key_lock:
+            if key_url in self._key_cache:
+                self._key_cache.move_to_end(key_url)
+                return self._key_cache[key_url]
+            fetch_lock = self._key_fetch_locks.setdefault(key_url, threading.Lock())
+        
+        with fetch_lock:
+            with self._key_lock:
+                if key_url in self._key_cache:
+                    # Fetched by another worker while this one waited
+                    return self._key_cache[key_url]
+            try:
+                key = self.download_data(key_url, cookies)
+            finally:
+                with self._key_lock:
+                    self._key_fetch_locks.pop(key_url, None)
+            with self._key_lock:
+                self._key_cache[key_url] = key
+                while len(self._key_cache) > self.key_cache_size:
+                    self._key_cache.popitem(last=False)
+            return key
+    
+    def stream_to_files(self, url, parts, cookies=None, decryptor=None, byterange=None, rate_limiters=(),
+                        cancel=None):
+        """Stream a response body into one or more files, splitting it at the given part lengths
+        
+        parts is a list of (output_path, length) pairs; a length of None takes the rest
+        of the body. byterange (offset, length) restricts the request with a Range header.
+        Every chunk read is charged to the given rate limiters. With validate_fragments,
+        an incomplete or malformed body raises FragmentIntegrityError. Setting the
+        cancel event stops the transfer with DownloadCancelled.
+        """
+        if cancel is not None and cancel.is_set():
+            raise DownloadCancelled(f"Download of {url} was cancelled")
+        start = time.monotonic()
+        buffer = self._chunk_buffer()
+        view = memoryview(buffer)
+        results = []
+        
+        headers = {}
+        if byterange:
+            offset, length = byterange
+            headers['Range'] = f"bytes={offset}-{offset + length - 1}"
+        
+        with self.sessions.request(url, cookies=cookies, timeout=self.request_timeout, stream=True, headers=headers) as response:
+            response.raise_for_status()
+            first_byte = time.monotonic() - start
+            response.raw.decode_content = True
+            if cancel is not None and cancel.is_set():
+                raise DownloadCancelled(f"Download of {url} was cancelled")
+            
+            # A server that ignores Range sends the whole resource from the start
+            skip = byterange[0] if byterange and response.status_code != 206 else 0
+            while skip:
+                n = response.raw.readinto(view[:min(skip, len(buffer))])
+                if not n:
+                    raise requests.ConnectionError(f"Response from {url} ended before the requested byte range")
+                for limiter in rate_limiters:
+                    limiter.consume(n)
+                skip -= n
             
-            with open(output_path, 'wb') as f:
-                f.write(data)
+            body_read = 0
+            for output_path, remaining in parts:
+                bytes_written = 0
+                validator = FragmentValidator(url) if self.validate_fragments else None
+                with open(output_path, 'wb') as f:
+                    while remaining is None or remaining > 0:
+                        n = response.raw.readinto(view[:len(buffer) if remaining is None else min(remaining, len(buffer))])
+                        if not n:
+                            if remaining:
+                                raise requests.ConnectionError(f"Response from {url} ended {remaining} bytes early")
+                            break
+                        if cancel is not None and cancel.is_set():
+                            raise DownloadCancelled(f"Download of {url} was cancelled")
+                        for limiter in rate_limiters:
+                            limiter.consume(n)
+                        body_read += n
+                        chunk = decryptor.update(view[:n]) if decryptor else view[:n]
+                        if validator:
+                            validator.update(chunk)
+                        f.write(chunk)
+                        bytes_written += len(chunk)
+                        if remaining is not None:
+                            remaining -= n
+                    
+                    if decryptor:
+                        chunk = decryptor.finalize()
+                        if validator:
+                            validator.update(chunk)
+                        f.write(chunk)
+                        bytes_written += len(chunk)
                 
-            return len(data)
-        except Exception as e:
-            self.logger.error(f"Failed to download fragment {url}: {str(e)}")
-            return 0
+                if validator:
+                    validator.finalize()
+                
+                results.append({
+                    'bytes': bytes_written,
+                    'time_to_first_byte': first_byte,
+                    'elapsed': time.monotonic() - start
+                })
+            
+            # A body read to its end must match Content-Length (unknown once decompressed)
+            content_length = response.headers.get('Content-Length')
+            if self.validate_fragments and parts[-1][1] is None and content_length \
+                    and not response.headers.get('Content-Encoding'):
+                expected = int(content_length) - (byterange[0] if byterange and response.status_code != 206 else 0)
+                if body_read != expected:
+                    raise FragmentIntegrityError(f"Got {body_read} of {expected} bytes from {url}")
+        
+        return results
     
-    def parse_dash_manifest(self, manifest_data):
-        """Parse a DASH manifest to get fragment URLs"""
+    def stream_to_file(self, url, output_path, cookies=None, decryptor=None, byterange=None, rate_limiters=(),
+                       cancel=None):
+        """Write a response body to a file chunk by chunk as it arrives, decrypting it on the way if needed"""
+        length = byterange[1] if byterange else None
+        return self.stream_to_files(url, [(output_path, length)], cookies, decryptor, byterange, rate_limiters,
+                                    cancel)[0]
+    
+    def download_fragment(self, url, output_path, cookies=None, key=None, byterange=None, retry_stats=None,
+                          rate_limiters=(), cancel=None):
+        """Download a single stream fragment to a file, reporting bytes written and timing"""
+        start = time.monotonic()
         try:
-            root = ET.fromstring(manifest_data)
-            namespace = {'ns': 'urn:mpeg:dash:schema:mpd:2011'}
+            # Create directory if it doesn't exist
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            
+            if key and key['method'] != 'AES-128':
+                raise ValueError(f"Unsupported encryption method: {key['method']}")
             
-            representations = []
+            # The key fetch has its own retries, so it stays out of the fragment's retry loop
+            key_data = self.get_decryption_key(key['uri'], cookies) if key else None
             
-            for period in root.findall('.//ns:Period', namespace):
-                for adapt_set in period.findall('.//ns:AdaptationSet', namespace):
-                    for rep in adapt_set.findall('.//ns:Representation', namespace):
-                        rep_id = rep.get('id')
-                        mime_type = adapt_set.get('mimeType')
-                        
-                        # Check for either initialization or segment templates
-                        init_template = None
-                        segment_template = None
-                        
-                        for template in rep.findall('.//ns:SegmentTemplate', namespace):
-                            if 'initialization' in template.attrib:
-                                init_template = template.get('initialization')
-                            if 'media' in template.attrib:
-                                segment_template = template.get('media')
-                                
-                        base_url = None
-                        for url in rep.findall('.//ns:BaseURL', namespace):
-                            base_url = url.text
-                        
-                        representations.append({
-                            'id': rep_id,
-                            'mime_type': mime_type,
-                            'initialization': init_template,
-                            'media': segment_template,
-                            'base_url': base_url
-                        })
+            def fetch():
+                # CBC state can't be rewound, so every attempt starts a fresh decryptor
+                decryptor = AES128Decryptor(key_data, key['iv']) if key else None
+                return self.stream_to_file(url, output_path, cookies, decryptor, byterange, rate_limiters, cancel)
             
-            return representations
+            return self._with_retries(url, fetch, self.fragment_retry_policy, retry_stats, cancel)
+        except Exception as e:
+            if not isinstance(e, DownloadCancelled):
+                self.logger.error(f"Failed to download fragment {url}: {str(e)}")
+            # Don't leave a truncated fragment behind
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            return {'bytes': 0, 'time_to_first_byte': None, 'elapsed': time.monotonic() - start, 'error': str(e)}
+    
+    def download_byte_ranges(self, url, parts, cookies=None, retry_stats=None, rate_limiters=(), cancel=None):
+        """Fetch adjacent byte ranges of one resource with a single Range request
+        
+        parts is a list of (output_path, (offset, length)) pairs in offset order.
+        """
+        start = time.monotonic()
+        offset = parts[0][1][0]
+        length = sum(byterange[1] for _, byterange in parts)
+        try:
+            return self._with_retries(url, lambda: self.stream_to_files(
+                url, [(path, byterange[1]) for path, byterange in parts], cookies, byterange=(offset, length),
+                rate_limiters=rate_limiters, cancel=cancel),
+                self.fragment_retry_policy, retry_stats, cancel)
+        except Exception as e:
+            if not isinstance(e, DownloadCancelled):
+                self.logger.error(f"Failed to download byte range {offset}-{offset + length - 1} of {url}: {str(e)}")
+            for path, _ in parts:
+                if os.path.exists(path):
+                    os.remove(path)
+            return [
+                {'bytes': 0, 'time_to_first_byte': None, 'elapsed': time.monotonic() - start, 'error': str(e)}
+                for _ in parts
+            ]
+    
+    def _can_coalesce(self, previous, fragment):
+        """Check whether a fragment's byte range directly follows the previous fragment's in the same resource"""
+        if not previous.get('byterange') or not fragment.get('byterange'):
+            return False
+        if previous.get('key') or fragment.get('key') or previous['url'] != fragment['url']:
+            return False
+        offset, length = previous['byterange']
+        return offset + length == fragment['byterange'][0]
+    
+    def plan_requests(self, indexed_fragments):
+        """Group (index, fragment) pairs into download tasks, coalescing adjacent byte ranges up to max_coalesce_bytes"""
+        tasks = []
+        task_bytes = 0
+        for i, fragment in indexed_fragments:
+            if tasks and self._can_coalesce(tasks[-1][-1][1], fragment) \
+                    and task_bytes + fragment['byterange'][1] <= self.max_coalesce_bytes:
+                tasks[-1].append((i, fragment))
+                task_bytes += fragment['byterange'][1]
+            else:
+                tasks.append([(i, fragment)])
+                task_bytes = fragment['byterange'][1] if fragment.get('byterange') else 0
+        return tasks
+    
+    def _download_task(self, task, job, cancel=None, suffix='.part'):
+        """Download one planned task into fragment paths ending in suffix, returning a result per fragment"""
+        if len(task) == 1:
+            i, fragment = task[0]
+            results = [self.download_fragment(fragment['url'], job.fragment_path(i) + suffix, job.cookies,
+                                              fragment.get('key'), fragment.get('byterange'), job.retry_stats,
+                                              self._rate_limiters(job), cancel)]
+        else:
+            parts = [(job.fragment_path(i) + suffix, fragment['byterange']) for i, fragment in task]
+            results = self.download_byte_ranges(task[0][1]['url'], parts, job.cookies, job.retry_stats,
+                                                self._rate_limiters(job), cancel)
+        
+        for (i, _), result in zip(task, results):
+            result['part_path'] = job.fragment_path(i) + suffix
+        return results
+    
+    def _job_controller(self, job):
+        """Return the job's adaptive concurrency controller, or None if its concurrency is fixed"""
+        if job.concurrency or not self.adaptive_concurrency:
+            return None
+        if job.controller is None:
+            job.controller = AIMDController(self.concurrency, maximum=self.max_concurrency)
+        return job.controller
+    
+    def _job_hedger(self, job):
+        """Return the job's hedging tracker, or None if hedging is off"""
+        if not self.hedge_percentile or not self.hedge_budget:
+            return None
+        if job.hedger is None:
+            job.hedger = HedgeTracker(self.hedge_percentile, self.hedge_budget, self.hedge_min_samples)
+        return job.hedger
+    
+    def _await_task(self, entry, job, hedge_executor, losers):
+        """Wait for a task, racing a duplicate request against it once it runs past the job's hedging threshold
+        
+        The future of the losing request is added to losers.
+        """
+        task, future, cancel, submitted = entry
+        threshold = job.hedger.threshold() if job.hedger else None
+        if threshold is None:
+            return future.result()
+        
+        try:
+            return future.result(timeout=max(0, submitted + threshold - time.monotonic()))
+        except FutureTimeout:
+            if not job.hedger.try_acquire():
+                return future.result()
+        
+        self.logger.info(f"Hedging {job.label.lower()} {task[0][0]+1} after {threshold:.2f}s")
+        hedge_cancel = threading.Event()
+        hedge = hedge_executor.submit(self._download_task, task, job, hedge_cancel, '.hedge.part')
+        cancels = {future: cancel, hedge: hedge_cancel}
+        
+        # The first request to succeed wins; if both fail the primary's errors are reported
+        winner = None
+        running = {future, hedge}
+        while running and winner is None:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            winner = next((f for f in (future, hedge) if f in done and not any(
+                result.get('error') for result in f.result())), None)
+        winner = winner or future
+        
+        for racer, racer_cancel in cancels.items():
+            if racer is not winner:
+                racer_cancel.set()
+                racer.add_done_callback(self._discard_task_files)
+                losers.append(racer)
+        job.hedger.record_win(winner is hedge)
+        return winner.result()
+    
+    def _discard_task_files(self, future):
+        """Remove the files of a task that lost a hedging race"""
+        if future.cancelled() or future.exception():
+            return
+        for result in future.result():
+            if os.path.exists(result['part_path']):
+                os.remove(result['part_path'])
+    
+    def download_fragments(self, fragments, job, checkpoint=True):
+        """Download fragments with a bounded worker pool, committing them in sequence order
+        
+        With checkpoint, progress.json is rewritten once the batch is done;
+        callers that run many small batches leave it to the journal instead.
+        """
+        controller = self._job_controller(job)
+        hedger = self._job_hedger(job)
+        concurrency = max(1, job.concurrency or self.concurrency)
+        task_iter = iter(self.plan_requests(job.assign_indices(fragments)))
+        total = job.next_index
+        pending = deque()
+        losers = []
+        
+        def limit():
+            return controller.limit if controller else concurrency
+        
+        # Workers write to .part files; fragments are only renamed into place
+        # and recorded in the progress journal in playlist order
+        def fill():
+            while len(pending) < limit():
+                task = next(task_iter, None)
+                if task is None:
+                    break
+                cancel = threading.Event()
+                pending.append((task, executor.submit(self._download_task, task, job, cancel), cancel,
+                                time.monotonic()))
+                if hedger:
+                    hedger.count_request()
+        
+        executor = ThreadPoolExecutor(max_workers=controller.maximum if controller else concurrency,
+                                      thread_name_prefix="fragment")
+        # Only the task at the head of the queue is hedged, so a couple of threads is enough
+        hedge_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hedge") if hedger else None
+        try:
+            fill()
+            while pending:
+                # Wait for the oldest in-flight task so commits stay ordered
+                entry = pending.popleft()
+                results = self._await_task(entry, job, hedge_executor, losers)
+                task = entry[0]
+                if hedger:
+                    hedger.observe(max(result['elapsed'] for result in results))
+                if controller:
+                    for result in results:
+                        change = controller.observe(result, job.retry_stats.congestion_errors())
+                        if change:
+                            self.logger.info(f"{job.label} concurrency {change['previous']} -> "
+                                             f"{change['concurrency']}: {change['reason']}")
+                            job.report(dict(change, type='concurrency'))
+                fill()
+                
+                for (i, fragment), result in zip(task, results):
+                    self._commit_fragment(i, fragment, result, total, job, limit())
+        finally:
+            for _, future, cancel, _ in pending:
+                future.cancel()
+                cancel.set()
+            # Cancelled hedge losers clean up after themselves; one stuck on a slow
+            # server must not hold up the job
+            still_running = any(not loser.done() for loser in losers)
+            executor.shutdown(wait=not still_running)
+            if hedge_executor:
+                hedge_executor.shutdown(wait=not still_running)
+            if job.writer:
+                job.writer.close()
+            if checkpoint:
+                job.checkpoint()
+        
+        return True
+    
+    def _commit_fragment(self, i, fragment, result, total, job, concurrency=None):
+        """Move a downloaded fragment into place and record it in the progress journal"""
+        fragment_path = job.fragment_path(i)
+        part_path = result.get('part_path', fragment_path + '.part')
+        if job.single_file:
+            if result['bytes'] and os.path.exists(part_path):
+                writer = job.append_writer()
+                size = writer.append(part_path, fragment['sequence'])
+                if job.remux:
+                    job.remux.feed(writer.path, writer.offset - size, size)
+            elif os.path.exists(part_path):
+                os.remove(part_path)
+        elif os.path.exists(part_path):
+            os.replace(part_path, fragment_path)
+            if job.remux and result['bytes']:
+                job.remux.feed(fragment_path)
+        if job.merger:
+            job.merger.committed(i, fragment_path, result['bytes'])
+        self.logger.info(f"Downloaded {job.label.lower()} {i+1}/{total}: {result['bytes']} bytes")
+        job.report({
+            'type': 'fragment',
+            'current': i + 1,
+            'total': total,
+            'sequence': fragment['sequence'],
+            'bytes': result['bytes'],
+            'concurrency': concurrency
+        })
+        
+        # Save progress
+        job.record(i, fragment, result['bytes'])
+    
+    def parse_dash_mpd(self, manifest_data, manifest_url=None):
+        """Parse a DASH manifest into its MPD-level attributes and representations"""
+        return DashManifestParser(manifest_url).parse(manifest_data)
+    
+    def parse_dash_manifest(self, manifest_data, manifest_url=None):
+        """Parse a DASH manifest to get fragment URLs"""
+        try:
+            return self.parse_dash_mpd(manifest_data, manifest_url)['representations']
             
         except Exception as e:
             self.logger.error(f"Failed to parse DASH manifest: {str(e)}")
             return []
     
-    def parse_m3u8_playlist(self, playlist_data, base_url=None):
-        """Parse an HLS (.m3u8) playlist to get fragment URLs"""
-        try:
-            lines = playlist_data.decode('utf-8').splitlines()
+    def select_dash_representation(self, representations, quality='best', content_type='video'):
+        """Pick the representation that best matches a quality such as best, worst or 720p60"""
+        candidates = [rep for rep in representations if rep['content_type'] == content_type] or representations
+        if not candidates:
+            return None
+        
+        for rep in candidates:
+            if quality in (rep.get('id') or ''):
+                return rep
+        
+        by_bandwidth = sorted(candidates, key=lambda rep: rep['bandwidth'])
+        if quality == 'worst':
+            return by_bandwidth[0]
+        
+        match = re.match(r'^(\d+)p(\d+)?$', quality or '')
+        if match:
+            height = int(match.group(1))
+            frame_rate = int(match.group(2)) if match.group(2) else None
+            matching = [
+                rep for rep in by_bandwidth
+                if rep['height'] == height and (frame_rate is None or round(rep['frame_rate'] or 0) == frame_rate)
+            ]
+            if matching:
+                return matching[-1]
+        
+        if quality == 'best':
+            return by_bandwidth[-1]
+        
+        # If requested quality not found, use first one
+        return candidates[0]
+    
+    def build_dash_fragments(self, rep, mpd, now=None):
+        """Expand a representation's SegmentTemplate / SegmentTimeline into fragment URLs"""
+        base_url = rep['base_url'] or ''
+        if not rep['media']:
+            # SegmentBase or a single BaseURL: the whole representation is one file
+            return [{'url': base_url, 'sequence': 0, 'duration': rep['period_duration']}] if rep['base_url'] else []
+        
+        now = now if now is not None else time.time()
+        timescale = rep['timescale']
+        offset = rep['presentation_time_offset']
+        dynamic = mpd['type'] == 'dynamic' and mpd['availability_start_time'] is not None
+        # Live edge, in timescale units of the period's media timeline
+        live_edge = offset + (now - mpd['availability_start_time'] - rep['period_start']) * timescale if dynamic else None
+        # Segments addressed by $Time$ (with or without a format) only keep stable sequence numbers when keyed by time
+        identifiers = {match.group(1) for match in _TEMPLATE_IDENTIFIER.finditer(rep['media'])}
+        keyed_by_time = 'Time' in identifiers and 'Number' not in identifiers
+        # Keeps sequences unique and increasing across periods
+        period_key = round((rep['period_start'] or 0) * 1000) << _PERIOD_SEQUENCE_SHIFT
+        
+        def fragment(number, segment_time, duration):
+            url = expand_segment_template(rep['media'], rep['id'], number, segment_time, rep['bandwidth'])
+            return {
+                'url': urljoin(base_url, url),
+                'sequence': period_key + (segment_time if keyed_by_time else number),
+                'duration': duration / timescale
+            }
+        
+        fragments = []
+        number = rep['start_number']
+        
+        if rep['timeline']:
+            segment_time = 0
+            timeline = rep['timeline']
+            for i, s in enumerate(timeline):
+                if s['t'] is not None:
+                    segment_time = s['t']
+                repeat = s['r']
+                if repeat < 0:
+                    # Open-ended repeat runs to the next S element, the period end or the live edge
+                    if i + 1 < len(timeline) and timeline[i + 1]['t'] is not None:
+                        end = timeline[i + 1]['t']
+                    elif rep['period_duration'] is not None:
+                        end = offset + rep['period_duration'] * timescale
+                    elif live_edge is not None:
+                        end = live_edge
+                    else:
+                        end = segment_time + s['d']
+                    repeat = max(0, math.ceil((end - segment_time) / s['d']) - 1)
+                
+                for _ in range(repeat + 1):
+                    fragments.append(fragment(number, segment_time, s['d']))
+                    segment_time += s['d']
+                    number += 1
+        
+        elif rep['duration']:
+            segment_duration = rep['duration'] / timescale
+            first = rep['start_number']
+            if dynamic:
+                # Only segments that are fully available and still inside the DVR window
+                elapsed = (live_edge - offset) / timescale
+                last = first + int(elapsed // segment_duration) - 1
+                if rep['period_duration'] is not None:
+                    # A period that is over ends before the live edge
+                    last = min(last, first + math.ceil(rep['period_duration'] / segment_duration) - 1)
+                if mpd['time_shift_buffer_depth']:
+                    first = max(first, last - int(mpd['time_shift_buffer_depth'] // segment_duration) + 1)
+            else:
+                total = rep['period_duration'] or mpd['media_presentation_duration'] or 0
+                last = first + math.ceil(total / segment_duration) - 1
+            
+            for number in range(first, last + 1):
+                segment_time = offset + (number - rep['start_number']) * rep['duration']
+                fragments.append(fragment(number, segment_time, rep['duration']))
+        
+        return fragments
+    
+    def build_dash_live_fragments(self, mpd, representation_id, now=None):
+        """Expand a representation in every period of a live MPD that lists it, in presentation order"""
+        reps = mpd['index'].get(representation_id)
+        if not reps:
+            raise ValueError(f"Representation {representation_id} is no longer in the manifest")
+        return [fragment for rep in reps for fragment in self.build_dash_fragments(rep, mpd, now)]
+    
+    def download_dash_initialization(self, rep, job):
+        """Download a representation's initialization segment, if it has one"""
+        if not rep['initialization']:
+            return True
+        
+        url = urljoin(rep['base_url'] or '', expand_segment_template(rep['initialization'], rep['id'], bandwidth=rep['bandwidth']))
+        result = self.download_fragment(url, os.path.join(job.output_dir, 'init.mp4'), job.cookies)
+        return result['bytes'] > 0
+    
+    def download_dash_representation(self, manifest_url, mpd, rep, job, max_fragments=None, idle_timeout=None):
+        """Download one DASH representation: its init segment, then its media segments"""
+        os.makedirs(job.output_dir, exist_ok=True)
+        
+        if not self.download_dash_initialization(rep, job):
+            self.logger.error("Failed to download DASH initialization segment")
+            return False
+        if job.remux and rep['initialization']:
+            job.remux.feed(os.path.join(job.output_dir, 'init.mp4'))
+        
+        if mpd['type'] == 'dynamic':
+            return self.download_live_dash(manifest_url, rep['id'], job, max_fragments, idle_timeout)
+        
+        fragments = self.build_dash_fragments(rep, mpd)
+        if not fragments:
+            self.logger.error("No fragments found in DASH representation")
+            return False
+        
+        # Limit the number of fragments if needed
+        if max_fragments:
+            fragments = fragments[:max_fragments]
+        
+        return self.download_fragments(fragments, job)
+    
+    def download_dash_av(self, manifest_url, output_dir, quality='best', max_fragments=None, cookies=None,
+                         concurrency=None, idle_timeout=None, progress_callback=None, resume=False, rate_limiter=None,
+                         single_file=False):
+        """Download the video and audio representations of a DASH stream in parallel
+        
+        Tracks are written to the video/ and audio/ subdirectories of output_dir,
+        ready for stream_merger to mux them in a single pass. A rate_limiter caps
+        both tracks together, and single_file appends each track to one file.
+        """
+        self.logger.info(f"Downloading video and audio tracks from: {manifest_url}")
+        
+        mpd = self.parse_dash_mpd(self.download_data(manifest_url, cookies), manifest_url)
+        video_rep = self.select_dash_representation(
+            [rep for rep in mpd['representations'] if rep['content_type'] == 'video'], quality)
+        audio_rep = self.select_dash_representation(
+            [rep for rep in mpd['representations'] if rep['content_type'] == 'audio'], 'best', content_type='audio')
+        
+        if not video_rep or not audio_rep:
+            self.logger.error("DASH manifest does not have both a video and an audio representation")
+            return False
+        
+        tracks = [
+            (video_rep, FragmentJob(os.path.join(output_dir, 'video'), cookies, concurrency, 'm4s',
+                                    'Video fragment', progress_callback, resume, rate_limiter, single_file)),
+            (audio_rep, FragmentJob(os.path.join(output_dir, 'audio'), cookies, concurrency, 'm4s',
+                                    'Audio fragment', progress_callback, resume, rate_limiter, single_file))
+        ]
+        
+        # Each track runs its own fragment pool, so wall-clock time is bounded by the slower one
+        with ThreadPoolExecutor(max_workers=len(tracks), thread_name_prefix="track") as executor:
+            futures = [
+                executor.submit(self.download_dash_representation, manifest_url, mpd, rep, job, max_fragments, idle_timeout)
+                for rep, job in tracks
+            ]
+            results = [future.result() for future in futures]
+        
+        return all(results)
+    
+    def parse_m3u8_media_playlist(self, playlist_data, base_url=None, after_sequence=None):
+        """Parse an HLS media playlist into its fragments and playlist-level tags
+        
+        Fragments up to after_sequence are skipped without building them, so a
+        live reload only yields the segments that are new since the last one.
+        The fragments come back as a compact FragmentTable.
+        """
+        return MediaPlaylistParser(base_url).parse(playlist_data, after_sequence)
+    
+    def parse_m3u8_master_playlist(self, playlist_data, base_url=None):
+        """Parse an HLS master playlist into its variant streams"""
+        lines = playlist_data.decode('utf-8').splitlines()
+        
+        video_names = {}
+        variants = []
+        stream_inf = None
+        
+        for line in lines:
+            line = line.strip()
+            if line.startswith('#EXT-X-MEDIA:'):
+                attributes = _parse_attribute_list(line[len('#EXT-X-MEDIA:'):])
+                if attributes.get('TYPE') == 'VIDEO':
+                    video_names[attributes.get('GROUP-ID')] = attributes.get('NAME')
             
-            fragments = []
-            media_sequence = 0
+            elif line.startswith('#EXT-X-STREAM-INF:'):
+                stream_inf = _parse_attribute_list(line[len('#EXT-X-STREAM-INF:'):])
             
-            for i, line in enumerate(lines):
-                if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
-                    media_sequence = int(line.split(':')[1])
-                
-                elif not line.startswith('#') and line.strip():
-                    # This is a fragment URL
-                    url = line
-                    
-                    # Make relative URLs absolute
-                    if base_url and not url.startswith(('http://', 'https://')):
-                        url = base_url + ('/' if not base_url.endswith('/') and not url.startswith('/') else '') + url
-                    
-                    fragments.append({
-                        'url': url,
-                        'sequence': media_sequence
-                    })
-                    
-                    media_sequence += 1
+            elif stream_inf is not None and line and not line.startswith('#'):
+                # The URI line following EXT-X-STREAM-INF is the variant's media playlist
+                width, _, height = stream_inf.get('RESOLUTION', '').partition('x')
+                codecs = stream_inf.get('CODECS')
+                variants.append({
+                    'url': _resolve_uri(base_url, line),
+                    'bandwidth': int(stream_inf.get('BANDWIDTH', 0)),
+                    'width': int(width) if width else None,
+                    'height': int(height) if height else None,
+                    'frame_rate': float(stream_inf['FRAME-RATE']) if 'FRAME-RATE' in stream_inf else None,
+                    'codecs': codecs,
+                    'video_group': stream_inf.get('VIDEO'),
+                    'audio_only': not height and bool(codecs) and all(
+                        codec.strip().lower().startswith(_AUDIO_CODECS) for codec in codecs.split(',')
+                    )
+                })
+                stream_inf = None
+        
+        # Rendition names such as "720p60" or "audio_only" come from EXT-X-MEDIA, which
+        # may appear anywhere in the playlist
+        for variant in variants:
+            variant['name'] = video_names.get(variant.pop('video_group'))
+            if variant['name'] == 'audio_only':
+                variant['audio_only'] = True
+        
+        return variants
+    
+    def select_hls_variant(self, variants, quality='best'):
+        """Pick the variant matching a quality such as best, worst, 720p60 or audio_only"""
+        if not variants:
+            return None
+        
+        quality = (quality or 'best').lower()
+        
+        def by_bandwidth(candidates):
+            return sorted(candidates, key=lambda variant: variant['bandwidth'])
+        
+        # Rendition names as published by the platform, e.g. "1080p60 (source)"
+        for variant in variants:
+            if variant['name'] and variant['name'].split()[0].lower() == quality:
+                return variant
+        
+        video = [variant for variant in variants if not variant['audio_only']] or variants
+        audio = [variant for variant in variants if variant['audio_only']]
+        
+        if quality in ('audio_only', 'audio'):
+            if audio:
+                return by_bandwidth(audio)[-1]
+            self.logger.warning("No audio-only variant in master playlist, using the lowest quality")
+            return by_bandwidth(variants)[0]
+        
+        if quality == 'worst':
+            return by_bandwidth(video)[0]
+        
+        match = re.match(r'^(\d+)p(\d+)?$', quality)
+        if match:
+            height = int(match.group(1))
+            matching = [variant for variant in video if variant['height'] == height]
+            if match.group(2):
+                frame_rate = int(match.group(2))
+                matching = [v for v in matching if v['frame_rate'] and round(v['frame_rate']) == frame_rate]
+            else:
+                # Plain "720p" means the standard frame rate variant when a 60 fps one also exists
+                matching = [v for v in matching if not v['frame_rate'] or v['frame_rate'] <= 31] or matching
             
-            return fragments
+            if matching:
+                return by_bandwidth(matching)[-1]
+            self.logger.warning(f"Quality {quality} not found in master playlist, using best")
+        
+        return by_bandwidth(video)[-1]
+    
+    def resolve_hls_playlist(self, playlist_url, quality='best', cookies=None, retry_stats=None):
+        """Follow a master playlist to the media playlist for the requested quality
+        
+        Returns the media playlist URL and its contents.
+        """
+        playlist_data = self.download_data(playlist_url, cookies, retry_stats)
+        if b'#EXT-X-STREAM-INF' not in playlist_data:
+            return playlist_url, playlist_data
+        
+        variants = self.parse_m3u8_master_playlist(playlist_data, _playlist_base_url(playlist_url))
+        variant = self.select_hls_variant(variants, quality)
+        if not variant:
+            raise ValueError("Master playlist has no variant streams")
+        
+        self.logger.info(
+            f"Selected variant {variant['name'] or variant['height'] or 'audio'} "
+            f"({variant['bandwidth']} bps) for quality {quality}"
+        )
+        return variant['url'], self.download_data(variant['url'], cookies, retry_stats)
+    
+    def parse_m3u8_playlist(self, playlist_data, base_url=None):
+        """Parse an HLS (.m3u8) playlist to get fragment URLs"""
+        try:
+            return self.parse_m3u8_media_playlist(playlist_data, base_url)['fragments']
             
         except Exception as e:
             self.logger.error(f"Failed to parse M3U8 playlist: {str(e)}")
@@ -190,43 +1162,80 @@ class StreamDownloader:
             ]
         }
     
-    def download_stream_fragments(self, manifest_url, output_dir, quality='best', max_fragments=None, cookies=None):
-        """Download stream fragments from a manifest URL"""
+    def download_stream_fragments(self, manifest_url, output_dir, quality='best', max_fragments=None, cookies=None,
+                                  concurrency=None, live=False, idle_timeout=None, progress_callback=None, resume=False,
+                                  rate_limiter=None, single_file=False, remux_output=None, ffmpeg_path="ffmpeg",
+                                  incremental_merge=False):
+        """Download stream fragments from a manifest URL
+        
+        rate_limiter is an optional TokenBucket for this job alone; its rate can be
+        changed while the download runs. With single_file, fragments are appended
+        to one stream file with an offset index instead of one file each. With
+        remux_output, committed fragments are also streamed into an FFmpeg remux
+        that writes that file during the download. With incremental_merge, TS
+        fragments are concatenated in the background as they are committed, so
+        merging afterwards only has the last few left to do.
+        """
         self.logger.info(f"Downloading stream fragments from: {manifest_url}")
         
         if not os.path.exists(output_dir):
             os.makedirs(output_dir, exist_ok=True)
         
+        job = FragmentJob(output_dir, cookies, concurrency, progress_callback=progress_callback, resume=resume,
+                          rate_limiter=rate_limiter, single_file=single_file)
+        if remux_output:
+            if resume:
+                self.logger.warning("The live remux only gets the fragments downloaded from now on; "
+                                    "merge the fragments afterwards for a complete file")
+            job.remux = RemuxPipe(remux_output, ffmpeg_path)
+        if incremental_merge and not single_file:
+            # A single-file download is already one stream
+            job.merger = IncrementalMerger(output_dir)
+            if resume:
+                job.merger.load()
+            else:
+                job.merger.reset()
+            job.merger.start()
+        
+        downloaded = False
+        try:
+            downloaded = self._download_job(manifest_url, job, quality, max_fragments, live, idle_timeout)
+        finally:
+            if job.merger:
+                job.merger.stop()
+            if job.remux and not job.remux.close():
+                downloaded = False
+        return downloaded
+    
+    def _download_job(self, manifest_url, job, quality='best', max_fragments=None, live=False, idle_timeout=None):
+        """Download the fragments of a DASH or HLS manifest into a prepared job"""
+        cookies = job.cookies
+        
         # Determine manifest type
-        if manifest_url.endswith('.mpd'):
+        manifest_path = urlparse(manifest_url).path
+        if manifest_path.endswith('.mpd'):
             # DASH manifest
-            manifest_data = self.download_data(manifest_url, cookies)
-            representations = self.parse_dash_manifest(manifest_data)
+            manifest_data = self.download_data(manifest_url, cookies, job.retry_stats)
+            mpd = self.parse_dash_mpd(manifest_data, manifest_url)
             
             # Select representation based on quality
-            selected_rep = None
-            for rep in representations:
-                if quality in rep.get('id', ''):
-                    selected_rep = rep
-                    break
-            
-            if not selected_rep and representations:
-                # If requested quality not found, use first one
-                selected_rep = representations[0]
+            selected_rep = self.select_dash_representation(mpd['representations'], quality)
             
             if not selected_rep:
                 self.logger.error("No suitable representation found in DASH manifest")
                 return False
             
-            # TODO: Implement DASH fragment downloading
-            self.logger.error("DASH fragment downloading not fully implemented")
-            return False
+            job.extension = 'm4s'
+            return self.download_dash_representation(manifest_url, mpd, selected_rep, job, max_fragments, idle_timeout)
             
-        elif manifest_url.endswith('.m3u8'):
-            # HLS manifest
-            manifest_data = self.download_data(manifest_url, cookies)
-            base_url = '/'.join(manifest_url.split('/')[:-1])
-            fragments = self.parse_m3u8_playlist(manifest_data, base_url)
+        elif manifest_path.endswith('.m3u8'):
+            # HLS manifest, following a master playlist to the requested variant
+            playlist_url, manifest_data = self.resolve_hls_playlist(manifest_url, quality, cookies, job.retry_stats)
+            
+            if live:
+                return self.download_live_hls(playlist_url, job, max_fragments, idle_timeout)
+            
+            fragments = self.parse_m3u8_playlist(manifest_data, _playlist_base_url(playlist_url))
             
             if not fragments:
                 self.logger.error("No fragments found in HLS playlist")
@@ -236,26 +1245,125 @@ class StreamDownloader:
             if max_fragments:
                 fragments = fragments[:max_fragments]
             
-            # Download fragments
-            for i, fragment in enumerate(fragments):
-                fragment_url = fragment['url']
-                fragment_path = os.path.join(output_dir, f"fragment_{i:05d}.ts")
+            return self.download_fragments(fragments, job)
+        else:
+            self.logger.error(f"Unsupported manifest type: {manifest_url}")
+            return False
+    
+    def record_live(self, reload_manifest, job, max_fragments=None, idle_timeout=None):
+        """Repeatedly reload a live manifest and download fragments newer than the last one committed
+        
+        reload_manifest() returns a dict with the current 'fragments', whether the
+        stream has 'ended' and the 'reload_interval' in seconds. Each reload only
+        adds a fragment or two, so progress.json is rewritten every
+        live_checkpoint_interval seconds and when recording stops; the journal
+        covers the commits in between.
+        """
+        idle_timeout = idle_timeout or self.live_idle_timeout
+        last_sequence = None
+        downloaded = 0
+        last_new_fragment = time.monotonic()
+        
+        try:
+            while True:
+                reload_started = time.monotonic()
+                try:
+                    manifest = reload_manifest()
+                except Exception as e:
+                    self.logger.warning(f"Failed to reload live manifest: {str(e)}")
+                    manifest = {'fragments': [], 'ended': False, 'reload_interval': None}
                 
-                bytes_downloaded = self.download_fragment(fragment_url, fragment_path, cookies)
-                self.logger.info(f"Downloaded fragment {i+1}/{len(fragments)}: {bytes_downloaded} bytes")
+                # Only fetch fragments we haven't seen in an earlier reload
+                new_fragments = [
+                    fragment for fragment in manifest['fragments']
+                    if last_sequence is None or fragment['sequence'] > last_sequence
+                ]
+                if max_fragments:
+                    new_fragments = new_fragments[:max_fragments - downloaded]
                 
-                # Save progress
-                progress = {
-                    'fragments_total': len(fragments),
-                    'fragments_downloaded': i + 1,
-                    'last_fragment': fragment['sequence'],
-                    'last_url': fragment_url
-                }
+                if new_fragments:
+                    self.download_fragments(new_fragments, job, checkpoint=False)
+                    downloaded += len(new_fragments)
+                    last_sequence = new_fragments[-1]['sequence']
+                    last_new_fragment = time.monotonic()
+                    if time.monotonic() - job.last_checkpoint >= self.live_checkpoint_interval:
+                        job.checkpoint()
                 
-                with open(os.path.join(output_dir, 'progress.json'), 'w') as f:
-                    json.dump(progress, f)
+                if manifest['ended']:
+                    self.logger.info(f"Live stream ended after {downloaded} fragments")
+                    break
+                if max_fragments and downloaded >= max_fragments:
+                    break
+                if time.monotonic() - last_new_fragment > idle_timeout:
+                    self.logger.warning(f"No new fragments for {idle_timeout} seconds, stopping live recording")
+                    break
+                
+                # Reload after one interval, or half of it if the manifest didn't
+                # change (RFC 8216 section 6.3.4)
+                reload_interval = manifest['reload_interval'] or self.live_default_target_duration
+                reload_delay = reload_interval if new_fragments else reload_interval / 2
+                time.sleep(max(0, reload_delay - (time.monotonic() - reload_started)))
+        finally:
+            job.checkpoint()
+        
+        return downloaded > 0
+    
+    def download_live_hls(self, playlist_url, job, max_fragments=None, idle_timeout=None):
+        """Record a live HLS stream by reloading its media playlist until it ends
+        
+        Reloads are conditional requests, ask for a delta update (_HLS_skip) when the
+        server allows it, and only parse segments newer than the last one seen.
+        """
+        # The parser resumes where the previous reload ended when the playlist only grew
+        parser = MediaPlaylistParser(_playlist_base_url(playlist_url))
+        state = {'etag': None, 'last_modified': None, 'last_sequence': None,
+                 'target_duration': None, 'can_skip_until': None, 'loaded_at': None}
+        
+        def reload_playlist():
+            url = playlist_url
+            # A delta update may only be requested while the last full playlist is younger
+            # than half the Skip Boundary (RFC 8216bis, 6.2.5.1)
+            if state['can_skip_until'] and time.monotonic() - state['loaded_at'] < state['can_skip_until'] / 2:
+                url = _add_query_parameter(playlist_url, '_HLS_skip', 'YES')
             
-            return True
-        else:
-            self.logger.error(f"Unsupported manifest type: {manifest_url}")
-            return False
+            data = self.download_manifest(url, job.cookies, state, job.retry_stats)
+            if data is None:
+                return {'fragments': [], 'ended': False, 'reload_interval': state['target_duration']}
+            
+            playlist = parser.parse(data, state['last_sequence'])
+            state['loaded_at'] = time.monotonic()
+            state['target_duration'] = playlist['target_duration']
+            state['can_skip_until'] = playlist['can_skip_until']
+            if playlist['fragments']:
+                state['last_sequence'] = playlist['fragments'].last_sequence
+            return {
+                'fragments': playlist['fragments'],
+                'ended': playlist['endlist'],
+                'reload_interval': playlist['target_duration']
+            }
+        
+        return self.record_live(reload_playlist, job, max_fragments, idle_timeout)
+    
+    def download_live_dash(self, manifest_url, representation_id, job, max_fragments=None, idle_timeout=None):
+        """Record a dynamic DASH stream, refreshing the MPD every minimumUpdatePeriod"""
+        state = {'etag': None, 'last_modified': None, 'reload_interval': None}
+        # Kept across refreshes so periods that are over are not rebuilt every time
+        parser = DashManifestParser(manifest_url)
+        
+        def reload_mpd():
+            data = self.download_manifest(manifest_url, job.cookies, state, job.retry_stats)
+            if data is None:
+                return {'fragments': [], 'ended': False, 'reload_interval': state['reload_interval']}
+            
+            mpd = parser.parse(data)
+            fragments = self.build_dash_live_fragments(mpd, representation_id)
+            segment_duration = fragments[-1]['duration'] if fragments else None
+            state['reload_interval'] = mpd['minimum_update_period'] or segment_duration
+            return {
+                'fragments': fragments,
+                # A live MPD switches to static once the presentation is over
+                'ended': mpd['type'] == 'static',
+                'reload_interval': state['reload_interval']
+            }
+        
+        return self.record_live(reload_mpd, job, max_fragments, idle_timeout)
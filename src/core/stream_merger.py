@@ -1,11 +1,25 @@
 import os
+import re
+import json
+import time
 import subprocess
 import shutil
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from src.core.append_writer import INDEX_FILE, fragment_file_index, fragment_file_path, single_file_path
+from src.core.fragment_validation import TS_PACKET_SIZE, TS_SYNC_BYTE
+
 logger = logging.getLogger("stream_merger")
 
+# Outputs that a byte-level concatenation of MPEG-TS fragments already is
+_TS_EXTENSIONS = ('.ts', '.m2ts', '.mts')
+# Leading fragments concatenated while the download runs, and how far that got
+PARTIAL_MERGE_FILE = "partial_merge.ts"
+MERGE_CHECKPOINT_FILE = "partial_merge.json"
+
 def check_ffmpeg():
     """Check if FFmpeg is available"""
     try:
@@ -19,24 +33,386 @@ def check_ffmpeg():
     except Exception:
         return False
 
-def merge_ts_files(input_dir, output_file, ffmpeg_path="ffmpeg"):
-    """Merge .ts fragment files into a single output file using FFmpeg"""
+def find_ts_fragments(input_dir):
+    """Return the .ts fragment files of a download in order"""
+    fragments = sorted(
+        [f for f in os.listdir(input_dir) if f.startswith("fragment_") and f.endswith(".ts")],
+        key=fragment_file_index
+    )
+    return [os.path.join(input_dir, fragment) for fragment in fragments]
+
+def _write_concat_list(input_dir, fragments, name="filelist.txt"):
+    """Write the file list of FFmpeg's concat demuxer and return its path"""
+    file_list_path = os.path.join(input_dir, name)
+    with open(file_list_path, "w") as f:
+        for fragment in fragments:
+            f.write(f"file '{fragment}'\n")
+    return file_list_path
+
+def _copy_file_range(in_fd, out_fd, offset, size):
+    """Copy in the kernel with copy_file_range; returns the offset reached"""
+    if not hasattr(os, "copy_file_range"):
+        return offset
     try:
-        # Find all fragment files and sort them numerically
-        fragments = sorted(
-            [f for f in os.listdir(input_dir) if f.startswith("fragment_") and f.endswith(".ts")],
-            key=lambda x: int(x.split("_")[1].split(".")[0])
+        while offset < size:
+            copied = os.copy_file_range(in_fd, out_fd, size - offset, offset)
+            if not copied:
+                break
+            offset += copied
+    except OSError:
+        # Not supported for these files (old kernel, cross-filesystem, some network filesystems)
+        pass
+    return offset
+
+def _sendfile(in_fd, out_fd, offset, size):
+    """Copy in the kernel with sendfile; returns the offset reached"""
+    if not hasattr(os, "sendfile"):
+        return offset
+    try:
+        while offset < size:
+            sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+            if not sent:
+                break
+            offset += sent
+    except OSError:
+        # Platforms such as macOS only send to sockets
+        pass
+    return offset
+
+def _append_file(path, out):
+    """Append a file to an unbuffered output, in the kernel where the OS allows it"""
+    with open(path, "rb") as source:
+        size = os.fstat(source.fileno()).st_size
+        offset = 0
+        for copy in (_copy_file_range, _sendfile):
+            if offset < size:
+                offset = copy(source.fileno(), out.fileno(), offset, size)
+        if offset < size:
+            source.seek(offset)
+            shutil.copyfileobj(source, out, 1024 * 1024)
+
+def _is_plain_ts(path):
+    """Check that a fragment is whole MPEG-TS packets, which concatenate byte for byte"""
+    size = os.path.getsize(path)
+    if not size or size % TS_PACKET_SIZE:
+        return False
+    with open(path, "rb") as f:
+        return f.read(1) == bytes([TS_SYNC_BYTE])
+
+def concat_ts_files(fragments, output_file):
+    """Concatenate MPEG-TS fragments into output_file without FFmpeg"""
+    with open(output_file, "wb", buffering=0) as out:
+        for fragment in fragments:
+            _append_file(fragment, out)
+
+class IncrementalMerger:
+    """Concatenate committed MPEG-TS fragments into partial_merge.ts while the download runs
+    
+    The downloader reports every commit. Commits come in file index order, so
+    every index up to the last one committed is settled: a background thread
+    appends those fragment files in order, skipping failed ones, and
+    checkpoints how many indices and bytes it has merged in partial_merge.json.
+    After a crash, load() truncates the file back to the checkpoint and the
+    merge carries on from there; when the download ends, only the fragments
+    past the checkpoint are left for finish_partial_merge().
+    """
+    
+    def __init__(self, fragments_dir, checkpoint_interval=5.0):
+        self.fragments_dir = fragments_dir
+        self.path = os.path.join(fragments_dir, PARTIAL_MERGE_FILE)
+        self.checkpoint_path = os.path.join(fragments_dir, MERGE_CHECKPOINT_FILE)
+        # Seconds between checkpoints, so a crash redoes at most that much merging
+        self.checkpoint_interval = checkpoint_interval
+        # Index of the next fragment to append, bytes merged so far and indices that failed
+        self.next_index = 0
+        self.offset = 0
+        self.skipped = []
+        self.disabled = False
+        self._settled = 0
+        self._restart = False
+        self._out = None
+        self._last_checkpoint = 0.0
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+    
+    def _fragment_path(self, index):
+        return fragment_file_path(self.fragments_dir, index)
+    
+    def load(self):
+        """Pick up the checkpoint of an earlier merge; returns False when there is none that still applies"""
+        if not os.path.exists(self.checkpoint_path):
+            self.reset()
+            return False
+        try:
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+            next_index, offset, skipped = state['fragments'], state['offset'], state['skipped']
+            skipped_set = set(skipped)
+            merged_size = sum(os.path.getsize(self._fragment_path(index))
+                              for index in range(next_index) if index not in skipped_set)
+            # Fragments that changed since, or a failed one downloaded on a later attempt, void the merge
+            valid = merged_size == offset and os.path.getsize(self.path) >= offset and \
+                not any(os.path.exists(self._fragment_path(index)) for index in skipped)
+        except (OSError, ValueError, KeyError, TypeError):
+            valid = False
+        if not valid:
+            logger.warning(f"Discarding the partial merge in {self.fragments_dir}, it no longer matches the fragments")
+            self.reset()
+            return False
+        
+        if os.path.getsize(self.path) > offset:
+            os.truncate(self.path, offset)
+        self.next_index, self.offset, self.skipped = next_index, offset, list(skipped)
+        logger.info(f"Resuming the partial merge after {next_index} fragments ({offset} bytes)")
+        return True
+    
+    def reset(self):
+        """Discard the partial merge and start again from the first fragment"""
+        self._close()
+        for path in (self.path, self.checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.next_index = 0
+        self.offset = 0
+        self.skipped = []
+    
+    def start(self):
+        """Start merging in a background thread"""
+        self._thread = threading.Thread(target=self._run, name="merge", daemon=True)
+        self._thread.start()
+    
+    def committed(self, index, path, size):
+        """Report a committed fragment file; size 0 marks a failed fragment"""
+        if self.disabled:
+            return
+        if size and not path.endswith(".ts"):
+            logger.info("Incremental merge only handles MPEG-TS fragments, leaving the merge for later")
+            self.disabled = True
+            return
+        if size and index in self.skipped:
+            # A fragment the merge went past was downloaded after all
+            self._restart = True
+        self._settled = max(self._settled, index + 1)
+        self._wake.set()
+    
+    def stop(self):
+        """Merge every settled fragment, write a last checkpoint and stop the thread"""
+        self._stopping = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._merge_settled(True)
+        self._close()
+        if self.disabled:
+            self.reset()
+    
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._stopping:
+                break
+            self._merge_settled()
+    
+    def _merge_settled(self, final=False):
+        if self.disabled:
+            return
+        try:
+            if self._restart:
+                logger.warning("A fragment that had failed was downloaded; restarting the partial merge")
+                self._restart = False
+                self.reset()
+            self.merge_through(self._settled, final)
+        except OSError as e:
+            logger.error(f"Incremental merge stopped: {str(e)}")
+            self.disabled = True
+            self._close()
+    
+    def merge_through(self, end, checkpoint=True):
+        """Append the fragment files of every index before end; returns False at one that is not plain MPEG-TS"""
+        for index in range(self.next_index, end):
+            path = self._fragment_path(index)
+            if not os.path.exists(path):
+                self.skipped.append(index)
+            elif not _is_plain_ts(path):
+                logger.info(f"{path} is not plain MPEG-TS, leaving the merge for later")
+                self.disabled = True
+                return False
+            else:
+                if self._out is None:
+                    # Not O_APPEND: copy_file_range and sendfile refuse appending destinations
+                    self._out = os.fdopen(os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o666), "wb", buffering=0)
+                    self._out.seek(self.offset)
+                _append_file(path, self._out)
+                self.offset += os.path.getsize(path)
+            self.next_index = index + 1
+        
+        if checkpoint or time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self._checkpoint()
+        return True
+    
+    def _checkpoint(self):
+        if self._out is not None:
+            # The data has to be on disk before a checkpoint can point past it
+            os.fsync(self._out.fileno())
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({'fragments': self.next_index, 'offset': self.offset, 'skipped': self.skipped}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.checkpoint_path)
+        self._last_checkpoint = time.monotonic()
+    
+    def _close(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+def finish_partial_merge(input_dir):
+    """Append the fragments a background merge had not reached; returns the merged file, or None without one"""
+    merger = IncrementalMerger(input_dir)
+    if not os.path.exists(merger.checkpoint_path) or not merger.load():
+        return None
+    fragments = find_ts_fragments(input_dir)
+    start = merger.next_index
+    end = max(start, fragment_file_index(fragments[-1]) + 1 if fragments else 0)
+    try:
+        completed = merger.merge_through(end)
+    finally:
+        merger._close()
+    if not completed:
+        merger.reset()
+        return None
+    logger.info(f"Merged {end - start} remaining fragment slots onto {merger.path}")
+    return merger.path
+
+def _remux_chunk(fragments, list_path, chunk_path, ffmpeg_path="ffmpeg"):
+    """Remux one chunk of fragments into an MPEG-TS file; returns whether it worked and FFmpeg's errors"""
+    _write_concat_list(os.path.dirname(list_path), fragments, os.path.basename(list_path))
+    try:
+        result = subprocess.run(
+            [ffmpeg_path, "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+             "-c", "copy", "-f", "mpegts", "-y", chunk_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        return result.returncode == 0 and os.path.exists(chunk_path), result.stderr.strip()
+    except OSError as e:
+        return False, str(e)
+    finally:
+        if os.path.exists(list_path):
+            os.remove(list_path)
+
+def merge_ts_chunks(input_dir, fragments, output_file, ffmpeg_path="ffmpeg", chunk_size=256, workers=None,
+                    retries=2):
+    """Merge fragments as a tree: remux chunks of them in parallel, then concatenate the chunk files
+    
+    Every chunk is its own FFmpeg process, so up to workers (the number of
+    cores by default) run at once. A chunk that fails is retried on its own,
+    up to retries more times, without redoing the others. The chunk files
+    are joined with FFmpeg's concat demuxer, which lines their timestamps up
+    the way one run over all fragments would.
+    """
+    chunk_dir = os.path.join(input_dir, "merge_chunks")
+    os.makedirs(chunk_dir, exist_ok=True)
+    chunks = [fragments[start:start + chunk_size] for start in range(0, len(fragments), chunk_size)]
+    chunk_paths = [os.path.join(chunk_dir, f"chunk_{n:05d}.ts") for n in range(len(chunks))]
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    logger.info(f"Remuxing {len(fragments)} fragments in {len(chunks)} chunks with {workers} FFmpeg processes")
+    
+    try:
+        pending = list(range(len(chunks)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="merge") as executor:
+            for attempt in range(retries + 1):
+                futures = [
+                    (n, executor.submit(_remux_chunk, chunks[n], os.path.join(chunk_dir, f"chunk_{n:05d}.txt"),
+                                        chunk_paths[n], ffmpeg_path))
+                    for n in pending
+                ]
+                pending = []
+                for n, future in futures:
+                    ok, errors = future.result()
+                    if not ok:
+                        logger.warning(f"Remuxing chunk {n + 1}/{len(chunks)} failed "
+                                       f"(attempt {attempt + 1}/{retries + 1}): {errors}")
+                        pending.append(n)
+                if not pending:
+                    break
+        if pending:
+            logger.error(f"{len(pending)} of {len(chunks)} chunks could not be remuxed")
+            return False
+        
+        list_path = _write_concat_list(chunk_dir, chunk_paths)
+        cmd = [ffmpeg_path, "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", "-y", output_file]
+        logger.info(f"Running FFmpeg command: {' '.join(cmd)}")
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
         )
         
+        if result.returncode == 0:
+            logger.info(f"Successfully merged {len(fragments)} fragment files into {output_file} "
+                        f"from {len(chunks)} chunks")
+            return True
+        else:
+            logger.error(f"FFmpeg chunk concatenation failed with exit code {result.returncode}")
+            logger.error(f"Error: {result.stderr}")
+            return False
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+def merge_ts_files(input_dir, output_file, ffmpeg_path="ffmpeg", native=True, parallel=False, chunk_size=256):
+    """Merge .ts fragment files into a single output file
+    
+    Plain MPEG-TS fragments going into a TS output are concatenated natively,
+    which is what FFmpeg's concat demuxer would produce for them; anything
+    else is merged with FFmpeg. With parallel, more than chunk_size fragments
+    are merged as a tree of chunks by merge_ts_chunks.
+    """
+    try:
+        ts_output = output_file.lower().endswith(_TS_EXTENSIONS)
+        
+        # A single-file download is already one continuous transport stream
+        stream_path = single_file_path(input_dir, "ts")
+        single_file = os.path.exists(stream_path)
+        if single_file and ts_output:
+            _link_or_copy(stream_path, output_file)
+            logger.info(f"Using single-file stream {stream_path} as {output_file} without concatenating")
+            return True
+        
+        # A merge that ran during the download leaves only the last fragments to add
+        partial = None if single_file else finish_partial_merge(input_dir)
+        if partial and ts_output:
+            shutil.move(partial, output_file)
+            os.remove(os.path.join(input_dir, MERGE_CHECKPOINT_FILE))
+            logger.info(f"Finished the partial merge of {input_dir} into {output_file}")
+            return True
+        
+        # Other containers are remuxed from the stream, the partial merge or the fragments in order
+        if single_file:
+            fragments = [stream_path]
+        else:
+            fragments = [partial] if partial else find_ts_fragments(input_dir)
+        
         if not fragments:
             logger.error("No fragment files found to merge")
             return False
         
+        if native and ts_output and all(_is_plain_ts(f) for f in fragments):
+            concat_ts_files(fragments, output_file)
+            logger.info(f"Concatenated {len(fragments)} MPEG-TS fragment files into {output_file}")
+            return True
+        
+        if parallel and len(fragments) > chunk_size:
+            return merge_ts_chunks(input_dir, fragments, output_file, ffmpeg_path, chunk_size)
+        
         # Create a temporary file list for FFmpeg
-        file_list_path = os.path.join(input_dir, "filelist.txt")
-        with open(file_list_path, "w") as f:
-            for fragment in fragments:
-                f.write(f"file '{os.path.join(input_dir, fragment)}'\n")
+        file_list_path = _write_concat_list(input_dir, fragments)
         
         # Build FFmpeg command
         cmd = [
@@ -75,17 +451,153 @@ def merge_ts_files(input_dir, output_file, ffmpeg_path="ffmpeg"):
         logger.error(f"Error merging TS files: {str(e)}")
         return False
 
+def _link_or_copy(source, destination):
+    """Hard link source to destination, copying it where links are not supported"""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def find_track_files(track_dir):
+    """Return a fragmented MP4 track's init segment followed by its media segments in order"""
+    stream_path = single_file_path(track_dir, "m4s")
+    if os.path.exists(stream_path):
+        files = [stream_path]
+    else:
+        fragments = sorted(
+            [f for f in os.listdir(track_dir) if f.startswith("fragment_") and f.endswith(".m4s")],
+            key=fragment_file_index
+        )
+        files = [os.path.join(track_dir, fragment) for fragment in fragments]
+    
+    init_segment = os.path.join(track_dir, "init.mp4")
+    if os.path.exists(init_segment):
+        files.insert(0, init_segment)
+    
+    return files
+
+def find_track_dirs(fragments_dir):
+    """Return the fragmented MP4 track directories of a download, or an empty list for TS downloads"""
+    track_dirs = [os.path.join(fragments_dir, track) for track in ("video", "audio")]
+    if all(os.path.isdir(track_dir) and find_track_files(track_dir) for track_dir in track_dirs):
+        return track_dirs
+    
+    if find_track_files(fragments_dir):
+        return [fragments_dir]
+    
+    return []
+
+def _join_files(files, output_file):
+    """Concatenate files byte for byte"""
+    with open(output_file, "wb", buffering=0) as out:
+        for path in files:
+            _append_file(path, out)
+
+def _write_track_list(track_dir, files):
+    """Write the file list of FFmpeg's concatf protocol for one track and return its path"""
+    list_path = os.path.join(track_dir, "tracklist.txt")
+    with open(list_path, "w") as f:
+        f.write("\n".join(os.path.abspath(path) for path in files) + "\n")
+    return list_path
+
+def _ffmpeg_version(ffmpeg_path="ffmpeg"):
+    """Return FFmpeg's (major, minor) version, or None for builds that don't report a release number"""
+    try:
+        result = subprocess.run(
+            [ffmpeg_path, "-version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+    except OSError:
+        return None
+    match = re.match(r"ffmpeg version n?(\d+)\.(\d+)", result.stdout or "")
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def _lacks_concatf(result, ffmpeg_path="ffmpeg"):
+    """Check whether an FFmpeg run failed because the concatf protocol doesn't exist (before 6.0)"""
+    if "Protocol not found" in (result.stderr or ""):
+        return True
+    version = _ffmpeg_version(ffmpeg_path)
+    return version is not None and version < (6, 0)
+
+def merge_fmp4_tracks(track_dirs, output_file, ffmpeg_path="ffmpeg"):
+    """Mux fragmented MP4 tracks (e.g. DASH video and audio) into one output file in a single FFmpeg pass"""
+    list_files = []
+    joined_files = []
+    try:
+        # Each track is its init segment followed by its media segments, read
+        # by FFmpeg as one byte stream through the concatf protocol
+        inputs = []
+        for track_dir in track_dirs:
+            files = find_track_files(track_dir)
+            if not files:
+                logger.error(f"No fragment files found in {track_dir}")
+                return False
+            
+            list_path = _write_track_list(track_dir, files)
+            list_files.append(list_path)
+            inputs.append((files, f"concatf:{os.path.abspath(list_path)}"))
+        
+        def mux(input_urls):
+            cmd = [ffmpeg_path]
+            for url in input_urls:
+                cmd.extend(["-i", url])
+            for i in range(len(input_urls)):
+                cmd.extend(["-map", str(i)])
+            cmd.extend(["-c", "copy", "-y", output_file])
+            
+            logger.info(f"Running FFmpeg command: {' '.join(cmd)}")
+            return subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True
+            )
+        
+        result = mux([url for _, url in inputs])
+        
+        if result.returncode != 0 and _lacks_concatf(result, ffmpeg_path):
+            # FFmpeg before 6.0 has no concatf protocol; join each track on disk instead
+            logger.warning("FFmpeg has no concatf protocol, joining track fragments before muxing")
+            for i, (files, _) in enumerate(inputs):
+                joined_path = os.path.join(os.path.dirname(files[0]), f"track_{i}.mp4")
+                _join_files(files, joined_path)
+                joined_files.append(joined_path)
+            result = mux(joined_files)
+        
+        if result.returncode == 0:
+            logger.info(f"Successfully muxed {len(track_dirs)} track(s) into {output_file}")
+            return True
+        else:
+            logger.error(f"FFmpeg mux failed with exit code {result.returncode}")
+            logger.error(f"Error: {result.stderr}")
+            return False
+            
+    except Exception as e:
+        logger.error(f"Error muxing fragmented MP4 tracks: {str(e)}")
+        return False
+    finally:
+        for path in list_files + joined_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+def _metadata_args(metadata):
+    """Return the -metadata options for every non-empty metadata value"""
+    args = []
+    for key, value in metadata.items():
+        if value:  # Only add if value is not empty
+            args.extend(["-metadata", f"{key}={value}"])
+    return args
+
 def add_metadata(input_file, output_file, metadata, ffmpeg_path="ffmpeg"):
     """Add metadata to a video file using FFmpeg"""
     try:
         # Build FFmpeg command with metadata
         cmd = [ffmpeg_path, "-i", input_file, "-c", "copy"]
-        
-        # Add metadata options
-        for key, value in metadata.items():
-            if value:  # Only add if value is not empty
-                cmd.extend(["-metadata", f"{key}={value}"])
-        
+        cmd.extend(_metadata_args(metadata))
         cmd.extend(["-y", output_file])
         
         logger.info(f"Running FFmpeg metadata command: {' '.join(cmd)}")
@@ -146,6 +658,69 @@ def embed_thumbnail(input_file, thumbnail_path, output_file, ffmpeg_path="ffmpeg
         logger.error(f"Error embedding thumbnail: {str(e)}")
         return False
 
+def merge_in_one_pass(fragments_dir, output_file, metadata=None, thumbnail_path=None, ffmpeg_path="ffmpeg"):
+    """Merge fragments, add metadata and embed a thumbnail with a single FFmpeg run
+    
+    Each step of the separate path rereads and rewrites the whole recording;
+    here the concat input, metadata and attached picture go into one command.
+    """
+    list_files = []
+    try:
+        cmd = [ffmpeg_path]
+        track_dirs = find_track_dirs(fragments_dir)
+        if track_dirs:
+            for track_dir in track_dirs:
+                list_path = _write_track_list(track_dir, find_track_files(track_dir))
+                list_files.append(list_path)
+                cmd.extend(["-i", f"concatf:{os.path.abspath(list_path)}"])
+        elif os.path.exists(single_file_path(fragments_dir, "ts")):
+            cmd.extend(["-i", single_file_path(fragments_dir, "ts")])
+        elif finish_partial_merge(fragments_dir):
+            cmd.extend(["-i", os.path.join(fragments_dir, PARTIAL_MERGE_FILE)])
+        else:
+            fragments = find_ts_fragments(fragments_dir)
+            if not fragments:
+                logger.error("No fragment files found to merge")
+                return False
+            list_path = _write_concat_list(fragments_dir, fragments)
+            list_files.append(list_path)
+            cmd.extend(["-f", "concat", "-safe", "0", "-i", list_path])
+        
+        inputs = len(track_dirs) or 1
+        if thumbnail_path:
+            cmd.extend(["-i", thumbnail_path])
+        for i in range(inputs):
+            cmd.extend(["-map", str(i)])
+        cmd.extend(["-c", "copy"])
+        if thumbnail_path:
+            cmd.extend(["-map", str(inputs), "-disposition:v:1", "attached_pic"])
+        cmd.extend(_metadata_args(metadata or {}))
+        cmd.extend(["-y", output_file])
+        
+        logger.info(f"Running FFmpeg command: {' '.join(cmd)}")
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        
+        if result.returncode == 0:
+            logger.info(f"Merged fragments with metadata and thumbnail into {output_file} in one pass")
+            return True
+        else:
+            logger.error(f"Single-pass FFmpeg processing failed with exit code {result.returncode}")
+            logger.error(f"Error: {result.stderr}")
+            return False
+            
+    except Exception as e:
+        logger.error(f"Error in single-pass processing: {str(e)}")
+        return False
+    finally:
+        for path in list_files:
+            if os.path.exists(path):
+                os.remove(path)
+
 def clean_up_fragments(directory, keep_fragments=False):
     """Clean up fragment files after merging"""
     if keep_fragments:
@@ -153,14 +728,25 @@ def clean_up_fragments(directory, keep_fragments=False):
         return True
     
     try:
-        fragments = [f for f in os.listdir(directory) if f.startswith("fragment_") and f.endswith(".ts")]
+        fragments = [
+            os.path.join(directory, f) for f in os.listdir(directory)
+            if f.startswith("fragment_") and f.endswith(".ts")
+        ]
+        for stream_path in (single_file_path(directory, "ts"), os.path.join(directory, PARTIAL_MERGE_FILE)):
+            if os.path.exists(stream_path):
+                fragments.append(stream_path)
+        track_dirs = find_track_dirs(directory)
+        for track_dir in track_dirs:
+            fragments.extend(find_track_files(track_dir))
         
         for fragment in fragments:
-            os.remove(os.path.join(directory, fragment))
+            os.remove(fragment)
             
-        progress_file = os.path.join(directory, "progress.json")
-        if os.path.exists(progress_file):
-            os.remove(progress_file)
+        for progress_dir in set([directory] + track_dirs):
+            for progress_name in ("progress.json", "progress.journal", INDEX_FILE, MERGE_CHECKPOINT_FILE):
+                progress_file = os.path.join(progress_dir, progress_name)
+                if os.path.exists(progress_file):
+                    os.remove(progress_file)
             
         logger.info(f"Cleaned up {len(fragments)} fragment files")
         return True
@@ -191,9 +777,32 @@ def process_stream_download(fragments_dir, output_file, options=None):
     temp_dir = os.path.dirname(output_file)
     temp_file = os.path.join(temp_dir, f"temp_{os.path.basename(output_file)}")
     
-    # Step 1: Merge TS files
+    if thumbnail_path and not os.path.exists(thumbnail_path):
+        thumbnail_path = None
+    
+    # Merging alone is already one pass; with metadata or a thumbnail, try doing everything at once,
+    # unless the merge should be spread over several FFmpeg processes
+    parallel_merge = options.get("parallel_merge", False)
+    if (metadata or thumbnail_path) and options.get("single_pass", True) and not parallel_merge:
+        logger.info(f"Merging fragment files from {fragments_dir} to {output_file} in one pass")
+        if merge_in_one_pass(fragments_dir, temp_file, metadata, thumbnail_path, ffmpeg_path):
+            shutil.move(temp_file, output_file)
+            if not keep_fragments:
+                clean_up_fragments(fragments_dir, keep_fragments)
+            logger.info(f"Stream processing complete. Output file: {output_file}")
+            return True
+        logger.warning("Falling back to separate merge, metadata and thumbnail steps")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    
+    # Step 1: Merge fragments (TS fragments, or fragmented MP4 tracks from DASH)
     logger.info(f"Merging fragment files from {fragments_dir} to {temp_file}")
-    if not merge_ts_files(fragments_dir, temp_file, ffmpeg_path):
+    track_dirs = find_track_dirs(fragments_dir)
+    if track_dirs:
+        merged = merge_fmp4_tracks(track_dirs, temp_file, ffmpeg_path)
+    else:
+        merged = merge_ts_files(fragments_dir, temp_file, ffmpeg_path, parallel=parallel_merge)
+    if not merged:
         return False
     
     # Step 2: Add metadata if needed
@@ -207,7 +816,7 @@ def process_stream_download(fragments_dir, output_file, options=None):
         temp_file = metadata_file
     
     # Step 3: Embed thumbnail if needed
-    if thumbnail_path and os.path.exists(thumbnail_path):
+    if thumbnail_path:
         logger.info(f"Embedding thumbnail {thumbnail_path} into {temp_file}")
         if not embed_thumbnail(temp_file, thumbnail_path, output_file, ffmpeg_path):
             # If thumbnail embedding fails, use the file from the previous step
@@ -38,6 +38,10 @@ def download_with_streamlink(args, output_path):
     if hasattr(args, 'cookies') and args.cookies:
         command.extend(["--twitch-cookies", args.cookies])
     
+    # streamlink has no bandwidth limit option
+    if getattr(args, 'limit_rate', None):
+        print(f"{Fore.YELLOW}Warning: rate limits are not supported for Twitch downloads and will be ignored")
+    
     # Set low latency for live streams if requested
     if hasattr(args, 'no_live_from_start') and args.no_live_from_start:
         command.append("--twitch-low-latency")
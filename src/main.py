@@ -27,6 +27,7 @@ except ImportError:
 from src.utils.history_manager import HistoryManager
 from src.utils.updater import get_current_version, UpdateChecker, show_update_dialog
 from src.utils.platform_utils import detect_platform
+from src.core.rate_limiter import parse_rate
 
 # Constants
 APP_NAME = "Stream Downloader"
@@ -136,6 +137,10 @@ class Worker(QThread):
             if self.options.get("cookies_file"):
                 command.extend(["--twitch-cookies", self.options.get("cookies_file")])
             
+            # streamlink has no bandwidth limit option
+            if self.options.get("rate_limit"):
+                self.log.emit("Warning: rate limits are not supported for Twitch downloads and will be ignored")
+            
             # Set low latency for live streams if not downloading from start
             if not self.options.get("live_from_start", True):
                 command.append("--twitch-low-latency")
@@ -177,6 +182,10 @@ class Worker(QThread):
             if self.options.get("cookies_file"):
                 command.extend(["--cookies", self.options.get("cookies_file")])
             
+            # Bandwidth limit in bytes per second
+            if self.options.get("rate_limit"):
+                command.extend(["--limit-rate", str(self.options.get("rate_limit"))])
+            
             # Add verbose output
             command.append("-v")
                 
@@ -736,12 +745,22 @@ class StreamDownloaderApp(QMainWindow):
         proxy_layout.addWidget(proxy_label)
         proxy_layout.addWidget(self.proxy_url)
         
+        # Bandwidth limits
+        rate_limit_layout = QHBoxLayout()
+        rate_limit_label = QLabel("Rate limit per download:")
+        self.rate_limit = QLineEdit()
+        self.rate_limit.setPlaceholderText("e.g. 500K or 2M, empty for unlimited")
+        
+        rate_limit_layout.addWidget(rate_limit_label)
+        rate_limit_layout.addWidget(self.rate_limit)
+        
         # Auto-update option
         self.auto_update_cb = QCheckBox("Check for updates at startup")
         
         advanced_layout.addWidget(advanced_title)
         advanced_layout.addWidget(self.use_proxy_cb)
         advanced_layout.addLayout(proxy_layout)
+        advanced_layout.addLayout(rate_limit_layout)
         advanced_layout.addWidget(self.auto_update_cb)
         
         # Add to main layout
@@ -868,6 +887,12 @@ class StreamDownloaderApp(QMainWindow):
     
     def save_settings(self):
         """Save settings to QSettings"""
+        try:
+            parse_rate(self.rate_limit.text())
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Rate Limit", f"{str(e)}. Use a number of bytes per second such as 500K or 2M.")
+            return
+        
         self.settings.setValue("output_template", self.output_template.text())
         self.settings.setValue("ffmpeg_path", self.ffmpeg_path.text())
         self.settings.setValue("use_proxy", self.use_proxy_cb.isChecked())
@@ -875,6 +900,7 @@ class StreamDownloaderApp(QMainWindow):
         self.settings.setValue("last_output_dir", self.output_path.text())
         self.settings.setValue("theme", self.theme_selector.currentText().lower())
         self.settings.setValue("auto_update", self.auto_update_cb.isChecked())
+        self.settings.setValue("rate_limit", self.rate_limit.text())
         
         QMessageBox.information(self, "Settings Saved", "Your settings have been saved successfully.")
     
@@ -886,6 +912,7 @@ class StreamDownloaderApp(QMainWindow):
         self.proxy_url.setText(self.settings.value("proxy_url", ""))
         self.proxy_url.setEnabled(self.use_proxy_cb.isChecked())
         self.auto_update_cb.setChecked(self.settings.value("auto_update", True, type=bool))
+        self.rate_limit.setText(self.settings.value("rate_limit", ""))
         
         # Set theme
         theme = self.settings.value("theme", "light").lower()
@@ -932,6 +959,15 @@ class StreamDownloaderApp(QMainWindow):
         if self.use_proxy_cb.isChecked() and self.proxy_url.text():
             options["proxy"] = self.proxy_url.text()
         
+        # Add the bandwidth limit; each download process enforces its own
+        try:
+            rate_limit = parse_rate(self.rate_limit.text())
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Rate Limit", str(e))
+            return
+        if rate_limit:
+            options["rate_limit"] = rate_limit
+        
         # Create and start worker thread
         self.worker = Worker(stream_url, quality, output_dir, options)
         self.worker.progress.connect(self.update_progress)
@@ -73,6 +73,7 @@ def get_download_help():
   {Fore.YELLOW}--no-history{Style.RESET_ALL}           Don't save to download history  {Fore.YELLOW}--proxy URL{Style.RESET_ALL}            Use proxy for downloading
   {Fore.YELLOW}--retries NUMBER{Style.RESET_ALL}       Number of retry attempts (default: 3)
   {Fore.YELLOW}--timeout SECONDS{Style.RESET_ALL}      Connection timeout in seconds (default: 30)
+  {Fore.YELLOW}--limit-rate RATE{Style.RESET_ALL}      Maximum download rate of this download, e.g. 500K or 2M
   {Fore.YELLOW}--quiet{Style.RESET_ALL}                Suppress all output except errors
   {Fore.YELLOW}--abort-on-error{Style.RESET_ALL}       Abort on first error
   {Fore.YELLOW}--list-formats{Style.RESET_ALL}         List all available formats before downloading
@@ -0,0 +1,1133 @@
+import unittest
+import sys
+import os
+import json
+import importlib.util
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+import subprocess
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add the src directory to the path so we can import modules from it
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '.')))
+
+from src.core import stream_downloader
+from src.core.stream_downloader import FragmentJob, StreamDownloader, expand_segment_template
+from src.core.stream_merger import merge_ts_files
+from src.core.progress_journal import load_downloaded_sequences
+from src.core.rate_limiter import TokenBucket, global_rate_limiter
+from src.core.remux_pipe import RemuxPipe
+from src.core.fragment_validation import FragmentIntegrityError, FragmentValidator
+from src.core.m3u8_parser import MediaPlaylistParser
+from src.core.mpd_parser import DashManifestParser
+
+
+class FakeCDNHandler(BaseHTTPRequestHandler):
+    """Serves playlists and fragments registered on the server's ``routes`` dict"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        self.server.hits[path] = self.server.hits.get(path, 0) + 1
+        failures = self.server.failures.get(path)
+        if failures:
+            # Canned (status, Retry-After) error responses are served before the route
+            status, retry_after = failures.pop(0)
+            self.send_response(status)
+            if retry_after is not None:
+                self.send_header("Retry-After", retry_after)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        bad_bodies = self.server.bad_bodies.get(path)
+        if bad_bodies:
+            # Broken 200 responses are served before the route
+            body = bad_bodies.pop(0)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        route = self.server.routes.get(path)
+        if route is None:
+            self.send_error(404)
+            return
+        self.server.request_cookies[path] = self.headers.get("Cookie")
+
+        body, delay = route
+        stalled = self.server.stalled_bodies.get(path)
+        if stalled:
+            # Send the headers and the first bytes of the body, then go quiet
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:10])
+            self.wfile.flush()
+            time.sleep(stalled.pop(0))
+            self.close_connection = True
+            return
+        stalls = self.server.stalls.get(path)
+        if stalls:
+            delay += stalls.pop(0)
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            time.sleep(delay)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+        if "_HLS_skip=YES" in query and path in self.server.delta_routes:
+            self.server.delta_hits += 1
+            body = self.server.delta_routes[path]
+
+        etag = '"%08x"' % zlib.crc32(body)
+        if self.headers.get("If-None-Match") == etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        status = 200
+        byte_range = self.headers.get("Range")
+        if byte_range and self.server.honor_ranges:
+            first, _, last = byte_range[len("bytes="):].partition("-")
+            body = body[int(first):int(last) + 1]
+            status = 206
+
+        self.send_response(status)
+        if path in self.server.set_cookies:
+            self.send_header("Set-Cookie", self.server.set_cookies[path])
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StreamDownloaderTest(unittest.TestCase):
+    """Tests for the native fragment downloader"""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCDNHandler)
+        self.server.daemon_threads = True
+        self.server.routes = {}
+        self.server.hits = {}
+        self.server.failures = {}
+        self.server.bad_bodies = {}
+        self.server.stalls = {}
+        self.server.stalled_bodies = {}
+        self.server.delta_routes = {}
+        self.server.delta_hits = 0
+        self.server.not_modified = 0
+        self.server.honor_ranges = True
+        self.server.set_cookies = {}
+        self.server.request_cookies = {}
+        self.server.lock = threading.Lock()
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = "http://%s:%d" % self.server.server_address
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+    def add_playlist(self, count, delays=None, bodies=None):
+        """Register a VOD playlist of ``count`` fragments and return its URL"""
+        lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:2", "#EXT-X-MEDIA-SEQUENCE:100"]
+        for i in range(count):
+            lines.extend(["#EXTINF:2.0,", f"frag{i}.ts"])
+            delay = delays[i] if delays else 0
+            body = bodies[i] if bodies else f"fragment-{i}".encode()
+            self.server.routes[f"/frag{i}.ts"] = (body, delay)
+        lines.append("#EXT-X-ENDLIST")
+        self.server.routes["/stream.m3u8"] = ("\n".join(lines).encode(), 0)
+        return self.base_url + "/stream.m3u8"
+
+    def test_concurrent_download_commits_in_order(self):
+        """Fragments finishing out of order are still written and tracked in sequence order"""
+        # Earlier fragments are slower, so they finish last
+        url = self.add_playlist(6, delays=[0.3, 0.25, 0.2, 0.15, 0.1, 0.05])
+        downloader = StreamDownloader(max_retries=1)
+
+        self.assertTrue(downloader.download_stream_fragments(url, self.output_dir, concurrency=3))
+
+        for i in range(6):
+            with open(os.path.join(self.output_dir, f"fragment_{i:05d}.ts"), 'rb') as f:
+                self.assertEqual(f.read(), f"fragment-{i}".encode())
+        self.assertFalse(any(name.endswith('.part') for name in os.listdir(self.output_dir)))
+
+        with open(os.path.join(self.output_dir, 'progress.json')) as f:
+            progress = json.load(f)
+        self.assertEqual(progress['fragments_downloaded'], 6)
+        self.assertEqual(progress['last_fragment'], 105)
+
+    def test_resume_only_fetches_missing_fragments(self):
+        """Resuming verifies fragments on disk and re-downloads only missing or truncated ones"""
+        url = self.add_playlist(6)
+        StreamDownloader(max_retries=1).download_stream_fragments(url, self.output_dir)
+        os.remove(os.path.join(self.output_dir, "fragment_00002.ts"))
+        with open(os.path.join(self.output_dir, "fragment_00004.ts"), 'wb') as f:
+            f.write(b"frag")
+        self.server.hits.clear()
+
+        self.assertTrue(StreamDownloader(max_retries=1).download_stream_fragments(url, self.output_dir, resume=True))
+
+        self.assertEqual(sorted(self.server.hits), ["/frag2.ts", "/frag4.ts", "/stream.m3u8"])
+        for i in range(6):
+            with open(os.path.join(self.output_dir, f"fragment_{i:05d}.ts"), 'rb') as f:
+                self.assertEqual(f.read(), f"fragment-{i}".encode())
+        with open(os.path.join(self.output_dir, 'progress.json')) as f:
+            self.assertEqual(json.load(f)['fragments_downloaded'], 6)
+
+    def test_resume_replays_progress_journal(self):
+        """Fragments journaled after the last checkpoint survive a crash, a torn last line does not"""
+        url = self.add_playlist(6)
+        StreamDownloader(max_retries=1).download_stream_fragments(url, self.output_dir)
+        # Simulate a crash: the checkpoint only knows the first two fragments
+        with open(os.path.join(self.output_dir, 'progress.json')) as f:
+            progress = json.load(f)
+        progress['fragments'] = progress['fragments'][:2]
+        with open(os.path.join(self.output_dir, 'progress.json'), 'w') as f:
+            json.dump(progress, f)
+        with open(os.path.join(self.output_dir, 'progress.journal'), 'w') as f:
+            f.write("2 102 10\n3 103 10\n4 10")
+
+        self.assertEqual(load_downloaded_sequences(self.output_dir), {100, 101, 102, 103})
+        self.server.hits.clear()
+
+        self.assertTrue(StreamDownloader(max_retries=1).download_stream_fragments(url, self.output_dir, resume=True))
+
+        self.assertEqual(sorted(self.server.hits), ["/frag4.ts", "/frag5.ts", "/stream.m3u8"])
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'progress.journal')))
+        self.assertEqual(load_downloaded_sequences(self.output_dir), set(range(100, 106)))
+
+    def test_single_file_mode_appends_with_offset_index(self):
+        """Fragments go into one stream file with an offset index that resuming trims back to"""
+        url = self.add_playlist(6)
+        stream_path = os.path.join(self.output_dir, "stream.ts")
+        expected = b"".join(f"fragment-{i}".encode() for i in range(6))
+
+        self.assertTrue(StreamDownloader(max_retries=1).download_stream_fragments(
+            url, self.output_dir, max_fragments=4, single_file=True))
+
+        self.assertFalse(any(name.startswith("fragment_") for name in os.listdir(self.output_dir)))
+        with open(os.path.join(self.output_dir, "stream.index")) as f:
+            self.assertEqual(f.readline(), "100 0 10\n")
+        # Simulate a crash halfway through appending the next fragment
+        with open(stream_path, 'ab') as f:
+            f.write(b"fragm")
+        with open(os.path.join(self.output_dir, "stream.index"), 'a') as f:
+            f.write("104 40")
+        self.server.hits.clear()
+
+        self.assertTrue(StreamDownloader(max_retries=1).download_stream_fragments(
+            url, self.output_dir, resume=True, single_file=True))
+
+        self.assertEqual(sorted(self.server.hits), ["/frag4.ts", "/frag5.ts", "/stream.m3u8"])
+        with open(stream_path, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+        with open(os.path.join(self.output_dir, "stream.index")) as f:
+            self.assertEqual(f.read().splitlines()[-1], "105 50 10")
+
+        # The stream is already the merged transport stream, so FFmpeg is never run
+        output_file = os.path.join(self.output_dir, "merged.ts")
+        self.assertTrue(merge_ts_files(self.output_dir, output_file, ffmpeg_path="/nonexistent/ffmpeg"))
+        with open(output_file, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_single_file_resume_before_the_first_journal_entry(self):
+        """A fragment appended and indexed before anything reached the journal is not appended again"""
+        url = self.add_playlist(3)
+        self.assertTrue(StreamDownloader(max_retries=1).download_stream_fragments(
+            url, self.output_dir, max_fragments=1, single_file=True))
+        # Simulate a crash right after the first append, before the journal was written
+        for name in ("progress.json", "progress.journal"):
+            if os.path.exists(os.path.join(self.output_dir, name)):
+                os.remove(os.path.join(self.output_dir, name))
+        self.server.hits.clear()
+
+        self.assertTrue(StreamDownloader(max_retries=1).download_stream_fragments(
+            url, self.output_dir, resume=True, single_file=True))
+
+        self.assertEqual(sorted(self.server.hits), ["/frag1.ts", "/frag2.ts", "/stream.m3u8"])
+        with open(os.path.join(self.output_dir, "stream.ts"), 'rb') as f:
+            self.assertEqual(f.read(), b"".join(f"fragment-{i}".encode() for i in range(3)))
+
+    def test_incremental_merge_resumes_from_checkpoint(self):
+        """TS fragments are merged during the download, and a crashed merge carries on from its checkpoint"""
+        bodies = [(b"\x47" + bytes([i]) * 187) * (i + 1) for i in range(6)]
+        url = self.add_playlist(6, bodies=bodies)
+        partial_path = os.path.join(self.output_dir, "partial_merge.ts")
+        checkpoint_path = os.path.join(self.output_dir, "partial_merge.json")
+
+        self.assertTrue(StreamDownloader(max_retries=1).download_stream_fragments(
+            url, self.output_dir, max_fragments=4, incremental_merge=True))
+
+        with open(partial_path, 'rb') as f:
+            self.assertEqual(f.read(), b"".join(bodies[:4]))
+        with open(checkpoint_path) as f:
+            self.assertEqual(json.load(f), {'fragments': 4, 'offset': 188 * 10, 'skipped': []})
+        # Simulate a crash after merging two more fragments than the last checkpoint records
+        with open(checkpoint_path, 'w') as f:
+            json.dump({'fragments': 2, 'offset': 188 * 3, 'skipped': []}, f)
+        with open(partial_path, 'ab') as f:
+            f.write(b"\x47torn")
+
+        self.assertTrue(StreamDownloader(max_retries=1).download_stream_fragments(
+            url, self.output_dir, resume=True, incremental_merge=True))
+
+        with open(partial_path, 'rb') as f:
+            self.assertEqual(f.read(), b"".join(bodies))
+        output_file = os.path.join(self.output_dir, "merged.ts")
+        self.assertTrue(merge_ts_files(self.output_dir, output_file, ffmpeg_path="/nonexistent/ffmpeg"))
+        with open(output_file, 'rb') as f:
+            self.assertEqual(f.read(), b"".join(bodies))
+        self.assertFalse(os.path.exists(partial_path) or os.path.exists(checkpoint_path))
+
+    def test_remux_pipe_applies_backpressure(self):
+        """A slow FFmpeg makes feed() wait instead of queueing fragments without bound"""
+        slow_ffmpeg = os.path.join(self.output_dir, "slow_ffmpeg")
+        with open(slow_ffmpeg, 'w') as f:
+            f.write(f"""#!{sys.executable}
+import sys, time
+with open(sys.argv[-1], 'wb') as out:
+    while True:
+        data = sys.stdin.buffer.read(65536)
+        if not data:
+            break
+        out.write(data)
+        time.sleep(0.02)
+""")
+        os.chmod(slow_ffmpeg, 0o755)
+        fragments = []
+        for i in range(8):
+            path = os.path.join(self.output_dir, f"fragment_{i:05d}.ts")
+            with open(path, 'wb') as f:
+                f.write(bytes([i]) * 256 * 1024)
+            fragments.append(path)
+        output_file = os.path.join(self.output_dir, "out.ts")
+        pipe = RemuxPipe(output_file, slow_ffmpeg, max_pending=1)
+
+        for path in fragments:
+            self.assertTrue(pipe.feed(path))
+        self.assertTrue(pipe.close())
+
+        self.assertGreater(pipe.blocked_seconds, 0.1)
+        with open(output_file, 'rb') as f:
+            self.assertEqual(f.read(), b"".join(bytes([i]) * 256 * 1024 for i in range(8)))
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "FFmpeg is not installed")
+    def test_fragments_are_remuxed_while_downloading(self):
+        """The init segment and committed fragments are streamed into FFmpeg, which writes a playable file"""
+        source_dir = os.path.join(self.output_dir, "source")
+        os.makedirs(source_dir)
+        subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc=size=160x120:rate=25",
+                        "-t", "2", "-c:v", "libx264", "-g", "25", "-f", "dash", "-seg_duration", "1",
+                        os.path.join(source_dir, "out.mpd")], check=True)
+        for name in os.listdir(source_dir):
+            with open(os.path.join(source_dir, name), 'rb') as f:
+                self.server.routes[f"/remux/{name}"] = (f.read(), 0)
+        self.server.routes["/remux/manifest.mpd"] = (b"""<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT2S">
+  <Period><AdaptationSet mimeType="video/mp4">
+    <SegmentTemplate timescale="1" duration="1" startNumber="1" initialization="init-stream0.m4s"
+                     media="chunk-stream0-$Number%05d$.m4s"/>
+    <Representation id="v" bandwidth="100000" height="120"/>
+  </AdaptationSet></Period>
+</MPD>""", 0)
+        fragments_dir = os.path.join(self.output_dir, "fragments")
+        output_file = os.path.join(self.output_dir, "live.mp4")
+
+        self.assertTrue(StreamDownloader(max_retries=1).download_stream_fragments(
+            self.base_url + "/remux/manifest.mpd", fragments_dir, remux_output=output_file))
+
+        probe = subprocess.run(["ffmpeg", "-i", output_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+        self.assertIn("Video: h264", probe.stderr)
+        self.assertIn("Duration: 00:00:02", probe.stderr)
+
+    def test_missing_fragment_fails_fast(self):
+        """A 404 is not retried and the rest of the job still completes"""
+        url = self.add_playlist(3)
+        del self.server.routes["/frag1.ts"]
+        downloader = StreamDownloader(max_retries=5, retry_delay=1)
+
+        start = time.monotonic()
+        self.assertTrue(downloader.download_stream_fragments(url, self.output_dir))
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(self.server.hits["/frag1.ts"], 1)
+        with open(os.path.join(self.output_dir, 'progress.json')) as f:
+            progress = json.load(f)
+        self.assertEqual(progress['fragments_downloaded'], 2)
+        self.assertEqual(progress['retries']['permanent_failures'], 1)
+        self.assertEqual(progress['retries']['statuses'], {'404': 1})
+
+    def test_retry_after_is_honored(self):
+        """Throttled requests wait for Retry-After and count against their own budget"""
+        url = self.add_playlist(2)
+        self.server.failures["/stream.m3u8"] = [(503, "0")]
+        self.server.failures["/frag0.ts"] = [(429, "0"), (503, "0")]
+        # A 10 second exponential delay would time the test out if Retry-After were ignored
+        downloader = StreamDownloader(max_retries=3, retry_delay=10)
+
+        self.assertTrue(downloader.download_stream_fragments(url, self.output_dir))
+
+        self.assertEqual(self.server.hits["/frag0.ts"], 3)
+        with open(os.path.join(self.output_dir, 'progress.json')) as f:
+            retries = json.load(f)['retries']
+        self.assertEqual(retries['manifest_retries'], 1)
+        self.assertEqual(retries['fragment_retries'], 2)
+        self.assertEqual(retries['retry_after_waits'], 3)
+
+    def test_rate_limits_are_shared_by_workers(self):
+        """Concurrent fragment workers together stay under the job's rate limit"""
+        url = self.add_playlist(4)
+        for i in range(4):
+            self.server.routes[f"/frag{i}.ts"] = (bytes(100 * 1024), 0)
+        job_limit = TokenBucket(800 * 1024, burst=1)
+        downloader = StreamDownloader(max_retries=1, rate_limiter=TokenBucket())
+
+        start = time.monotonic()
+        self.assertTrue(downloader.download_stream_fragments(url, self.output_dir, concurrency=4, rate_limiter=job_limit))
+
+        # 400 KiB at 800 KiB/s
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+        # Lifting the limit at runtime takes effect on the next download
+        job_limit.set_rate(None)
+        start = time.monotonic()
+        downloader.download_stream_fragments(url, tempfile.mkdtemp(dir=self.output_dir), rate_limiter=job_limit)
+        self.assertLess(time.monotonic() - start, 0.45)
+
+    def test_downloader_rate_limit_is_its_own(self):
+        """set_rate_limit caps one downloader, which is still charged to the process-wide bucket"""
+        first, second = StreamDownloader(), StreamDownloader()
+        first.set_rate_limit(1024)
+
+        self.assertEqual(first.rate_limiter.rate, 1024)
+        self.assertIsNone(second.rate_limiter.rate)
+        self.assertIsNone(global_rate_limiter.rate)
+        job = FragmentJob(self.output_dir, rate_limiter=TokenBucket(2048))
+        self.assertEqual(first._rate_limiters(job), (job.rate_limiter, first.rate_limiter, global_rate_limiter))
+
+    def test_changing_the_rate_keeps_a_configured_burst(self):
+        """A burst given explicitly survives later rate changes"""
+        bucket = TokenBucket(1000, burst=10)
+        bucket.set_rate(5000)
+        self.assertEqual(bucket.burst, 10)
+        self.assertEqual(TokenBucket(1000).burst, 1000)
+
+    def test_invalid_fragments_are_refetched(self):
+        """HTML error pages and truncated TS packets are re-downloaded and counted as repaired"""
+        url = self.add_playlist(3)
+        packets = b"".join(b"\x47" + bytes([i]) * 187 for i in range(4))
+        for i in range(3):
+            self.server.routes[f"/frag{i}.ts"] = (packets, 0)
+        self.server.bad_bodies["/frag1.ts"] = [b"<html><body>Service unavailable</body></html>", packets[:-10]]
+        downloader = StreamDownloader(max_retries=3, retry_delay=0.01)
+
+        self.assertTrue(downloader.download_stream_fragments(url, self.output_dir))
+
+        self.assertEqual(self.server.hits["/frag1.ts"], 3)
+        with open(os.path.join(self.output_dir, "fragment_00001.ts"), 'rb') as f:
+            self.assertEqual(f.read(), packets)
+        with open(os.path.join(self.output_dir, 'progress.json')) as f:
+            retries = json.load(f)['retries']
+        self.assertEqual(retries['integrity_errors'], 2)
+        self.assertEqual(retries['repaired_fragments'], 1)
+
+    def test_sniffing_needs_more_than_a_leading_byte(self):
+        """A short body starting with 'G' or '<' is not taken for MPEG-TS or an HTML page"""
+        for body in (b"G" + os.urandom(100), b"GIF89a" + bytes(300), b"<\x00\x01binary", b"<3 caption text"):
+            validator = FragmentValidator()
+            validator.update(body)
+            validator.finalize()
+            self.assertEqual(validator.format, 'unknown')
+
+        validator = FragmentValidator()
+        validator.update(b"  <!DOCTYPE html><html>")
+        with self.assertRaises(FragmentIntegrityError):
+            validator.finalize()
+
+    def test_fmp4_box_validation(self):
+        """fMP4 bodies must be a chain of complete boxes, fed in any chunking"""
+        body = (16).to_bytes(4, 'big') + b"styp" + b"msdh" + bytes(4) + \
+            (1).to_bytes(4, 'big') + b"mdat" + (24).to_bytes(8, 'big') + b"payload!"
+        for chunk_size in (1, 5, len(body)):
+            validator = FragmentValidator()
+            for offset in range(0, len(body), chunk_size):
+                validator.update(body[offset:offset + chunk_size])
+            validator.finalize()
+
+        validator = FragmentValidator()
+        validator.update(body[:-3])
+        with self.assertRaises(FragmentIntegrityError):
+            validator.finalize()
+        with self.assertRaises(FragmentIntegrityError):
+            FragmentValidator().finalize()
+
+    def test_concurrency_is_bounded(self):
+        """No more than the requested number of fragments are in flight"""
+        url = self.add_playlist(12, delays=[0.05] * 12)
+        downloader = StreamDownloader(max_retries=1)
+
+        downloader.download_stream_fragments(url, self.output_dir, concurrency=4)
+
+        self.assertGreater(self.server.max_in_flight, 1)
+        self.assertLessEqual(self.server.max_in_flight, 4)
+
+    def test_adaptive_concurrency_grows_and_backs_off(self):
+        """Without a fixed concurrency the in-flight limit grows on a healthy link and halves on 503s"""
+        url = self.add_playlist(40, delays=[0.02] * 40)
+        for i in range(30, 34):
+            self.server.failures[f"/frag{i}.ts"] = [(503, "0")]
+        events = []
+        downloader = StreamDownloader(max_retries=2, concurrency=2, max_concurrency=8)
+
+        self.assertTrue(downloader.download_stream_fragments(url, self.output_dir, progress_callback=events.append))
+
+        changes = [event for event in events if event['type'] == 'concurrency']
+        self.assertGreater(changes[0]['concurrency'], 2)
+        self.assertTrue(all(change['concurrency'] <= 8 for change in changes))
+        back_off = [change for change in changes if change['concurrency'] < change['previous']]
+        # Errors of requests already in flight when the limit was cut don't cut it again
+        self.assertTrue(1 <= len(back_off) < 4)
+        self.assertTrue(all("throttled" in change['reason'] for change in back_off))
+        fragment_events = [event for event in events if event['type'] == 'fragment']
+        self.assertEqual(len(fragment_events), 40)
+        self.assertTrue(all(event['concurrency'] for event in fragment_events))
+
+    def test_stalled_body_counts_as_a_timeout_and_backs_off(self):
+        """A response that stalls partway through its body is a timeout, and the in-flight limit is cut"""
+        url = self.add_playlist(12, bodies=[bytes([i]) * 1000 for i in range(12)])
+        self.server.stalled_bodies["/frag6.ts"] = [1]
+        events = []
+        downloader = StreamDownloader(max_retries=2, retry_delay=0.01, concurrency=4, request_timeout=0.3)
+
+        self.assertTrue(downloader.download_stream_fragments(url, self.output_dir, progress_callback=events.append))
+
+        with open(os.path.join(self.output_dir, 'progress.json')) as f:
+            retries = json.load(f)['retries']
+        self.assertEqual(retries['timeouts'], 1)
+        self.assertEqual(retries['congestion_errors'], 1)
+        back_off = [event for event in events if event['type'] == 'concurrency' and event['concurrency'] < event['previous']]
+        self.assertEqual(len(back_off), 1)
+        self.assertIn("timed out", back_off[0]['reason'])
+
+    def test_slow_fragment_is_hedged(self):
+        """A fragment stuck past the latency percentile is raced by a duplicate that wins"""
+        url = self.add_playlist(40, delays=[0.01] * 40)
+        self.server.stalls["/frag30.ts"] = [3]
+        events = []
+        # Ordinary jitter above the 95th percentile also gets hedged, so leave room in the budget
+        downloader = StreamDownloader(max_retries=1, hedge_min_samples=10, hedge_budget=0.2)
+
+        start = time.monotonic()
+        downloader.download_stream_fragments(url, self.output_dir, concurrency=2,
+                                             progress_callback=lambda event: events.append((time.monotonic(), event)))
+
+        committed = next(at for at, event in events if event['type'] == 'fragment' and event['sequence'] == 130)
+        self.assertLess(committed - start, 2)
+        self.assertEqual(self.server.hits["/frag30.ts"], 2)
+        with open(os.path.join(self.output_dir, "fragment_00030.ts"), 'rb') as f:
+            self.assertEqual(f.read(), b"fragment-30")
+        with open(os.path.join(self.output_dir, 'progress.json')) as f:
+            hedging = json.load(f)['hedging']
+        self.assertEqual(hedging['requests'], 40)
+        self.assertGreaterEqual(hedging['hedge_wins'], 1)
+        self.assertLessEqual(hedging['hedges'], 0.2 * 40)
+
+    def test_connections_are_reused(self):
+        """Manifest and fragment fetches share keep-alive connections"""
+        url = self.add_playlist(5)
+        downloader = StreamDownloader(max_retries=1)
+
+        downloader.download_stream_fragments(url, self.output_dir, concurrency=1)
+
+        stats = downloader.connection_stats()
+        self.assertEqual(stats['requests'], 6)
+        self.assertEqual(stats['new_connections'], 1)
+        self.assertEqual(stats['reused_connections'], 5)
+        downloader.close()
+
+    def test_idle_sessions_are_evicted(self):
+        """Sessions idle for longer than idle_timeout are closed"""
+        url = self.add_playlist(1)
+        downloader = StreamDownloader(max_retries=1, idle_timeout=0.05)
+
+        downloader.download_data(url)
+        time.sleep(0.1)
+        downloader.sessions.evict_idle()
+
+        stats = downloader.connection_stats()
+        self.assertEqual(stats['evicted_sessions'], 1)
+        self.assertEqual(stats['open_sessions'], 0)
+
+    def test_idle_sessions_are_evicted_on_release(self):
+        """A request finishing elsewhere closes sessions that went idle meanwhile"""
+        self.add_playlist(1)
+        self.server.routes["/slow"] = (b"slow", 0.3)
+        port = self.server.server_address[1]
+        downloader = StreamDownloader(max_retries=1, idle_timeout=0.1)
+
+        downloader.download_data(f"http://127.0.0.1:{port}/frag0.ts")
+        downloader.download_data(f"http://localhost:{port}/slow")
+
+        stats = downloader.connection_stats()
+        self.assertEqual(stats['evicted_sessions'], 1)
+        self.assertEqual(stats['open_sessions'], 1)
+        downloader.close()
+
+    def test_cookies_do_not_leak_between_jobs(self):
+        """A cookie set on one job's request is not sent with another job's requests to the same host"""
+        url = self.add_playlist(1)
+        self.server.set_cookies["/stream.m3u8"] = "session=job-a; Path=/"
+        downloader = StreamDownloader(max_retries=1)
+
+        downloader.download_data(url, cookies={'user': 'a'})
+        downloader.download_data(self.base_url + "/frag0.ts", cookies={'user': 'b'})
+
+        self.assertEqual(self.server.request_cookies["/frag0.ts"], "user=b")
+        downloader.close()
+
+    def test_fragment_is_streamed_in_chunks(self):
+        """Fragments larger than the read buffer are written intact and report timing"""
+        body = os.urandom(100 * 1024 + 7)
+        self.server.routes["/big.ts"] = (body, 0)
+        downloader = StreamDownloader(max_retries=1, chunk_size=4096)
+        output_path = os.path.join(self.output_dir, "big.ts")
+
+        result = downloader.download_fragment(self.base_url + "/big.ts", output_path)
+
+        self.assertEqual(result['bytes'], len(body))
+        self.assertGreaterEqual(result['elapsed'], result['time_to_first_byte'])
+        with open(output_path, 'rb') as f:
+            self.assertEqual(f.read(), body)
+        self.assertEqual(len(downloader._chunk_buffer()), 4096)
+
+    def set_live_playlist(self, first, last, endlist=False):
+        """Publish a live playlist window covering sequences ``first`` to ``last``"""
+        lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:0.1", f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+        for seq in range(first, last + 1):
+            lines.extend(["#EXTINF:0.1,", f"live{seq}.ts"])
+            self.server.routes[f"/live{seq}.ts"] = (f"live-{seq}".encode(), 0)
+        if endlist:
+            lines.append("#EXT-X-ENDLIST")
+        self.server.routes["/live.m3u8"] = ("\n".join(lines).encode(), 0)
+
+    def test_live_playlist_is_tailed_until_endlist(self):
+        """Live mode reloads the playlist and only fetches new sequence numbers"""
+        self.set_live_playlist(10, 12)
+
+        def advance():
+            time.sleep(0.3)
+            self.set_live_playlist(11, 14)
+            time.sleep(0.3)
+            self.set_live_playlist(13, 15, endlist=True)
+
+        threading.Thread(target=advance, daemon=True).start()
+        downloader = StreamDownloader(max_retries=1)
+
+        self.assertTrue(downloader.download_stream_fragments(
+            self.base_url + "/live.m3u8", self.output_dir, live=True, idle_timeout=5))
+
+        contents = []
+        for i in range(6):
+            with open(os.path.join(self.output_dir, f"fragment_{i:05d}.ts"), 'rb') as f:
+                contents.append(f.read())
+        self.assertEqual(contents, [f"live-{seq}".encode() for seq in range(10, 16)])
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, "fragment_00006.ts")))
+
+    def test_live_recording_checkpoints_by_time_not_per_reload(self):
+        """Each reload's commits only go to the journal; progress.json is written at the end"""
+        self.add_playlist(4)
+        reloads = []
+
+        def reload_manifest():
+            reloads.append(None)
+            count = len(reloads)
+            fragments = [{'url': f"{self.base_url}/frag{i}.ts", 'sequence': i, 'duration': 2.0} for i in range(count)]
+            return {'fragments': fragments, 'ended': count == 4, 'reload_interval': 0.01}
+
+        downloader = StreamDownloader(max_retries=1)
+        job = FragmentJob(self.output_dir)
+        checkpoints = []
+        original = job.journal.checkpoint
+        job.journal.checkpoint = lambda state: (checkpoints.append(state), original(state))
+
+        self.assertTrue(downloader.record_live(reload_manifest, job))
+
+        self.assertEqual(len(checkpoints), 1)
+        self.assertEqual(checkpoints[0]['fragments_downloaded'], 4)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'progress.journal')))
+
+    def test_live_recording_stops_after_idle_timeout(self):
+        """A live playlist that stops advancing ends the recording after idle_timeout"""
+        self.set_live_playlist(0, 1)
+        downloader = StreamDownloader(max_retries=1)
+
+        start = time.monotonic()
+        self.assertTrue(downloader.download_stream_fragments(
+            self.base_url + "/live.m3u8", self.output_dir, live=True, idle_timeout=0.3))
+
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         ["fragment_00000.ts", "fragment_00001.ts", "progress.json"])
+
+    def set_delta_playlist(self, first, last, skipped, endlist=False):
+        """Publish a live playlist that allows delta updates, and its delta update skipping ``skipped`` segments"""
+        header = ["#EXTM3U", "#EXT-X-TARGETDURATION:0.1", "#EXT-X-SERVER-CONTROL:CAN-SKIP-UNTIL=5.0",
+                  f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+        segments = []
+        for seq in range(first, last + 1):
+            segments.append(["#EXTINF:0.1,", f"live{seq}.ts"])
+            self.server.routes[f"/live{seq}.ts"] = (f"live-{seq}".encode(), 0)
+        footer = ["#EXT-X-ENDLIST"] if endlist else []
+        full = header + sum(segments, []) + footer
+        delta = header + [f"#EXT-X-SKIP:SKIPPED-SEGMENTS={skipped}"] + sum(segments[skipped:], []) + footer
+        self.server.routes["/live.m3u8"] = ("\n".join(full).encode(), 0)
+        self.server.delta_routes["/live.m3u8"] = "\n".join(delta).encode()
+
+    def test_live_polling_is_conditional_and_uses_delta_updates(self):
+        """Unchanged playlists are answered with 304 and later reloads ask for delta updates"""
+        self.set_delta_playlist(10, 12, skipped=1)
+
+        def advance():
+            time.sleep(0.3)
+            self.set_delta_playlist(10, 14, skipped=2)
+            time.sleep(0.3)
+            self.set_delta_playlist(11, 15, skipped=3, endlist=True)
+
+        threading.Thread(target=advance, daemon=True).start()
+        downloader = StreamDownloader(max_retries=1)
+
+        self.assertTrue(downloader.download_stream_fragments(
+            self.base_url + "/live.m3u8", self.output_dir, live=True, idle_timeout=5))
+
+        for i, seq in enumerate(range(10, 16)):
+            with open(os.path.join(self.output_dir, f"fragment_{i:05d}.ts"), 'rb') as f:
+                self.assertEqual(f.read(), f"live-{seq}".encode())
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, "fragment_00006.ts")))
+        self.assertGreater(self.server.delta_hits, 0)
+        self.assertGreater(self.server.not_modified, 0)
+
+    def test_delta_updates_stop_at_half_the_skip_boundary(self):
+        """A delta update is only requested while the last playlist is younger than half of CAN-SKIP-UNTIL"""
+        for age, expected_hits in ((2.4, 1), (2.5, 0)):
+            self.server.delta_hits = 0
+            self.set_delta_playlist(10, 12, skipped=1)
+            output_dir = os.path.join(self.output_dir, str(age))
+            # Every wait between reloads lets exactly ``age`` seconds pass
+            clock = [1000.0]
+            fake_time = mock.Mock(wraps=time)
+            fake_time.monotonic.side_effect = lambda: clock[0]
+            fake_time.sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + age)
+
+            with mock.patch.object(stream_downloader, "time", fake_time):
+                downloader = StreamDownloader(max_retries=1)
+                self.assertTrue(downloader.download_stream_fragments(
+                    self.base_url + "/live.m3u8", output_dir, live=True, idle_timeout=0.001))
+
+            self.assertEqual(self.server.delta_hits, expected_hits, f"age {age}")
+
+    def test_segment_template_expansion(self):
+        """DASH template identifiers, width formatting and $$ escapes are expanded"""
+        self.assertEqual(
+            expand_segment_template("$RepresentationID$/$Bandwidth$/seg-$Number%05d$-$Time$$$.m4s",
+                                    "v1", number=42, time=90000, bandwidth=800000),
+            "v1/800000/seg-00042-90000$.m4s")
+
+    def test_media_playlist_parser_resumes_appended_playlist(self):
+        """Fragments come from a compact table, and a grown EVENT playlist is only parsed past the last segment"""
+        head = b"""#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:10
+#EXT-X-KEY:METHOD=AES-128,URI="key.bin"
+#EXTINF:4.0,
+seg10.ts
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:100@0
+http://other.example.com/single.ts
+"""
+        tail = b"""#EXTINF:3.5,
+#EXT-X-BYTERANGE:50
+http://other.example.com/single.ts
+#EXT-X-KEY:METHOD=NONE
+#EXTINF:2.0,
+seg13.ts
+#EXT-X-ENDLIST
+"""
+        parser = MediaPlaylistParser("http://cdn.example.com/live/")
+
+        first = parser.parse(head)
+        self.assertEqual(len(first['fragments']), 2)
+        self.assertEqual(first['fragments'][0]['url'], "http://cdn.example.com/live/seg10.ts")
+        self.assertEqual(first['fragments'][0]['key']['iv'], (10).to_bytes(16, 'big'))
+        self.assertEqual(first['fragments'].last_sequence, 11)
+
+        second = parser.parse(head + tail, after_sequence=11)
+        self.assertEqual([f['sequence'] for f in second['fragments']], [12, 13])
+        self.assertEqual(second['fragments'][0]['byterange'], (100, 50))
+        self.assertEqual(second['fragments'][0]['key']['uri'], "http://cdn.example.com/live/key.bin")
+        self.assertEqual(second['fragments'][-1], {'url': "http://cdn.example.com/live/seg13.ts",
+                                                   'sequence': 13, 'duration': 2.0})
+        self.assertTrue(second['endlist'])
+        self.assertEqual(second['media_sequence'], 10)
+
+        # A playlist that no longer starts the same way is parsed from the top
+        restarted = MediaPlaylistParser("http://cdn.example.com/live/")
+        restarted.parse(head)
+        shifted = restarted.parse(head.replace(b"SEQUENCE:10", b"SEQUENCE:11") + tail, after_sequence=11)
+        self.assertEqual([f['sequence'] for f in shifted['fragments']], [12, 13, 14])
+
+    def test_dash_segment_timeline_download(self):
+        """SegmentTimeline repeats are expanded and fetched after the init segment"""
+        mpd = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT10S">
+  <Period>
+    <AdaptationSet mimeType="video/mp4">
+      <SegmentTemplate timescale="1000" initialization="$RepresentationID$/init.mp4"
+                       media="$RepresentationID$/$Time$.m4s">
+        <SegmentTimeline>
+          <S t="0" d="2000" r="2"/>
+          <S d="4000"/>
+        </SegmentTimeline>
+      </SegmentTemplate>
+      <Representation id="low" bandwidth="100000" height="360"/>
+      <Representation id="high" bandwidth="900000" height="720"/>
+    </AdaptationSet>
+  </Period>
+</MPD>"""
+        self.server.routes["/dash/manifest.mpd"] = (mpd.encode(), 0)
+        self.server.routes["/dash/high/init.mp4"] = (b"init", 0)
+        for t in (0, 2000, 4000, 6000):
+            self.server.routes[f"/dash/high/{t}.m4s"] = (f"seg-{t}".encode(), 0)
+        downloader = StreamDownloader(max_retries=1)
+
+        self.assertTrue(downloader.download_stream_fragments(
+            self.base_url + "/dash/manifest.mpd", self.output_dir, quality="720p"))
+
+        with open(os.path.join(self.output_dir, "init.mp4"), 'rb') as f:
+            self.assertEqual(f.read(), b"init")
+        for i, t in enumerate((0, 2000, 4000, 6000)):
+            with open(os.path.join(self.output_dir, f"fragment_{i:05d}.m4s"), 'rb') as f:
+                self.assertEqual(f.read(), f"seg-{t}".encode())
+
+    def test_dash_refresh_only_rebuilds_open_periods(self):
+        """A streamed MPD refresh reuses closed periods and indexes representations by id"""
+        manifest = """<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="dynamic"
+    availabilityStartTime="1970-01-01T00:00:00Z" minimumUpdatePeriod="PT2S">
+  <BaseURL>https://cdn.example/live/</BaseURL>
+  <Period id="ad" start="PT0S" duration="PT10S"><AdaptationSet mimeType="video/mp4">
+    <SegmentTemplate timescale="1" media="ad/$Time$.m4s"><SegmentTimeline><S t="0" d="2" r="4"/></SegmentTimeline></SegmentTemplate>
+    <Representation id="v" bandwidth="1000"/>
+  </AdaptationSet></Period>
+  <Period id="show" start="PT10S"><AdaptationSet mimeType="video/mp4">
+    <BaseURL>show/</BaseURL>
+    <SegmentTemplate timescale="1" media="$Time$.m4s"><SegmentTimeline>{segments}</SegmentTimeline></SegmentTemplate>
+    <Representation id="v" bandwidth="1000"/><Representation id="v-hd" bandwidth="5000"/>
+  </AdaptationSet></Period>
+</MPD>"""
+        parser = DashManifestParser("https://cdn.example/live/manifest.mpd")
+
+        first = parser.parse(manifest.format(segments='<S t="0" d="2"/>').encode())
+        second = parser.parse(manifest.format(segments='<S t="0" d="2" r="1"/>').encode())
+
+        self.assertIs(second['representations'][0], first['representations'][0])
+        self.assertIsNot(second['representations'][1], first['representations'][1])
+        self.assertEqual(second['representations'][1]['timeline'], [{'t': 0, 'd': 2, 'r': 1}])
+        self.assertEqual(second['representations'][2]['base_url'], "https://cdn.example/live/show/")
+        self.assertEqual(second['representations'][2]['period_start'], 10)
+        # Every period that lists an id is indexed, in presentation order
+        self.assertEqual(parser.index['v'], [second['representations'][0], second['representations'][1]])
+        self.assertIs(parser.index['v'][0], second['representations'][0])
+        self.assertEqual(parser.index['v-hd'], [second['representations'][2]])
+        self.assertIs(second['index'], parser.index)
+
+    def test_dynamic_dash_number_template_tracks_live_edge(self):
+        """Duration-based templates on a live MPD stop at the last complete segment"""
+        downloader = StreamDownloader()
+        mpd = downloader.parse_dash_mpd(b"""<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="dynamic"
+    availabilityStartTime="1970-01-01T00:00:00Z" timeShiftBufferDepth="PT10S" minimumUpdatePeriod="PT2S">
+  <Period start="PT0S"><AdaptationSet mimeType="audio/mp4">
+    <SegmentTemplate duration="2" startNumber="1" media="a/$Number$.m4s"/>
+    <Representation id="a" bandwidth="128000"/>
+  </AdaptationSet></Period>
+</MPD>""", "https://cdn.example/live/manifest.mpd")
+
+        fragments = downloader.build_dash_fragments(mpd['representations'][0], mpd, now=101)
+
+        self.assertEqual(mpd['minimum_update_period'], 2)
+        self.assertEqual([f['sequence'] for f in fragments], [46, 47, 48, 49, 50])
+        self.assertEqual(fragments[-1]['url'], "https://cdn.example/live/a/50.m4s")
+
+    def test_dash_live_sequences_stay_unique_across_periods(self):
+        """Numbers restarting in a new period and formatted $Time$ still give increasing sequences"""
+        downloader = StreamDownloader()
+        mpd = downloader.parse_dash_mpd(b"""<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="dynamic"
+    availabilityStartTime="1970-01-01T00:00:00Z" minimumUpdatePeriod="PT2S">
+  <Period id="one" start="PT0S" duration="PT4S"><AdaptationSet mimeType="video/mp4">
+    <SegmentTemplate duration="2" startNumber="1" media="one/$Number$.m4s"/>
+    <Representation id="v" bandwidth="1000"/>
+  </AdaptationSet></Period>
+  <Period id="two" start="PT4S"><AdaptationSet mimeType="video/mp4">
+    <SegmentTemplate timescale="1" media="two/$Time%05d$.m4s"><SegmentTimeline><S t="0" d="2" r="1"/></SegmentTimeline></SegmentTemplate>
+    <Representation id="v" bandwidth="1000"/>
+  </AdaptationSet></Period>
+</MPD>""", "https://cdn.example/live/manifest.mpd")
+
+        fragments = downloader.build_dash_live_fragments(mpd, "v", now=9)
+
+        self.assertEqual([f['url'].rsplit('/live/', 1)[1] for f in fragments],
+                         ["one/1.m4s", "one/2.m4s", "two/00000.m4s", "two/00002.m4s"])
+        sequences = [f['sequence'] for f in fragments]
+        self.assertEqual(sequences[:2], [1, 2])
+        self.assertEqual(sequences[2:], [(4000 << 48) + 0, (4000 << 48) + 2])
+
+    def test_dash_periods_without_duration_end_where_the_next_starts(self):
+        """A period with no duration attribute lasts until the next Period@start, live or not"""
+        manifest = """<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" {mpd_attributes}>
+  <Period id="p0" start="PT0S"><AdaptationSet mimeType="video/mp4">
+    <SegmentTemplate duration="2" startNumber="1" media="p0/seg_$Number$.m4s"/>
+    <Representation id="v" bandwidth="1000"/>
+  </AdaptationSet></Period>
+  <Period id="p1" start="PT10S"><AdaptationSet mimeType="video/mp4">
+    <SegmentTemplate timescale="1" media="p1/$Time$.m4s"><SegmentTimeline><S t="0" d="2" r="-1"/></SegmentTimeline></SegmentTemplate>
+    <Representation id="v" bandwidth="1000"/>
+  </AdaptationSet></Period>
+</MPD>"""
+        dynamic = manifest.format(mpd_attributes='type="dynamic" availabilityStartTime="1970-01-01T00:00:00Z" '
+                                                 'minimumUpdatePeriod="PT2S"').encode()
+        static = manifest.format(mpd_attributes='type="static" mediaPresentationDuration="PT20S"').encode()
+        first_period = ["p0/seg_%d.m4s" % n for n in range(1, 6)]
+        downloader = StreamDownloader()
+
+        parser = DashManifestParser("https://cdn.example/live/manifest.mpd")
+        mpd = parser.parse(dynamic)
+        fragments = downloader.build_dash_live_fragments(mpd, "v", now=14)
+        self.assertEqual([f['url'].rsplit('/live/', 1)[1] for f in fragments],
+                         first_period + ["p1/0.m4s", "p1/2.m4s"])
+        # The closed period is reused on refresh with the duration it got from the next start
+        refreshed = parser.parse(dynamic)
+        self.assertIs(refreshed['representations'][0], mpd['representations'][0])
+        self.assertEqual(refreshed['representations'][0]['period_duration'], 10)
+
+        mpd = downloader.parse_dash_mpd(static, "https://cdn.example/live/manifest.mpd")
+        self.assertEqual([rep['period_duration'] for rep in mpd['representations']], [10, 10])
+        self.assertEqual([f['url'].rsplit('/live/', 1)[1] for f in downloader.build_dash_fragments(
+            mpd['representations'][0], mpd)], first_period)
+        self.assertEqual(len(downloader.build_dash_fragments(mpd['representations'][1], mpd)), 5)
+
+    def test_dash_video_and_audio_download_in_parallel(self):
+        """Video and audio representations are fetched into separate tracks with their own progress"""
+        mpd = """<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT4S">
+  <Period>
+    <AdaptationSet contentType="video" mimeType="video/mp4">
+      <SegmentTemplate duration="2" initialization="$RepresentationID$-init.mp4" media="$RepresentationID$-$Number$.m4s"/>
+      <Representation id="v" bandwidth="900000" height="720"/>
+    </AdaptationSet>
+    <AdaptationSet contentType="audio" mimeType="audio/mp4">
+      <SegmentTemplate duration="2" initialization="$RepresentationID$-init.mp4" media="$RepresentationID$-$Number$.m4s"/>
+      <Representation id="a" bandwidth="128000"/>
+    </AdaptationSet>
+  </Period>
+</MPD>"""
+        self.server.routes["/av.mpd"] = (mpd.encode(), 0)
+        for rep in ("v", "a"):
+            self.server.routes[f"/{rep}-init.mp4"] = (f"{rep}-init".encode(), 0)
+            for number in (1, 2):
+                self.server.routes[f"/{rep}-{number}.m4s"] = (f"{rep}-{number}".encode(), 0.1)
+        events = []
+        downloader = StreamDownloader(max_retries=1)
+
+        self.assertTrue(downloader.download_dash_av(self.base_url + "/av.mpd", self.output_dir,
+                                                    progress_callback=events.append))
+
+        for rep, track in (("v", "video"), ("a", "audio")):
+            track_dir = os.path.join(self.output_dir, track)
+            with open(os.path.join(track_dir, "init.mp4"), 'rb') as f:
+                self.assertEqual(f.read(), f"{rep}-init".encode())
+            with open(os.path.join(track_dir, "fragment_00001.m4s"), 'rb') as f:
+                self.assertEqual(f.read(), f"{rep}-2".encode())
+        self.assertEqual(sorted((e['label'], e['current']) for e in events),
+                         [("Audio fragment", 1), ("Audio fragment", 2), ("Video fragment", 1), ("Video fragment", 2)])
+
+    TWITCH_MASTER = b"""#EXTM3U
+#EXT-X-MEDIA:TYPE=VIDEO,GROUP-ID="chunked",NAME="1080p60 (source)",AUTOSELECT=YES,DEFAULT=YES
+#EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=1920x1080,CODECS="avc1.64002A,mp4a.40.2",VIDEO="chunked",FRAME-RATE=60.000
+chunked/index.m3u8
+#EXT-X-MEDIA:TYPE=VIDEO,GROUP-ID="720p60",NAME="720p60",AUTOSELECT=YES,DEFAULT=YES
+#EXT-X-STREAM-INF:BANDWIDTH=3400000,RESOLUTION=1280x720,CODECS="avc1.4D401F,mp4a.40.2",VIDEO="720p60",FRAME-RATE=60.000
+720p60/index.m3u8
+#EXT-X-MEDIA:TYPE=VIDEO,GROUP-ID="720p30",NAME="720p",AUTOSELECT=YES,DEFAULT=YES
+#EXT-X-STREAM-INF:BANDWIDTH=2300000,RESOLUTION=1280x720,CODECS="avc1.4D401F,mp4a.40.2",VIDEO="720p30",FRAME-RATE=30.000
+/hls/720p30/index.m3u8
+#EXT-X-MEDIA:TYPE=VIDEO,GROUP-ID="160p30",NAME="160p",AUTOSELECT=YES,DEFAULT=YES
+#EXT-X-STREAM-INF:BANDWIDTH=230000,RESOLUTION=284x160,CODECS="avc1.4D401F,mp4a.40.2",VIDEO="160p30",FRAME-RATE=30.000
+160p30/index.m3u8
+#EXT-X-MEDIA:TYPE=VIDEO,GROUP-ID="audio_only",NAME="audio_only",AUTOSELECT=NO,DEFAULT=NO
+#EXT-X-STREAM-INF:BANDWIDTH=160000,CODECS="mp4a.40.2",VIDEO="audio_only"
+audio_only/index.m3u8
+"""
+
+    def test_master_playlist_variant_selection(self):
+        """Platform quality names map to the matching EXT-X-STREAM-INF variant"""
+        downloader = StreamDownloader()
+        variants = downloader.parse_m3u8_master_playlist(self.TWITCH_MASTER, "https://cdn.example/hls/master")
+
+        def selected(quality):
+            return downloader.select_hls_variant(variants, quality)['url']
+
+        self.assertEqual(len(variants), 5)
+        self.assertEqual(selected("best"), "https://cdn.example/hls/master/chunked/index.m3u8")
+        self.assertEqual(selected("1080p60"), "https://cdn.example/hls/master/chunked/index.m3u8")
+        self.assertEqual(selected("720p60"), "https://cdn.example/hls/master/720p60/index.m3u8")
+        self.assertEqual(selected("720p"), "https://cdn.example/hls/720p30/index.m3u8")
+        self.assertEqual(selected("worst"), "https://cdn.example/hls/master/160p30/index.m3u8")
+        self.assertEqual(selected("audio_only"), "https://cdn.example/hls/master/audio_only/index.m3u8")
+
+    def test_master_playlist_is_followed(self):
+        """Downloading a master playlist fetches the selected variant's fragments"""
+        self.server.routes["/master.m3u8"] = (self.TWITCH_MASTER, 0)
+        self.server.routes["/720p60/index.m3u8"] = (
+            b"#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXTINF:2.0,\nseg0.ts\n#EXT-X-ENDLIST\n", 0)
+        self.server.routes["/720p60/seg0.ts"] = (b"720p60-segment", 0)
+        downloader = StreamDownloader(max_retries=1)
+
+        self.assertTrue(downloader.download_stream_fragments(
+            self.base_url + "/master.m3u8", self.output_dir, quality="720p60"))
+
+        with open(os.path.join(self.output_dir, "fragment_00000.ts"), 'rb') as f:
+            self.assertEqual(f.read(), b"720p60-segment")
+
+    @unittest.skipUnless(importlib.util.find_spec("yt_dlp"), "yt-dlp is not installed")
+    def test_aes128_fragments_are_decrypted_while_streaming(self):
+        """EXT-X-KEY fragments are decrypted with a cached key and explicit or sequence-derived IVs"""
+        from yt_dlp.aes import aes_cbc_encrypt_bytes
+
+        key = bytes(range(16))
+        explicit_iv = bytes([7]) * 16
+        plaintexts = [os.urandom(5000), os.urandom(4096), os.urandom(33)]
+        ivs = [explicit_iv, explicit_iv, (102).to_bytes(16, 'big')]
+        for i, (plaintext, iv) in enumerate(zip(plaintexts, ivs)):
+            padding = 16 - len(plaintext) % 16
+            padded = plaintext + bytes([padding]) * padding
+            self.server.routes[f"/enc{i}.ts"] = (aes_cbc_encrypt_bytes(padded, key, iv), 0)
+        self.server.routes["/key.bin"] = (key, 0)
+        self.server.routes["/enc.m3u8"] = (b"""#EXTM3U
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:100
+#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x07070707070707070707070707070707
+#EXTINF:2.0,
+enc0.ts
+#EXTINF:2.0,
+enc1.ts
+#EXT-X-KEY:METHOD=AES-128,URI="key.bin"
+#EXTINF:2.0,
+enc2.ts
+#EXT-X-ENDLIST
+""", 0)
+        downloader = StreamDownloader(max_retries=1, chunk_size=1000)
+
+        self.assertTrue(downloader.download_stream_fragments(self.base_url + "/enc.m3u8", self.output_dir))
+
+        for i, plaintext in enumerate(plaintexts):
+            with open(os.path.join(self.output_dir, f"fragment_{i:05d}.ts"), 'rb') as f:
+                self.assertEqual(f.read(), plaintext)
+        self.assertEqual(self.server.hits["/key.bin"], 1)
+
+    def test_slow_key_server_does_not_block_cached_keys(self):
+        """A key being fetched slowly holds up neither other keys nor the cache, which stays bounded"""
+        self.server.routes["/slow.key"] = (b"s" * 16, 0.5)
+        for i in range(3):
+            self.server.routes[f"/k{i}.key"] = (bytes([i]) * 16, 0)
+        downloader = StreamDownloader(max_retries=1)
+        downloader.key_cache_size = 2
+        downloader.get_decryption_key(self.base_url + "/k0.key")
+
+        slow = threading.Thread(target=downloader.get_decryption_key, args=(self.base_url + "/slow.key",))
+        slow.start()
+        time.sleep(0.1)
+        started = time.monotonic()
+        self.assertEqual(downloader.get_decryption_key(self.base_url + "/k0.key"), b"\x00" * 16)
+        self.assertLess(time.monotonic() - started, 0.2)
+        slow.join()
+
+        downloader.get_decryption_key(self.base_url + "/k1.key")
+        downloader.get_decryption_key(self.base_url + "/k2.key")
+        self.assertEqual(list(downloader._key_cache), [self.base_url + "/k1.key", self.base_url + "/k2.key"])
+        self.assertEqual(self.server.hits["/k0.key"], 1)
+
+    def add_byterange_playlist(self, resource):
+        """Register a single-file playlist splitting ``resource`` into six byte ranges"""
+        self.server.routes["/single.ts"] = (resource, 0)
+        self.server.routes["/single.m3u8"] = (b"""#EXTM3U
+#EXT-X-TARGETDURATION:2
+#EXT-X-VERSION:4
+#EXTINF:2.0,
+#EXT-X-BYTERANGE:1000@0
+single.ts
+#EXTINF:2.0,
+#EXT-X-BYTERANGE:1000
+single.ts
+#EXTINF:2.0,
+#EXT-X-BYTERANGE:1000
+single.ts
+#EXTINF:2.0,
+#EXT-X-BYTERANGE:500@3000
+single.ts
+#EXTINF:2.0,
+#EXT-X-BYTERANGE:1500@4000
+single.ts
+#EXTINF:2.0,
+#EXT-X-BYTERANGE:100
+single.ts
+#EXT-X-ENDLIST
+""", 0)
+        return [resource[0:1000], resource[1000:2000], resource[2000:3000],
+                resource[3000:3500], resource[4000:5500], resource[5500:5600]]
+
+    def assert_fragments(self, expected):
+        for i, data in enumerate(expected):
+            with open(os.path.join(self.output_dir, f"fragment_{i:05d}.ts"), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_adjacent_byte_ranges_are_coalesced(self):
+        """Contiguous EXT-X-BYTERANGE fragments share Range requests up to max_coalesce_bytes"""
+        expected = self.add_byterange_playlist(os.urandom(6000))
+        downloader = StreamDownloader(max_retries=1, max_coalesce_bytes=2500, chunk_size=256)
+
+        self.assertTrue(downloader.download_stream_fragments(self.base_url + "/single.m3u8", self.output_dir))
+
+        self.assert_fragments(expected)
+        # [0-2000) [2000-3500) [4000-5600): the gap at 3500 starts a new request
+        self.assertEqual(self.server.hits["/single.ts"], 3)
+
+    def test_byte_ranges_from_server_without_range_support(self):
+        """A server answering Range requests with the whole resource still yields the right slices"""
+        self.server.honor_ranges = False
+        expected = self.add_byterange_playlist(os.urandom(6000))
+        downloader = StreamDownloader(max_retries=1)
+
+        self.assertTrue(downloader.download_stream_fragments(self.base_url + "/single.m3u8", self.output_dir))
+
+        self.assert_fragments(expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
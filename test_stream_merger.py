@@ -0,0 +1,273 @@
+import unittest
+import sys
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import mock
+
+# Add the src directory to the path so we can import modules from it
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '.')))
+
+from src.core import stream_merger
+from src.core.stream_merger import find_track_dirs, merge_fmp4_tracks, merge_ts_files, process_stream_download
+
+
+def run_ffmpeg(*args):
+    subprocess.run(["ffmpeg", "-loglevel", "error", "-y"] + list(args), check=True)
+
+
+@unittest.skipUnless(shutil.which("ffmpeg"), "FFmpeg is not installed")
+class StreamMergerTest(unittest.TestCase):
+    """Tests for merging downloaded fragments with FFmpeg"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.fragments_dir = os.path.join(self.work_dir, "fragments")
+        os.makedirs(self.fragments_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def make_dash_tracks(self):
+        """Lay out a short test stream the way download_dash_av does: video/ and audio/ tracks"""
+        source_dir = os.path.join(self.work_dir, "dash")
+        os.makedirs(source_dir)
+        run_ffmpeg("-f", "lavfi", "-i", "testsrc=size=160x120:rate=25", "-f", "lavfi", "-i", "sine",
+                   "-t", "3", "-c:v", "libx264", "-g", "25", "-c:a", "aac",
+                   "-f", "dash", "-seg_duration", "1", os.path.join(source_dir, "out.mpd"))
+
+        for stream, track in (("0", "video"), ("1", "audio")):
+            track_dir = os.path.join(self.fragments_dir, track)
+            os.makedirs(track_dir)
+            shutil.copy(os.path.join(source_dir, f"init-stream{stream}.m4s"), os.path.join(track_dir, "init.mp4"))
+            chunks = sorted(f for f in os.listdir(source_dir) if f.startswith(f"chunk-stream{stream}-"))
+            for i, chunk in enumerate(chunks):
+                shutil.copy(os.path.join(source_dir, chunk), os.path.join(track_dir, f"fragment_{i:05d}.m4s"))
+
+    def probe_streams(self, path):
+        result = subprocess.run(["ffmpeg", "-i", path], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        return [line for line in result.stderr.splitlines() if "Stream #" in line]
+
+    def test_dash_tracks_are_muxed_in_one_pass(self):
+        """Separate video and audio fragment tracks end up as two streams in one file"""
+        self.make_dash_tracks()
+        output_file = os.path.join(self.work_dir, "output.mp4")
+
+        self.assertEqual(len(find_track_dirs(self.fragments_dir)), 2)
+        self.assertTrue(process_stream_download(self.fragments_dir, output_file))
+
+        streams = self.probe_streams(output_file)
+        self.assertTrue(any("Video" in line for line in streams))
+        self.assertTrue(any("Audio" in line for line in streams))
+        self.assertEqual(os.listdir(os.path.join(self.fragments_dir, "video")), [])
+
+    def test_metadata_and_thumbnail_are_added_in_the_merge_pass(self):
+        """Merging, metadata and the attached picture take a single FFmpeg run"""
+        self.make_dash_tracks()
+        thumbnail_path = os.path.join(self.work_dir, "thumb.png")
+        run_ffmpeg("-f", "lavfi", "-i", "color=red:size=64x64", "-frames:v", "1", thumbnail_path)
+        output_file = os.path.join(self.work_dir, "output.mp4")
+        commands = []
+        real_run = subprocess.run
+
+        def run(cmd, *args, **kwargs):
+            if "-version" not in cmd:
+                commands.append(cmd)
+            return real_run(cmd, *args, **kwargs)
+
+        with mock.patch("src.core.stream_merger.subprocess.run", side_effect=run):
+            self.assertTrue(process_stream_download(self.fragments_dir, output_file, {
+                "metadata": {"title": "Single pass"},
+                "thumbnail_path": thumbnail_path
+            }))
+
+        self.assertEqual(len(commands), 1)
+        probe = subprocess.run(["ffmpeg", "-i", output_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+        self.assertIn("Single pass", probe.stderr)
+        self.assertIn("attached pic", probe.stderr)
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, "temp_output.mp4")))
+
+
+class ConcatfFallbackTest(unittest.TestCase):
+    """Tests for joining fragmented MP4 tracks on disk when FFmpeg lacks concatf"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        for name in ("init.mp4", "fragment_00000.m4s", "fragment_00001.m4s"):
+            with open(os.path.join(self.work_dir, name), "wb") as f:
+                f.write(name.encode())
+        self.output_file = os.path.join(self.work_dir, "merged.mp4")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def fake_ffmpeg(self, version, mux_error):
+        """Return a subprocess.run stand-in whose concatf mux fails with mux_error"""
+        def run(cmd, **kwargs):
+            if cmd[1] == "-version":
+                return subprocess.CompletedProcess(cmd, 0, f"ffmpeg version {version} Copyright", "")
+            if cmd[2].startswith("concatf:"):
+                return subprocess.CompletedProcess(cmd, 1, "", mux_error)
+            return subprocess.CompletedProcess(cmd, 0, "", "")
+        return run
+
+    def test_unknown_protocol_falls_back_to_joined_tracks(self):
+        """A missing concatf protocol makes the tracks get joined on disk and muxed again"""
+        with mock.patch("subprocess.run", side_effect=self.fake_ffmpeg("7.0.2", "concatf:x: Protocol not found")) as run:
+            self.assertTrue(merge_fmp4_tracks([self.work_dir], self.output_file))
+        self.assertTrue(run.call_args_list[-1][0][0][2].endswith("track_0.mp4"))
+
+    def test_old_ffmpeg_falls_back_to_joined_tracks(self):
+        """FFmpeg before 6.0 gets the joined tracks whatever its error says"""
+        with mock.patch("subprocess.run", side_effect=self.fake_ffmpeg("5.1.4", "Error opening input")) as run:
+            self.assertTrue(merge_fmp4_tracks([self.work_dir], self.output_file))
+        self.assertTrue(run.call_args_list[-1][0][0][2].endswith("track_0.mp4"))
+
+    def test_other_failures_are_not_retried(self):
+        """A broken fragment on a current FFmpeg fails once instead of being copied and muxed again"""
+        with mock.patch("subprocess.run", side_effect=self.fake_ffmpeg("7.0.2", "Invalid data found")) as run:
+            self.assertFalse(merge_fmp4_tracks([self.work_dir], self.output_file))
+        self.assertEqual([cmd[0][0][1] for cmd in run.call_args_list], ["-i", "-version"])
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, "track_0.mp4")))
+
+
+class NativeConcatTest(unittest.TestCase):
+    """Tests for concatenating MPEG-TS fragments without FFmpeg"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.fragments = []
+        for index in range(5):
+            path = os.path.join(self.work_dir, f"fragment_{index}.ts")
+            with open(path, "wb") as f:
+                f.write((b"\x47" + bytes([index]) * 187) * (index + 1))
+            self.fragments.append(path)
+        self.expected = b"".join(open(path, "rb").read() for path in self.fragments)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_ts_fragments_are_concatenated_without_ffmpeg(self):
+        """Plain MPEG-TS fragments going into a .ts output never start FFmpeg"""
+        output_file = os.path.join(self.work_dir, "merged.ts")
+        with mock.patch("subprocess.run") as run:
+            self.assertTrue(merge_ts_files(self.work_dir, output_file, ffmpeg_path="/nonexistent/ffmpeg"))
+        run.assert_not_called()
+        with open(output_file, "rb") as f:
+            self.assertEqual(f.read(), self.expected)
+
+    def test_buffered_fallback(self):
+        """Without copy_file_range or sendfile the fragments are copied through a buffer"""
+        output_file = os.path.join(self.work_dir, "merged.ts")
+        with mock.patch.object(os, "copy_file_range", side_effect=OSError, create=True), \
+                mock.patch.object(os, "sendfile", side_effect=OSError, create=True):
+            stream_merger.concat_ts_files(self.fragments, output_file)
+        with open(output_file, "rb") as f:
+            self.assertEqual(f.read(), self.expected)
+
+    def test_other_containers_go_through_ffmpeg(self):
+        """Outputs that are not MPEG-TS are still merged by FFmpeg"""
+        output_file = os.path.join(self.work_dir, "merged.mp4")
+        with mock.patch("subprocess.run", side_effect=FileNotFoundError) as run:
+            self.assertFalse(merge_ts_files(self.work_dir, output_file, ffmpeg_path="/nonexistent/ffmpeg"))
+        run.assert_called_once()
+
+
+    def test_fragments_are_ordered_by_index_past_five_digits(self):
+        """fragment_100000 comes after fragment_99999 even though it sorts before it by name"""
+        for path, index in zip(self.fragments, range(99998, 100003)):
+            os.rename(path, os.path.join(self.work_dir, f"fragment_{index:05d}.ts"))
+        output_file = os.path.join(self.work_dir, "merged.ts")
+        self.assertTrue(merge_ts_files(self.work_dir, output_file, ffmpeg_path="/nonexistent/ffmpeg"))
+        with open(output_file, "rb") as f:
+            self.assertEqual(f.read(), self.expected)
+
+    def test_single_file_stream_is_linked_only_into_ts_outputs(self):
+        """A single-file stream becomes a .ts output as is, and is remuxed by FFmpeg for other containers"""
+        stream_path = os.path.join(self.work_dir, "stream.ts")
+        with open(stream_path, "wb") as f:
+            f.write(self.expected)
+        inputs = []
+
+        def fake_run(cmd, **kwargs):
+            with open(cmd[cmd.index("-i") + 1]) as f:
+                inputs.append(f.read())
+            return subprocess.CompletedProcess(cmd, 0, "", "")
+
+        with mock.patch("subprocess.run", side_effect=fake_run):
+            self.assertTrue(merge_ts_files(self.work_dir, os.path.join(self.work_dir, "merged.ts")))
+            self.assertEqual(inputs, [])
+            self.assertTrue(merge_ts_files(self.work_dir, os.path.join(self.work_dir, "merged.mp4")))
+        self.assertEqual(inputs, [f"file '{stream_path}'\n"])
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, "merged.mp4")))
+
+
+    @unittest.skipUnless(hasattr(os, "copy_file_range"), "copy_file_range is not available")
+    def test_incremental_merge_copies_in_the_kernel(self):
+        """The background merge appends at its offset without O_APPEND, so no fragment goes through a buffer"""
+        for index, path in enumerate(self.fragments):
+            os.rename(path, os.path.join(self.work_dir, f"fragment_{index:05d}.ts"))
+        merger = stream_merger.IncrementalMerger(self.work_dir)
+        merger.reset()
+        with mock.patch.object(stream_merger.shutil, "copyfileobj") as copyfileobj:
+            self.assertTrue(merger.merge_through(2))
+            # Reopening carries on at the merged offset
+            merger._close()
+            self.assertTrue(merger.merge_through(5))
+        merger._close()
+        copyfileobj.assert_not_called()
+        with open(merger.path, "rb") as f:
+            self.assertEqual(f.read(), self.expected)
+
+
+class ParallelMergeTest(unittest.TestCase):
+    """Tests for merging chunks of fragments in parallel FFmpeg processes"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        for index in range(5):
+            with open(os.path.join(self.work_dir, f"fragment_{index:05d}.ts"), "wb") as f:
+                f.write(b"fragment")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_failed_chunk_is_retried_on_its_own(self):
+        """Only the chunk whose FFmpeg run failed is remuxed again before the chunks are joined"""
+        commands = []
+        failed_once = []
+
+        def fake_run(cmd, **kwargs):
+            commands.append(cmd)
+            output = cmd[-1]
+            if output.endswith("chunk_00001.ts") and not failed_once:
+                failed_once.append(output)
+                return subprocess.CompletedProcess(cmd, 1, "", "Invalid data")
+            with open(output, "wb") as f:
+                f.write(b"remuxed")
+            return subprocess.CompletedProcess(cmd, 0, "", "")
+
+        output_file = os.path.join(self.work_dir, "merged.mp4")
+        with mock.patch("subprocess.run", side_effect=fake_run):
+            self.assertTrue(merge_ts_files(self.work_dir, output_file, parallel=True, chunk_size=2))
+
+        outputs = [os.path.basename(cmd[-1]) for cmd in commands]
+        # Three chunks, one retry of the chunk that failed, then one concatenation of the chunks
+        self.assertEqual(sorted(outputs[:3]), ["chunk_00000.ts", "chunk_00001.ts", "chunk_00002.ts"])
+        self.assertEqual(outputs[3:], ["chunk_00001.ts", "merged.mp4"])
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, "merge_chunks")))
+
+    def test_gives_up_after_the_retries(self):
+        """A chunk that keeps failing fails the merge without concatenating the chunks"""
+        with mock.patch("subprocess.run", return_value=subprocess.CompletedProcess([], 1, "", "")) as run:
+            self.assertFalse(merge_ts_files(self.work_dir, os.path.join(self.work_dir, "merged.mp4"),
+                                            parallel=True, chunk_size=2))
+        # Every chunk gets three attempts and the chunks are never concatenated
+        self.assertEqual(run.call_count, 9)
+
+
+if __name__ == "__main__":
+    unittest.main()